@@ -5,12 +5,20 @@ to certain "managed" CAVE tables (where only pre-approved types of annotations
 may be posted). These rules are typically used for centralized community tables
 to which many users can post annotations, in order to maintain some consistency
 in which annotations are posted to the table.
+
+The annotation lists/hierarchies themselves are stored in
+annotation_vocabularies.json and are loaded the first time they're used.
 """
 
+import os
+import json
+import pickle
+import hashlib
 from typing import Tuple, Union
 from datetime import datetime, timezone
 
-import anytree
+import numpy as np
+import pandas as pd
 
 from . import auth, lookup
 
@@ -20,1222 +28,33 @@ help_msg = 'See the annotation scheme described at ' + help_url
 default_table = 'cell_info'
 
 
-leg_parts = {'innervates thorax': {},
-             'innervates thorax-coxa joint': {},
-             'innervates coxa': {},
-             'innervates coxa-trochanter joint': {},
-             'innervates trochanter': {},
-             'innervates femur': {},
-             'innervates femur-tibia joint': {},
-             'innervates tibia': {},
-             'innervates tibia-tarsus joint': {},
-             'innervates tarsus': {}}
-
-cell_info = {
-    'primary class': {
-        'sensory neuron': {
-            'unknown sensory subtype': {},
-            'photoreceptor neuron': {
-                'R7': {},
-                'R8': {}},
-            'chordotonal neuron': {
-                "Johnston's organ neuron": {},
-                'club chordotonal neuron': {},
-                'claw chordotonal neuron': {},
-                'hook chordotonal neuron': {}},
-            'bristle mechanosensory neuron': {
-                'bristle mechanosensory neuron at gustatory sensillum': {}},
-            'hair plate neuron': {},
-            'campaniform sensillum neuron': {},
-            'olfactory receptor neuron': {},
-            'gustatory neuron': {},
-            'thermosensory neuron': {},
-            'hygrosensory neuron': {}},
-        'CNS neuron': {
-            'optic lobe intrinsic': {
-                'centrifugal': {
-                    'C2': {},
-                    'C3': {}},
-                'distal medulla': {
-                    'Dm1': {},
-                    'Dm2': {},
-                    'Dm3p': {},
-                    'Dm3q': {},
-                    'Dm3v': {},
-                    'Dm4': {},
-                    'Dm6': {},
-                    'Dm8a': {},
-                    'Dm8b': {},
-                    'Dm9': {},
-                    'Dm10': {},
-                    'Dm11': {},
-                    'Dm12': {},
-                    'Dm13': {},
-                    'Dm14': {},
-                    'Dm15': {},
-                    'Dm16': {},
-                    'Dm17': {},
-                    'Dm18': {},
-                    'Dm19': {},
-                    'Dm20': {}},
-                'distal medulla dorsal rim area': {
-                    'DmDRA1': {},
-                    'DmDRA2': {}},
-                'lamina intrinsic': {
-                    'Lai': {}},
-                'lamina monopolar': {
-                    'L1': {},
-                    'L2': {},
-                    'L3': {},
-                    'L4': {},
-                    'L5': {}},
-                'lamina tangential': {
-                    'Lat': {}},
-                'lamina wide field': {
-                    'Lawf1': {},
-                    'Lawf2': {}},
-                'lobula intrinsic': {
-                    'Li01': {},
-                    'Li02': {},
-                    'Li03': {},
-                    'Li04': {},
-                    'Li05': {},
-                    'Li06': {},
-                    'Li07': {},
-                    'Li08': {},
-                    'Li09': {},
-                    'Li10': {},
-                    'Li11': {},
-                    'Li12': {},
-                    'Li13': {},
-                    'Li14': {},
-                    'Li15': {},
-                    'Li16': {},
-                    'Li17': {},
-                    'Li18': {},
-                    'Li19': {},
-                    'Li20': {},
-                    'Li21': {},
-                    'Li22': {},
-                    'Li23': {},
-                    'Li24': {},
-                    'Li25': {},
-                    'Li26': {},
-                    'Li27': {},
-                    'Li28': {},
-                    'Li29': {},
-                    'Li30': {},
-                    'Li31': {},
-                    'Li32': {},
-                    'Li33': {}},
-                'lobula lobula plate tangential': {
-                    'LLPt': {}},
-                'lobula medulla amacrine': {
-                    'CT1': {},
-                    'LMa1': {},
-                    'LMa2': {},
-                    'LMa3': {},
-                    'LMa4': {},
-                    'LMa5': {}},
-                'lobula medulla tangential': {
-                    'LMt1': {},
-                    'LMt2': {},
-                    'LMt3': {},
-                    'LMt4': {}},
-                'lobula plate intrinsic': {
-                    'LPi01': {},
-                    'LPi02': {},
-                    'LPi03': {},
-                    'LPi04': {},
-                    'LPi05': {},
-                    'LPi06': {},
-                    'LPi07': {},
-                    'LPi08': {},
-                    'LPi09': {},
-                    'LPi10': {},
-                    'LPi11': {},
-                    'LPi12': {},
-                    'LPi13': {},
-                    'LPi14': {},
-                    'LPi15': {}},
-                'medulla intrinsic': {
-                    'Mi1': {},
-                    'Mi2': {},
-                    'Mi4': {},
-                    'Mi9': {},
-                    'Mi10': {},
-                    'Mi13': {},
-                    'Mi14': {},
-                    'Mi15': {}},
-                'medulla lobula lobula plate amacrine': {
-                    'Am1': {}},
-                'medulla lobula tangential': {
-                    'MLt1': {},
-                    'MLt2': {},
-                    'MLt3': {},
-                    'MLt4': {},
-                    'MLt5': {},
-                    'MLt6': {},
-                    'MLt7': {},
-                    'MLt8': {}},
-                'proximal distal medulla tangential': {
-                    'PDt': {}},
-                'proximal medulla': {
-                    'Pm01': {},
-                    'Pm02': {},
-                    'Pm03': {},
-                    'Pm04': {},
-                    'Pm05': {},
-                    'Pm06': {},
-                    'Pm07': {},
-                    'Pm08': {},
-                    'Pm09': {},
-                    'Pm10': {},
-                    'Pm11': {},
-                    'Pm12': {},
-                    'Pm13': {},
-                    'Pm14': {}},
-                'serpentine medulla': {
-                    'Sm01': {},
-                    'Sm02': {},
-                    'Sm03': {},
-                    'Sm04': {},
-                    'Sm05': {},
-                    'Sm06': {},
-                    'Sm07': {},
-                    'Sm08': {},
-                    'Sm09': {},
-                    'Sm10': {},
-                    'Sm11': {},
-                    'Sm12': {},
-                    'Sm13': {},
-                    'Sm14': {},
-                    'Sm15': {},
-                    'Sm16': {},
-                    'Sm17': {},
-                    'Sm18': {},
-                    'Sm19': {},
-                    'Sm20': {},
-                    'Sm21': {},
-                    'Sm22': {},
-                    'Sm23': {},
-                    'Sm24': {},
-                    'Sm25': {},
-                    'Sm26': {},
-                    'Sm27': {},
-                    'Sm28': {},
-                    'Sm29': {},
-                    'Sm30': {},
-                    'Sm31': {},
-                    'Sm32': {},
-                    'Sm33': {},
-                    'Sm34': {},
-                    'Sm35': {},
-                    'Sm36': {},
-                    'Sm37': {},
-                    'Sm38': {},
-                    'Sm39': {},
-                    'Sm40': {},
-                    'Sm41': {},
-                    'Sm42': {},
-                    'Sm43': {}},
-                'T1 neuron': {
-                    'T1': {},
-                },
-                'T2 neuron': {
-                    'T2': {},
-                    'T2a': {}},
-                'T3 neuron': {
-                    'T3': {}},
-                'T4 neuron': {
-                    'T4a': {},
-                    'T4b': {},
-                    'T4c': {},
-                    'T4d': {}},
-                'T5 neuron': {
-                    'T5a': {},
-                    'T5b': {},
-                    'T5c': {},
-                    'T5d': {}},
-                'translobula plate': {
-                    'Tlp1': {},
-                    'Tlp4': {},
-                    'Tlp5': {},
-                    'Tlp14': {}},
-                'transmedullary': {
-                    'Tm1': {},
-                    'Tm2': {},
-                    'Tm3': {},
-                    'Tm4': {},
-                    'Tm5a': {},
-                    'Tm5b': {},
-                    'Tm5c': {},
-                    'Tm5d': {},
-                    'Tm5e': {},
-                    'Tm5f': {},
-                    'Tm7': {},
-                    'Tm8a': {},
-                    'Tm8b': {},
-                    'Tm9': {},
-                    'Tm16': {},
-                    'Tm20': {},
-                    'Tm21': {},
-                    'Tm25': {},
-                    'Tm27': {},
-                    'Tm31': {},
-                    'Tm32': {},
-                    'Tm33': {},
-                    'Tm34': {},
-                    'Tm35': {},
-                    'Tm36': {},
-                    'Tm37': {}},
-                'transmedullary Y': {
-                    'TmY3': {},
-                    'TmY4': {},
-                    'TmY5a': {},
-                    'TmY9q': {},
-                    'TmY9q__perp': {},
-                    'TmY10': {},
-                    'TmY11': {},
-                    'TmY14': {},
-                    'TmY15': {},
-                    'TmY16': {},
-                    'TmY20': {},
-                    'TmY31': {}},
-                'Y neuron': {
-                    'Y1': {},
-                    'Y3': {},
-                    'Y4': {},
-                    'Y11': {},
-                    'Y12': {}}},
-            'visual projection': {
-                'lobula columnar': {
-                    'LC4': {},
-                    'LC6': {},
-                    'LC9': {},
-                    'LC10a': {},
-                    'LC10b': {},
-                    'LC10c': {},
-                    'LC10d': {},
-                    'LC10e': {},
-                    'LC10f': {},
-                    'LC11': {},
-                    'LC12': {},
-                    'LC13': {},
-                    'LC15': {},
-                    'LC16': {},
-                    'LC17': {},
-                    'LC18': {},
-                    'LC19': {},
-                    'LC20a': {},
-                    'LC20b': {},
-                    'LC21': {},
-                    'LC22': {},
-                    'LC24': {},
-                    'LC25': {},
-                    'LC26': {},
-                    'LC27': {},
-                    'LC28a': {},
-                    'LC29': {},
-                    'LC31a': {},
-                    'LC31b': {},
-                    'LC31c': {},
-                    'LC33a': {},
-                    'LC34': {},
-                    'LC35': {},
-                    'LC36': {},
-                    'LC37a': {},
-                    'LC39': {},
-                    'LC40': {},
-                    'LC41': {},
-                    'LC43': {},
-                    'LC44': {},
-                    'LC45': {},
-                    'LC46': {},
-
-                    'LCe01': {},
-                    'LCe01a': {},
-                    'LCe01b': {},
-                    'LCe02': {},
-                    'LCe03': {},
-                    'LCe04': {},
-                    'LCe05': {},
-                    'LCe06': {},
-                    'LCe07': {},
-                    'LCe08': {},
-                    'LCe09': {}},
-                'lobula tangential': {
-                    'LT1a': {},
-                    'LT1b': {},
-                    'LT1c': {},
-                    'LT1d': {},
-                    'LT11': {},
-                    'LT43': {},
-                    'LT47': {},
-                    'LT51': {},
-                    'LT52': {},
-                    'LT53': {},
-                    'LT55': {},
-                    'LT57': {},
-                    'LT59': {},
-                    'LT60': {},
-                    'LT61a': {},
-                    'LT61b': {},
-                    'LT62': {},
-                    'LT63': {},
-                    'LT64': {},
-                    'LT65': {},
-                    'LT66': {},
-                    'LT67': {},
-                    'LT68': {},
-                    'LT69': {},
-                    'LT72': {},
-                    'LT73': {},
-                    'LT74': {},
-                    'LT75': {},
-                    'LT76': {},
-                    'LT77': {},
-                    'LT78': {},
-                    'LT79': {},
-                    'LT80': {},
-                    'LT81': {},
-                    'LT82a': {},
-                    'LT83': {},
-                    'LT84': {},
-                    'LT85': {},
-                    'LT86': {},
-                    'LT87': {},
-
-                    'LTe01': {},
-                    'LTe02': {},
-                    'LTe03': {},
-                    'LTe04': {},
-                    'LTe05': {},
-                    'LTe06': {},
-                    'LTe07': {},
-                    'LTe08': {},
-                    'LTe09': {},
-                    'LTe10': {},
-                    'LTe11': {},
-                    'LTe12': {},
-                    'LTe13': {},
-                    'LTe14': {},
-                    'LTe15': {},
-                    'LTe16': {},
-                    'LTe17': {},
-                    'LTe18': {},
-                    'LTe19': {},
-                    'LTe20': {},
-                    'LTe21': {},
-                    'LTe22': {},
-                    'LTe23': {},
-                    'LTe24': {},
-                    'LTe25': {},
-                    'LTe26': {},
-                    'LTe27': {},
-                    'LTe28': {},
-                    'LTe29': {},
-                    'LTe30': {},
-                    'LTe31': {},
-                    'LTe32': {},
-                    'LTe33': {},
-                    'LTe35': {},
-                    'LTe36': {},
-                    'LTe37': {},
-                    'LTe38a': {},
-                    'LTe38b': {},
-                    'LTe38c': {},
-                    'LTe40': {},
-                    'LTe41': {},
-                    'LTe42a': {},
-                    'LTe42b': {},
-                    'LTe42c': {},
-                    'LTe43': {},
-                    'LTe44': {},
-                    'LTe45': {},
-                    'LTe46': {},
-                    'LTe47': {},
-                    'LTe48': {},
-                    'LTe49a': {},
-                    'LTe49b': {},
-                    'LTe49c': {},
-                    'LTe49d': {},
-                    'LTe49e': {},
-                    'LTe49f': {},
-                    'LTe50': {},
-                    'LTe51': {},
-                    'LTe52a': {},
-                    'LTe52b': {},
-                    'LTe53': {},
-                    'LTe54': {},
-                    'LTe55': {},
-                    'LTe56': {},
-                    'LTe57': {},
-                    'LTe58': {},
-                    'LTe59': {},
-                    'LTe60': {},
-                    'LTe61': {},
-                    'LTe62': {},
-                    'LTe63': {},
-                    'LTe64': {},
-                    'LTe65': {},
-                    'LTe66': {},
-                    'LTe67': {},
-                    'LTe68': {},
-                    'LTe69': {},
-                    'LTe70': {},
-                    'LTe72': {},
-                    'LTe73': {},
-                    'LTe74': {},
-                    'LTe75': {},
-                    'LTe76': {}},
-                'lobula plate columnar': {
-                    'LPC1': {},
-                    'LPC2': {}},
-                'lobula plate lobula columnar': {
-                    'LPLC1': {},
-                    'LPLC2': {},
-                    'LPLC4': {}},
-                'lobula lobula plate columnar': {
-                    'LLPC1': {},
-                    'LLPC2': {},
-                    'LLPC3': {},
-                    'LLPC4': {}},
-                'lobula plate tangential': {
-                    'LPT04_HST': {},
-                    'LPT21': {},
-                    'LPT22': {},
-                    'LPT23': {},
-                    'LPT26': {},
-                    'LPT27': {},
-                    'LPT28': {},
-                    'LPT29': {},
-                    'LPT30': {},
-                    'LPT31': {},
-                    'LPT42_Nod4': {},
-                    'LPT47_vCal2': {},
-                    'LPT48_vCal3': {},
-                    'LPT49': {},
-                    'LPT50': {},
-                    'LPT51': {},
-                    'LPT52': {},
-                    'LPT54': {},
-                    'LPTe01': {},
-                    'LPTe02': {},
-                    'Nod1': {},
-                    'Nod2': {},
-                    'Nod3': {},
-                    'Nod5': {},
-                    'H2': {}},
-                'medulla medulla': {
-                    'MeMe_e02': {},
-                    'MeMe_e03': {},
-                    'MeMe_e04': {},
-                    'MeMe_e05': {},
-                    'MeMe_e06': {},
-                    'MeMe_e07': {},
-                    'MeMe_e08': {}},
-                'medulla tubercle': {
-                    'MeTu1': {},
-                    'MeTu2a': {},
-                    'MeTu2b': {},
-                    'MeTu3c': {},
-                    'MeTu3a': {},
-                    'MeTu3b': {},
-                    'MeTu4a': {},
-                    'MeTu4b': {},
-                    'MeTu4c': {},
-                    'MeTu4d': {},
-                    'MeTu4_unknown': {}},
-                'medulla lobula plate': {
-                    'MeLp1': {}},
-                'amacrine medulla': {
-                    'aMe1': {},
-                    'aMe3': {},
-                    'aMe5': {},
-                    'aMe6a': {},
-                    'aMe8': {},
-                    'aMe9': {},
-                    'aMe10': {},
-                    'aMe12': {},
-                    'aMe19a': {},
-                    'aMe19b': {},
-                    'aMe20': {},
-                    'aMe25': {},
-                    'aMe26': {}},
-                'vertical system': {
-                    'VSm': {},
-                    'VS1': {},
-                    'VS2': {},
-                    'VS3': {},
-                    'VS4': {},
-                    'VS5': {},
-                    'VS6': {},
-                    'VS7': {},
-                    'VS8': {},
-                    'VST1': {},
-                    'VST2': {}},
-                'medulla tangential': {
-                    'MTe01a': {},
-                    'MTe01b': {},
-                    'MTe02': {},
-                    'MTe03': {},
-                    'MTe04': {},
-                    'MTe05': {},
-                    'MTe06': {},
-                    'MTe07': {},
-                    'MTe08': {},
-                    'MTe09': {},
-                    'MTe10': {},
-                    'MTe11': {},
-                    'MTe12': {},
-                    'MTe13': {},
-                    'MTe14': {},
-                    'MTe15': {},
-                    'MTe16': {},
-                    'MTe17': {},
-                    'MTe18': {},
-                    'MTe19': {},
-                    'MTe20': {},
-                    'MTe21': {},
-                    'MTe22': {},
-                    'MTe23': {},
-                    'MTe24': {},
-                    'MTe25': {},
-                    'MTe26': {},
-                    'MTe27': {},
-                    'MTe28': {},
-                    'MTe29': {},
-                    'MTe30': {},
-                    'MTe31': {},
-                    'MTe32': {},
-                    'MTe33': {},
-                    'MTe34': {},
-                    'MTe35': {},
-                    'MTe36': {},
-                    'MTe37': {},
-                    'MTe38': {},
-                    'MTe39': {},
-                    'MTe40': {},
-                    'MTe41': {},
-                    'MTe42': {},
-                    'MTe43': {},
-                    'MTe44': {},
-                    'MTe45': {},
-                    'MTe46': {},
-                    'MTe47': {},
-                    'MTe48': {},
-                    'MTe49': {},
-                    'MTe50': {},
-                    'MTe51': {},
-                    'MTe52': {},
-                    'MTe53': {},
-                    'MTe54': {},
-                    'MC65': {}},
-                'horizontal system': {
-                    'HSE': {},
-                    'HSN': {},
-                    'HSS': {}}},
-            'visual centrifugal': {
-                'lobula tangential': {
-                    'LT34': {},
-                    'LT36': {},
-                    'LT37': {},
-                    'LT38': {},
-                    'LT39': {},
-                    'LT40': {},
-                    'LT41': {},
-                    'LT42': {},
-                    'LT56': {},
-                    'LT70': {}},
-                'lobula plate tangential': {
-                    'LPT53': {},
-                    'LPT57': {},
-                    'LPT58': {}},
-                'amacrine medulla': {
-                    'aMe4': {},
-                    'aMe17a1': {},
-                    'aMe17a2': {},
-                    'aMe17b': {},
-                    'aMe17c': {}},
-                'medial antennal lobula': {
-                    'mALC3': {},
-                    'mALC4': {},
-                    'mALC5': {}},
-                'centrifugal medulla': {
-                    'cM01a': {},
-                    'cM01b': {},
-                    'cM01c': {},
-                    'cM02a': {},
-                    'cM02b': {},
-                    'cM03': {},
-                    'cM04': {},
-                    'cM05': {},
-                    'cM06': {},
-                    'cM07': {},
-                    'cM08a': {},
-                    'cM08b': {},
-                    'cM08c': {},
-                    'cM09': {},
-                    'cM10': {},
-                    'cM11': {},
-                    'cM12': {},
-                    'cM13': {},
-                    'cM14': {},
-                    'cM15': {},
-                    'cM16': {},
-                    'cM17': {},
-                    'cM18': {},
-                    'cM19': {}},
-                'centrifugal medulla lobula': {
-                    'cML01': {},
-                    'cML02': {}},
-                'centrifugal medulla lobula lobula plate': {
-                    'cMLLP01': {},
-                    'cMLLP02': {}},
-                'centrifugal lobula': {
-                    'cL01': {},
-                    'cL02a': {},
-                    'cL02b': {},
-                    'cL02c': {},
-                    'cL02d': {},
-                    'cL03': {},
-                    'cL04': {},
-                    'cL05': {},
-                    'cL06': {},
-                    'cL07': {},
-                    'cL08': {},
-                    'cL09': {},
-                    'cL10': {},
-                    'cL11': {},
-                    'cL12': {},
-                    'cL13': {},
-                    'cL14': {},
-                    'cL15': {},
-                    'cL16': {},
-                    'cL17': {},
-                    'cL18': {},
-                    'cL19': {},
-                    'cL20': {},
-                    'cL21': {},
-                    'cL22a': {},
-                    'cL22b': {},
-                    'cL22c': {}},
-                'centrifugal lobula medulla': {
-                    'cLM01': {}},
-                'centrifugal lobula plate': {
-                    'cLP01': {},
-                    'cLP02': {},
-                    'cLP03': {},
-                    'cLP04': {},
-                    'cLP05': {},
-                    'cLPL01': {}},
-                'centrifugal lobula lobula plate': {
-                    'cLLP02': {}},
-                'centrifugal lobula lobula plate medulla': {
-                    'cLLPM01': {},
-                    'cLLPM02': {}},
-                'ventral centrifugal': {
-                    'VCH': {}},
-                'optic anterior': {
-                    'OA-AL2b1': {},
-                    'OA-AL2b2': {},
-                    'OA-AL2i1': {},
-                    'OA-AL2i2': {},
-                    'OA-AL2i3': {},
-                    'OA-AL2i4': {},
-                    'OA-ASM1': {}}},
-            'central brain intrinsic': {
-                'kenyon cell': {}},
-            'VNC intrinsic': {}},
-        'efferent neuron': {
-            'motor neuron': {},
-            'UM neuron': {},
-            'endocrine neuron': {}},
-        'glia': {
-            'trachea': {},
-            'astrocyte': {},
-            'cortex glia': {},
-            'neuropil ensheathing glia': {},
-            'nervous system ensheathing glia': {
-                'perineural glia': {},
-                'subperineural glia': {}}}},
-    'hemilineage': {
-        'primary': {},
-        'putative primary': {},
-        'ALad1': {},
-        'ALad1__prim': {},
-        'ALl1_dorsal': {},
-        'ALl1_ventral': {},
-        'ALlv1': {},
-        'ALv1': {},
-        'ALv2': {},
-        'AOTUv1_medial': {},
-        'AOTUv1_ventral': {},
-        'AOTUv2': {},
-        'AOTUv3_dorsal': {},
-        'AOTUv3_ventral': {},
-        'AOTUv4_dorsal': {},
-        'AOTUv4_ventral': {},
-        'CLp1': {},
-        'CLp1_or_SLPpm2': {},
-        'CLp2': {},
-        'CREa1_dorsal': {},
-        'CREa1_ventral': {},
-        'CREa2_medial': {},
-        'CREa2_ventral': {},
-        'CREl1': {},
-        'DILP__prim': {},
-        'DL1_dorsal': {},
-        'DL1_ventral': {},
-        'DL2_dorsal': {},
-        'DL2_ventral': {},
-        'DM1_CX_d2': {},
-        'DM1_CX_p': {},
-        'DM1_CX_v': {},
-        'DM1_antero_dorsal': {},
-        'DM1_antero_ventral': {},
-        'DM1_dorsal': {},
-        'DM1_posterior': {},
-        'DM2_CX_d1': {},
-        'DM2_CX_d2': {},
-        'DM2_CX_p': {},
-        'DM2_CX_v': {},
-        'DM2_central': {},
-        'DM2_or_DM3_posterior': {},
-        'DM3_CX_d1': {},
-        'DM3_CX_d2': {},
-        'DM3_CX_p': {},
-        'DM3_CX_v': {},
-        'DM3__prim': {},
-        'DM3_dorso_lateral': {},
-        'DM3_dorso_medial': {},
-        'DM4_CX_d1': {},
-        'DM4_CX_d2': {},
-        'DM4_CX_d3': {},
-        'DM4_CX_p': {},
-        'DM4_CX_v': {},
-        'DM4__prim': {},
-        'DM4_dorsal': {},
-        'DM4_ventral': {},
-        'DM5_central': {},
-        'DM5_ventral': {},
-        'DM6_IbSpsP': {},
-        'DM6__prim': {},
-        'DM6_central1': {},
-        'DM6_central2': {},
-        'DM6_dorso_lateral': {},
-        'DM6_dorso_medial': {},
-        'DM6_posterior': {},
-        'DM6_ventral': {},
-        'EBa1': {},
-        'FLAa1': {},
-        'FLAa2': {},
-        'FLAa3': {},
-        'LALa1': {},
-        'LALa1_anterior': {},
-        'LALa1_posterior': {},
-        'LALv1_dorsal': {},
-        'LALv1_ventral': {},
-        'LB0_anterior': {},
-        'LB0_posterior': {},
-        'LB11': {},
-        'LB12': {},
-        'LB12__prim': {},
-        'LB19': {},
-        'LB23': {},
-        'LB3': {},
-        'LB3__prim': {},
-        'LB5': {},
-        'LB6': {},
-        'LB6__prim': {},
-        'LB7': {},
-        'LB7__prim': {},
-        'LHa1': {},
-        'LHa2': {},
-        'LHa3': {},
-        'LHd1': {},
-        'LHd2': {},
-        'LHl1': {},
-        'LHl2_dorsal': {},
-        'LHl2_ventral': {},
-        'LHl3': {},
-        'LHl4_dorsal': {},
-        'LHl4_posterior': {},
-        'LHp1': {},
-        'LHp2': {},
-        'LHp3': {},
-        'MBp1': {},
-        'MBp2': {},
-        'MBp3': {},
-        'MBp4': {},
-        'MD0__prim': {},
-        'MD3': {},
-        'MD_SA1': {},
-        'MD_SA1__prim': {},
-        'MX0__prim': {},
-        'MX12': {},
-        'MX12__prim': {},
-        'MX3': {},
-        'MX5': {},
-        'MX7': {},
-        'MX7__prim': {},
-        'PBp1': {},
-        'PDM34': {},
-        'PSa1': {},
-        'PSp1': {},
-        'PSp2': {},
-        'PSp3': {},
-        'PVM15': {},
-        'SIPa1_dorsal': {},
-        'SIPa1_ventral': {},
-        'SIPp1': {},
-        'SLPa&l1_anterior': {},
-        'SLPa&l1_lateral': {},
-        'SLPad1_anterior': {},
-        'SLPad1_posterior': {},
-        'SLPal1': {},
-        'SLPal2': {},
-        'SLPal3_and_SLPal4_dorsal': {},
-        'SLPal5': {},
-        'SLPav1_lateral': {},
-        'SLPav1_medial': {},
-        'SLPav2': {},
-        'SLPav3': {},
-        'SLPp&v1_posterior': {},
-        'SLPp&v1_ventral': {},
-        'SLPpl1': {},
-        'SLPpl2': {},
-        'SLPpl3': {},
-        'SLPpm1': {},
-        'SLPpm2': {},
-        'SLPpm3': {},
-        'SLPpm4': {},
-        'SMPad1': {},
-        'SMPad2': {},
-        'SMPad3': {},
-        'SMPp&v1_posterior': {},
-        'SMPp&v1_ventral': {},
-        'SMPpd1': {},
-        'SMPpd2': {},
-        'SMPpm1': {},
-        'SMPpv1': {},
-        'SMPpv2_dorsal': {},
-        'SMPpv2_ventral': {},
-        'TRdl_a': {},
-        'TRdl_a__prim': {},
-        'TRdl_b': {},
-        'TRdl_b__prim': {},
-        'TRdm': {},
-        'VESa1': {},
-        'VESa2': {},
-        'VLPa1_lateral': {},
-        'VLPa1_medial': {},
-        'VLPa2': {},
-        'VLPd&p1_dorsal': {},
-        'VLPd&p1_posterior': {},
-        'VLPd1': {},
-        'VLPl&d1_dorsal': {},
-        'VLPl&d1_lateral': {},
-        'VLPl&p1_lateral': {},
-        'VLPl&p1_posterior': {},
-        'VLPl&p2_lateral': {},
-        'VLPl&p2_posterior': {},
-        'VLPl1_or_VLPl5': {},
-        'VLPl2_lateral': {},
-        'VLPl2_medial': {},
-        'VLPl2_posterior': {},
-        'VLPl4_anterior': {},
-        'VLPl4_dorsal': {},
-        'VLPp&l1__prim': {},
-        'VLPp&l1_anterior': {},
-        'VLPp&l1_lateral': {},
-        'VLPp&l1_posterior': {},
-        'VLPp1': {},
-        'VLPp2': {},
-        'VPNd1': {},
-        'VPNd2': {},
-        'VPNd3': {},
-        'VPNl&d1_dorsal': {},
-        'VPNl&d1_lateral': {},
-        'VPNl&d1_medial': {},
-        'VPNl&d1_medial_Lee': {},
-        'VPNp&v1_posterior': {},
-        'VPNp&v1_ventral': {},
-        'VPNp1_lateral': {},
-        'VPNp1_medial': {},
-        'VPNp2': {},
-        'VPNp3': {},
-        'VPNv1': {},
-        'VPNv2': {},
-        'WEDa1': {},
-        'WEDa2': {},
-        'WEDd1': {},
-        'WEDd2': {},
-        '0A': {},
-        '0B': {},
-        '1A': {},
-        '1B': {},
-        '2A': {},
-        '3A': {},
-        '3B': {},
-        '4A': {},
-        '4B': {},
-        '5B': {},
-        '6A': {},
-        '6B': {},
-        '7B': {},
-        '8A': {},
-        '8B': {},
-        '9A': {},
-        '9B': {},
-        '10B': {},
-        '11A': {},
-        '11B': {},
-        '12A': {},
-        '12B': {},
-        '13A': {},
-        '13B': {},
-        '14A': {},
-        '14B': {},
-        '15B': {},
-        '16B': {},
-        '17A': {},
-        '17B': {},
-        '17X': {},
-        '18B': {},
-        '18X': {},
-        '19A': {},
-        '19B': {},
-        '20A.22A': {},
-        '20B.21B.22B': {},
-        '21A': {},
-        '21X': {},
-        '23B': {},
-        '24A': {},
-        '24B.25B': {},
-        '26X': {},
-        '27X': {}},
-    'fast neurotransmitter': {
-        'cholinergic': {},
-        'GABAergic': {},
-        'glutamatergic': {}},
-    'other neurotransmitter': {
-        'dopaminergic': {},
-        'histaminergic': {},
-        'octopaminergic': {},
-        'serotonergic': {},
-        'tyraminergic': {}},
-    'soma side': {
-        'soma on left': {},
-        'soma on right': {},
-        'soma on midline': {}},
-    'soma region': {
-        'soma in brain': {
-            'soma in central brain': {},
-            'soma in optic lobe': {}},
-        'soma in neck connective': {},
-        'soma in VNC': {
-            'soma in T1': {},
-            'soma in T2': {},
-            'soma in T3': {},
-            'soma in abdominal ganglion': {
-                'soma in A1': {},
-                'soma in A2': {},
-                'soma in A3': {},
-                'soma in A4': {},
-                'soma in A5': {},
-                'soma in A6': {},
-                'soma in A7': {},
-                'soma in A8': {},
-                'soma in A9': {},
-                'soma in A10': {}}}},
-    'anterior-posterior projection pattern': {
-        'descending': {},
-        'ascending': {}},
-    'leg neuromere projection pattern': {
-        'leg local': {
-            'T1 leg local': {},
-            'T2 leg local': {},
-            'T3 leg local': {}},
-        'leg intersegmental': {
-            'T1+T2 leg intersegmental': {
-                'T1-to-T2 leg intersegmental': {},
-                'T2-to-T1 leg intersegmental': {}},
-            'T1+T3 leg intersegmental': {
-                'T1-to-T3 leg intersegmental': {},
-                'T3-to-T1 leg intersegmental': {}},
-            'T2+T3 leg intersegmental': {
-                'T2-to-T3 leg intersegmental': {},
-                'T3-to-T2 leg intersegmental': {}},
-            'T1+T2+T3 leg intersegmental': {}}},
-    'tectulum projection pattern': {
-        'tectulum local': {
-            'neck tectulum local': {},
-            'wing tectulum local': {},
-            'haltere tectulum local': {}},
-        'tectulum intersegmental': {
-            'neck+wing tectulum intersegmental': {
-                'neck-to-wing tectulum intersegmental': {},
-                'wing-to-neck tectulum intersegmental': {}},
-            'neck+haltere tectulum intersegmental': {
-                'neck-to-haltere tectulum intersegmental': {},
-                'haltere-to-neck tectulum intersegmental': {}},
-            'wing+haltere tectulum intersegmental': {
-                'wing-to-haltere tectulum intersegmental': {},
-                'haltere-to-wing tectulum intersegmental': {}},
-            'neck+wing+haltere tectulum intersegmental': {}}},
-    'left-right projection pattern': {
-        'unilateral': {},
-        'bilateral': {},
-        'midplane': {}},
-    'body part innervated': {
-        'innervates antenna': {
-            'innervates scape': {},
-            'innervates pedicel': {},
-            'innervates funiculus': {
-                'innervates sacculus': {}},
-            'innervates arista': {}},
-        'innervates maxillary palp': {},
-        'innervates proboscis': {},
-        'innervates retina': {},
-        'innervates ocelli': {},
-        'innervates neck': {},
-        'innervates corpus cardiacum': {},
-        'innervates corpus allatum': {},
-        'innervates aorta': {},
-        'innervates leg': {
-            'innervates T1 leg': leg_parts,
-            'innervates T2 leg': leg_parts,
-            'innervates T3 leg': leg_parts},
-        'innervates notum': {
-            'innervates scutum': {},
-            'innervates scutellum': {}},
-        'innervates wing': {
-            'innervates tegula': {},
-            'innervates radius': {}},
-        'innervates haltere': {},
-        'innervates spiracle': {},
-        'innervates abdomen': {}},
-    'body side innervated': {
-        'innervates left side of body': {},
-        'innervates right side of body': {},
-        'innervates both sides of body': {}},
-    'muscle innervated': {
-        'innervates tergopleural promotor': {},
-        'innervates pleural promotor': {},
-        'innervates pleural remotor and abductor': {},
-        'innervates sternal anterior rotator': {},
-        'innervates sternal posterior rotator': {},
-        'innervates sternal adductor': {},
-        'innervates tergotrochanter extensor': {},
-        'innervates sternotrochanter extensor': {},
-        'innervates trochanter extensor': {},
-        'innervates trochanter flexor': {},
-        'innervates accessory trochanter flexor': {},
-        'innervates femur reductor': {},
-        'innervates tibia extensor': {},
-        'innervates tibia flexor': {},
-        'innervates accessory tibia flexor': {},
-        'innervates tarsus depressor': {},
-        'innervates tarsus retro depressor': {},
-        'innervates tarsus levator': {},
-        'innervates long tendon muscle': {
-            'innervates long tendon muscle 2': {},
-            'innervates long tendon muscle 1': {}},
-        'innervates indirect flight muscle': {
-            'innervates dorsal longitudinal muscle': {},
-            'innervates dorsoventral muscle': {}},
-        'innervates wing steering muscle': {},
-        'innervates wing tension muscle': {}},
-    'motor neuron primary neurite bundle': {
-        'L1 bundle': {},
-        'L2 bundle': {},
-        'L3 bundle': {},
-        'L4 bundle': {},
-        'L5 bundle': {},
-        'A1 bundle': {},
-        'A2 bundle': {},
-        'A3 bundle': {},
-        'A4 bundle': {},
-        'A5 bundle': {},
-        'V1 bundle': {},
-        'V2 bundle': {},
-        'V3 bundle': {},
-        'V4 bundle': {},
-        'V5 bundle': {},
-        'V6 bundle': {},
-        'D1 bundle': {},
-        'D2 bundle': {},
-        'L6 bundle': {},
-        'L7 bundle': {},
-        'L8 bundle': {},
-        'L9 bundle': {},
-        'L10 bundle': {},
-        'L11 bundle': {},
-        'L12 bundle': {},
-        'L13 bundle': {},
-        'A6 bundle': {},
-        'A7 bundle': {},
-        'PDMN bundle': {},
-        'A11 bundle': {},
-        'A12 bundle': {},
-        'L14 bundle': {},
-        'L15 bundle': {},
-        'L16 bundle': {},
-        'L18 bundle': {},
-        'tbd bundle': {},
-        'C1 bundle': {},
-        'D bundle': {},
-        'A8 bundle': {},
-        'A9 bundle': {},
-        'A10 bundle': {},
-        'ADMN1 bundle': {},
-        'ADMN2 bundle': {},
-        'ADMN3 bundle': {},
-        'PDMN1 bundle': {},
-        'PDMN2 bundle': {},
-        'HN bundle': {},
-        'T3 H1 bundle': {},
-        'T3 H2 bundle': {},
-        'T3 H3 bundle': {}},
-    'neuron identity': {},
-    'freeform': {},
-}
-FANC_cell_info = cell_info.copy()
-FANC_cell_info['publication'] = {
-    'Azevedo Lesser Phelps Mark et al. 2024': {},
-    'Lesser Azevedo et al. 2024': {},
-    'Cheong Boone Bennett et al. 2023': {},
-    'Sapkal et al. 2023': {},
-    'Yang et al. 2023': {},
-    'Dallmann et al. 2023': {},
-    'Yoshikawa et al. 2024': {},
-    'Lee et al. 2024': {},
-    'Stürner Brooks ... Eichler 2024': {},
-    'Syed et al. 2024': {},
-    'Guo et al. 2024': {},
-    'Dhawan et al. 2025': {},
-    'Lesser et al. 2025': {},
-    'Cachero ... Jefferis Donà 2025': {},
-}
-
-proofreading_notes = [
-    'spans neck',
-    'soma is damaged',
-    'arbor is damaged',
-    'thoroughly proofread',
-    'merge monster',
+# Annotation classes that a segment may have more than one subannotation of
+# (see rule 1 in is_allowed_to_post)
+multiple_subclasses_allowed = [
+    'other neurotransmitter',
+    'neuron identity',
+    'freeform',
+    'publication'
 ]
 
 # A mapping that tells which CAVE tables are governed by which
-# annotation lists/hierarchies
-rules_governing_tables = {
-    'neuron_information': FANC_cell_info,
-    'cell_info': cell_info,
-    'proofreading_notes': proofreading_notes,
+# annotation lists/hierarchies (by their names in the vocabularies file)
+_table_vocabularies = {
+    'neuron_information': 'FANC_cell_info',
+    'cell_info': 'cell_info',
+    'proofreading_notes': 'proofreading_notes',
 }
 
+# The annotation lists/hierarchies are stored in a data file and only loaded
+# the first time they're needed, which keeps `import banc` fast
+_vocabularies_path = os.path.join(os.path.dirname(__file__),
+                                  'annotation_vocabularies.json')
+_compiled_cache_dir = os.path.join(os.path.dirname(__file__), '__pycache__')
+# Increment this if AnnotationRules changes, to invalidate compiled caches
+_compiled_format_version = 2
+_lazy_attributes = ['leg_parts', 'cell_info', 'FANC_cell_info',
+                    'proofreading_notes', 'rules_governing_tables']
+
 
 # ------------------------- #
 
@@ -1243,22 +62,387 @@ rules_governing_tables = {
 def _dict_to_anytree(dictionary):
     """
     Given a dictionary containing a hierarchy of strings, return a dictionary
-    with each string as a key and the corresponding anytree.Node as the value.
+    with each string as a key and a list of the corresponding anytree.Nodes
+    (one per place the string appears in the hierarchy) as the value.
     """
-    def _build_tree(annotations: dict, parent: dict = None, nodes: dict = {}):
+    import anytree
+
+    def _build_tree(annotations: dict, parent: anytree.Node, nodes: dict):
         for annotation in annotations.keys():
             node = anytree.Node(annotation, parent=parent)
-            nodes[annotation] = nodes.get(annotation, []) + [node]
-            _build_tree(annotations[annotation], parent=node, nodes=nodes)
+            nodes.setdefault(annotation, []).append(node)
+            _build_tree(annotations[annotation], node, nodes)
         return nodes
 
-    return _build_tree(dictionary)
+    return _build_tree(dictionary, None, {})
+
+
+def _anytree_to_dict(nodes: dict) -> dict:
+    """
+    Inverse of _dict_to_anytree(): given a dictionary mapping annotation names
+    to lists of anytree.Nodes, return the nested dictionary hierarchy.
+    """
+    def _build_dict(node):
+        return {child.name: _build_dict(child) for child in node.children}
+
+    roots = {id(node): node for node_list in nodes.values()
+             for node in node_list if node.is_root}
+    return {root.name: _build_dict(root) for root in roots.values()}
+
+
+class AnnotationRules(object):
+    """
+    An annotation hierarchy compiled into flat lookup tables, so that
+    checking an annotation against the hierarchy takes constant time.
+
+    Attributes
+    ----------
+    hierarchy : dict
+        The nested dictionary the rules were compiled from.
+    term_ids : dict
+        Maps each annotation term to a unique integer ID.
+    parents : dict
+        Maps each term to a tuple with the name of its parent at each place
+        the term appears in the hierarchy (None where it appears as a root).
+    children : dict
+        Maps each term to a frozenset of the names of its children.
+    roots : frozenset
+        Terms that appear exactly once in the hierarchy, at its root (the
+        annotation classes that may be posted without a parent annotation).
+    valid_pairs : frozenset
+        All valid (annotation_class, annotation) pairs.
+    descendants, ancestors : dict
+        The closure of `children` and `parents`: map each term to a frozenset
+        of all terms below/above it anywhere in the hierarchy.
+    """
+    def __init__(self, hierarchy: dict):
+        self.hierarchy = hierarchy
+        self.term_ids = {}
+        parents = {}
+        children = {}
+        stack = [(None, hierarchy)]
+        while stack:
+            parent, subtree = stack.pop()
+            for term, subsubtree in subtree.items():
+                self.term_ids.setdefault(term, len(self.term_ids))
+                parents.setdefault(term, []).append(parent)
+                children.setdefault(term, set()).update(subsubtree.keys())
+                stack.append((term, subsubtree))
+        # The stack visits siblings in reverse, so restore hierarchy order
+        self.parents = {term: tuple(p[::-1]) for term, p in parents.items()}
+        self.children = {term: frozenset(c) for term, c in children.items()}
+        self.roots = frozenset(term for term, p in self.parents.items()
+                               if p == (None,))
+        self.valid_pairs = frozenset((parent, term)
+                                     for term, p in self.parents.items()
+                                     for parent in p if parent is not None)
+
+        # Closure tables, built bottom-up with an explicit stack
+        descendants = {}
+        for term in self.term_ids:
+            stack = [term]
+            while stack:
+                current = stack[-1]
+                pending = [child for child in self.children[current]
+                           if child not in descendants and child not in stack]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                descendants[current] = frozenset().union(
+                    self.children[current],
+                    *(descendants.get(child, ()) for child in self.children[current]))
+        self.descendants = descendants
+        ancestors = {term: set() for term in self.term_ids}
+        for term, below in descendants.items():
+            for descendant in below:
+                ancestors[descendant].add(term)
+        self.ancestors = {term: frozenset(a) for term, a in ancestors.items()}
+        self._tree = None
+
+    @classmethod
+    def from_anytree(cls, nodes: dict):
+        """
+        Compile rules from a dictionary mapping annotation names to lists of
+        anytree.Nodes, as output by _dict_to_anytree().
+        """
+        return cls(_anytree_to_dict(nodes))
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def items(self):
+        return self.parents.items()
 
+    @property
+    def tree(self) -> dict:
+        """
+        The hierarchy as a dictionary mapping annotation names to lists of
+        anytree.Nodes. Built on first access, since it's only needed for
+        printing.
+        """
+        if self._tree is None:
+            self._tree = _dict_to_anytree(self.hierarchy)
+        return self._tree
 
-# Convert any hierarchical dictionaries to a tree format that is easier to use
-rules_governing_tables = {table_name: _dict_to_anytree(annotations)
-                          if isinstance(annotations, dict) else annotations
-                          for table_name, annotations in rules_governing_tables.items()}
+
+def _compile_rules(annotations):
+    """
+    Convert a user-provided hierarchy (a nested dictionary, or a dictionary
+    of anytree.Nodes from _dict_to_anytree()) to AnnotationRules. Lists and
+    already-compiled rules are returned unchanged.
+    """
+    if not isinstance(annotations, dict):
+        return annotations
+    if any(isinstance(value, list) for value in annotations.values()):
+        return AnnotationRules.from_anytree(annotations)
+    return AnnotationRules(annotations)
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """
+    Levenshtein distance between two strings, computed with the bit-parallel
+    algorithm of Myers (1999) as formulated by Hyyrö (2001), which processes
+    a whole column of the dynamic programming table per step.
+    """
+    if not a or not b:
+        return len(a) + len(b)
+    match_masks = {}
+    for i, char in enumerate(a):
+        match_masks[char] = match_masks.get(char, 0) | (1 << i)
+    all_ones = (1 << len(a)) - 1
+    last_bit = 1 << (len(a) - 1)
+    plus_vertical, minus_vertical, distance = all_ones, 0, len(a)
+    for char in b:
+        matches = match_masks.get(char, 0)
+        x_vertical = matches | minus_vertical
+        x_horizontal = (((matches & plus_vertical) + plus_vertical) ^ plus_vertical) | matches
+        plus_horizontal = minus_vertical | (~(x_horizontal | plus_vertical) & all_ones)
+        minus_horizontal = plus_vertical & x_horizontal
+        if plus_horizontal & last_bit:
+            distance += 1
+        elif minus_horizontal & last_bit:
+            distance -= 1
+        plus_horizontal = ((plus_horizontal << 1) | 1) & all_ones
+        minus_horizontal = (minus_horizontal << 1) & all_ones
+        plus_vertical = minus_horizontal | (~(x_vertical | plus_horizontal) & all_ones)
+        minus_vertical = plus_horizontal & x_vertical
+    return distance
+
+
+class _TermIndex(object):
+    """
+    Indexes for quickly finding annotation terms similar to a query: a prefix
+    trie (for completing partially typed terms) and a BK-tree (for finding
+    terms within a small edit distance, e.g. typos). Matching is
+    case-insensitive.
+    """
+    def __init__(self, terms):
+        self.terms = {}  # lowercase -> original terms
+        for term in terms:
+            if isinstance(term, str):
+                self.terms.setdefault(term.lower(), []).append(term)
+
+        # Each trie node is a dict of char -> child node, and the key None
+        # holds the lowercase term ending at that node
+        self.trie = {}
+        for term in self.terms:
+            node = self.trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[None] = term
+
+        # Each BK-tree node is (term, {distance: child node})
+        self.bktree = None
+        for term in self.terms:
+            if self.bktree is None:
+                self.bktree = (term, {})
+                continue
+            node = self.bktree
+            while True:
+                distance = _edit_distance(term, node[0])
+                if distance not in node[1]:
+                    node[1][distance] = (term, {})
+                    break
+                node = node[1][distance]
+
+    def completions(self, prefix: str, limit: int) -> list:
+        """Up to `limit` terms starting with `prefix`, shortest first."""
+        node = self.trie
+        for char in prefix:
+            if char not in node:
+                return []
+            node = node[char]
+        found = []
+        level = [node]
+        while level and len(found) < limit:
+            found.extend(sorted(n[None] for n in level if None in n))
+            level = [child for n in level
+                     for char, child in n.items() if char is not None]
+        return found[:limit]
+
+    def within(self, query: str, max_distance: int) -> list:
+        """All (distance, term) pairs within `max_distance` of `query`."""
+        found = []
+        stack = [self.bktree] if self.bktree is not None else []
+        while stack:
+            term, children = stack.pop()
+            distance = _edit_distance(query, term)
+            if distance <= max_distance:
+                found.append((distance, term))
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return found
+
+
+# To enable lazy building and caching of term indexes for list vocabularies
+_term_indexes = {}
+
+
+def _get_term_index(annotations) -> _TermIndex:
+    if isinstance(annotations, AnnotationRules):
+        if getattr(annotations, '_term_index', None) is None:
+            annotations._term_index = _TermIndex(annotations.term_ids)
+        return annotations._term_index
+    key = tuple(annotations)
+    if key not in _term_indexes:
+        _term_indexes[key] = _TermIndex(annotations)
+    return _term_indexes[key]
+
+
+def suggest(term: str,
+            table_name: str = default_table,
+            max_suggestions: int = 5,
+            max_distance: int = None) -> list:
+    """
+    Suggest recognized annotations that are similar to a given (probably
+    misspelled or incomplete) term, to help users find the annotation they
+    meant.
+
+    Parameters
+    ----------
+    term : str
+        The term to find suggestions for.
+    table_name : str
+        The name of the table whose rules should be used.
+        OR
+        Users will not typically do this, but you can also pass in a list or
+        dict specifying the valid annotations directly and it will be used.
+    max_suggestions : int
+        The maximum number of suggestions to return.
+    max_distance : int or None
+        The maximum edit distance (number of inserted, deleted or changed
+        characters) between `term` and a suggestion. If None (default), allow
+        one edit per 3 characters of `term`, and at least 1.
+
+    Returns
+    -------
+    list of str
+        Suggested annotations, best first: case-insensitive exact matches,
+        then annotations starting with `term`, then annotations within
+        `max_distance` edits of `term` (closest first).
+    """
+    if isinstance(table_name, str):
+        try:
+            annotations = _rules_governing_tables()[table_name]
+        except KeyError:
+            raise ValueError(f'Table name "{table_name}" not recognized.')
+    else:
+        annotations = _compile_rules(table_name)
+    if not isinstance(term, str):
+        return []
+    index = _get_term_index(annotations)
+    query = term.strip().lower()
+    if max_distance is None:
+        max_distance = max(1, len(query) // 3)
+
+    ranked = [query] if query in index.terms else []
+    ranked += [match for match in index.completions(query, max_suggestions + 1)
+               if match != query]
+    ranked += [match for _, match in sorted(index.within(query, max_distance),
+                                            key=lambda x: (x[0], len(x[1]), x[1]))
+               if match not in ranked]
+    suggestions = [original for match in ranked for original in index.terms[match]]
+    return suggestions[:max_suggestions]
+
+
+def _did_you_mean(term, annotations) -> str:
+    """Format suggestions for `term` for use in an error message."""
+    suggestions = [suggestion for suggestion in suggest(term, annotations)
+                   if suggestion != term]
+    if not suggestions:
+        return ''
+    return ' Did you mean ' + ' or '.join(f'"{s}"' for s in suggestions) + '?'
+
+
+def _load_vocabularies():
+    """
+    Load the annotation vocabularies and compile the ones that are
+    hierarchies into AnnotationRules, setting this module's `cell_info`,
+    `FANC_cell_info`, `proofreading_notes`, `leg_parts` and
+    `rules_governing_tables` attributes.
+
+    The compiled form is cached in __pycache__, keyed by a hash of the
+    vocabularies file, so it's only recompiled when the file changes.
+    """
+    with open(_vocabularies_path, 'rb') as f:
+        raw = f.read()
+    key = hashlib.sha256(raw + str(_compiled_format_version).encode()).hexdigest()
+    cache_path = os.path.join(_compiled_cache_dir,
+                              f'annotation_vocabularies.{key[:16]}.pickle')
+    try:
+        with open(cache_path, 'rb') as f:
+            vocabularies, compiled = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        vocabularies = json.loads(raw.decode('utf-8'))
+        vocabularies['FANC_cell_info'] = {
+            **vocabularies['cell_info'],
+            'publication': vocabularies.pop('FANC_publications')
+        }
+        # Only pickle builtin types, so the cache doesn't depend on whether
+        # this module was imported as fanc or banc
+        compiled = {name: vars(AnnotationRules(vocabularies[name]))
+                    for name in set(_table_vocabularies.values())
+                    if isinstance(vocabularies[name], dict)}
+        try:
+            os.makedirs(_compiled_cache_dir, exist_ok=True)
+            with open(cache_path + '.tmp', 'wb') as f:
+                pickle.dump((vocabularies, compiled), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            pass  # The cache is just an optimization
+
+    rules = {}
+    for name, state in compiled.items():
+        rules[name] = AnnotationRules.__new__(AnnotationRules)
+        rules[name].__dict__.update(state)
+    globals().update(vocabularies)
+    globals()['rules_governing_tables'] = {
+        table_name: rules.get(name, vocabularies[name])
+        for table_name, name in _table_vocabularies.items()
+    }
+
+
+def _rules_governing_tables() -> dict:
+    if 'rules_governing_tables' not in globals():
+        _load_vocabularies()
+    return globals()['rules_governing_tables']
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        _load_vocabularies()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
 
 
 def print_recognized_annotations(table_name: str = default_table):
@@ -1272,32 +456,118 @@ def print_recognized_annotations(table_name: str = default_table):
         OR
         Users will not typically do this, but you can also pass in a list or
         dict specifying the valid annotations directly and it will be used. If
-        a dictionary, must map annotation names (str) to anytree.Node objects,
-        as output by running _dict_to_anytree() on a hierarchy of annotations.
+        a dictionary, must be a nested dictionary hierarchy of annotations, or
+        map annotation names (str) to anytree.Node objects, as output by
+        running _dict_to_anytree() on a hierarchy of annotations.
     """
     if isinstance(table_name, str):
         try:
-            annotations = rules_governing_tables[table_name]
+            annotations = _rules_governing_tables()[table_name]
         except:
             raise ValueError(f'Table name "{table_name}" not recognized.')
-    elif isinstance(table_name, (dict, list)):
-        annotations = table_name
+    elif isinstance(table_name, (dict, list, AnnotationRules)):
+        annotations = _compile_rules(table_name)
     else:
         raise TypeError(f'Unrecognized type for table_name: {type(table_name)}')
 
-    if isinstance(annotations, dict):
-        def print_one_tree(annotations, root: str):
-            for prefix, _, node in anytree.RenderTree(annotations[root][0]):
+    if isinstance(annotations, AnnotationRules):
+        import anytree
+        tree = annotations.tree
+        for root in [root for root in annotations.hierarchy
+                     if root in annotations.roots]:
+            for prefix, _, node in anytree.RenderTree(tree[root][0]):
                 print(f'{prefix}{node.name}')
-
-        for root_node in {anno for anno, nodes in annotations.items()
-                          if len(nodes) == 1 and nodes[0].is_root}:
-            print_one_tree(annotations, root_node)
     elif isinstance(annotations, list):
         for annotation in annotations:
             print(annotation)
 
 
+def _paired_rules(table_name) -> AnnotationRules:
+    """
+    Get the compiled rules for a table that uses paired annotations, or
+    compile user-provided rules.
+    """
+    if isinstance(table_name, str):
+        try:
+            annotations = _rules_governing_tables()[table_name]
+        except KeyError:
+            raise ValueError(f'Table name "{table_name}" not recognized.')
+        if not isinstance(annotations, AnnotationRules):
+            raise ValueError(f'"{table_name}" does not use paired annotations.')
+        return annotations
+    if isinstance(table_name, (dict, AnnotationRules)):
+        return _compile_rules(table_name)
+    raise TypeError(f'Unrecognized type for table_name: {type(table_name)}')
+
+
+def subclasses(annotation: str, table_name: str = None) -> set:
+    """
+    Get all the annotations that are below the given annotation (its
+    subclasses, their subclasses, etc.) in the annotation hierarchy.
+
+    Parameters
+    ----------
+    annotation : str
+        The annotation to get the subclasses of.
+    table_name : str or None
+        The name of the table whose annotation hierarchy should be used.
+        If None (default), combine the hierarchies of all tables that use
+        paired annotations.
+
+    Returns
+    -------
+    set of str (empty if the annotation is not in the hierarchy)
+    """
+    if table_name is None:
+        all_rules = [rules for rules in _rules_governing_tables().values()
+                     if isinstance(rules, AnnotationRules)]
+    else:
+        all_rules = [_paired_rules(table_name)]
+    return set().union(*(rules.descendants.get(annotation, ())
+                         for rules in all_rules))
+
+
+
+def subclass_pairs(annotation: str, table_name: str = None) -> set:
+    """
+    Get all the (annotation_class, annotation) pairs that are below the given
+    annotation in the annotation hierarchy. Unlike `subclasses()`, this keeps
+    track of which parent each term was reached from, which matters for terms
+    that appear under several parents (e.g. 'innervates coxa' appears under
+    'innervates T1 leg', 'innervates T2 leg' and 'innervates T3 leg', but
+    only the pair with 'innervates T1 leg' is below 'innervates T1 leg').
+
+    Parameters
+    ----------
+    annotation : str
+        The annotation to get the subclass pairs of.
+    table_name : str or None
+        The name of the table whose annotation hierarchy should be used.
+        If None (default), combine the hierarchies of all tables that use
+        paired annotations.
+
+    Returns
+    -------
+    set of 2-tuples of str (empty if the annotation is not in the hierarchy)
+    """
+    if table_name is None:
+        all_rules = [rules for rules in _rules_governing_tables().values()
+                     if isinstance(rules, AnnotationRules)]
+    else:
+        all_rules = [_paired_rules(table_name)]
+    pairs = set()
+    for rules in all_rules:
+        stack = [annotation] if annotation in rules else []
+        visited = set(stack)
+        while stack:
+            parent = stack.pop()
+            for child in rules.children[parent]:
+                pairs.add((parent, child))
+                if child not in visited:
+                    visited.add(child)
+                    stack.append(child)
+    return pairs
+
 def guess_class(annotation: str, table_name: str = default_table) -> str:
     """
     Look up the parent (or "class") of an annotation based on the rules
@@ -1313,34 +583,26 @@ def guess_class(annotation: str, table_name: str = default_table) -> str:
         class of the annotation.
         OR
         Users will not typically do this, but you can also pass in a dict
-        specifying the annotation hierarchy/rules directly. The dict must
-        map annotation names (str) to anytree.Node objects, as output by
-        running _dict_to_anytree() on a hierarchy of annotations.
+        specifying the annotation hierarchy/rules directly. The dict must be
+        a nested dictionary hierarchy of annotations, or map annotation names
+        (str) to anytree.Node objects, as output by running _dict_to_anytree()
+        on a hierarchy of annotations.
     """
-    if isinstance(table_name, str):
-        try:
-            annotations = rules_governing_tables[table_name]
-        except KeyError:
-            raise ValueError(f'Table name "{table_name}" not recognized.')
-        if not isinstance(annotations, dict):
-            raise ValueError(f'"{table_name}" does not use paired annotations.')
-    elif isinstance(table_name, dict):
-        annotations = table_name
-    else:
-        raise TypeError(f'Unrecognized type for table_name: {type(table_name)}')
+    annotations = _paired_rules(table_name)
 
     try:
-        annotation_nodes = annotations[annotation]
-    except KeyError:
-        raise ValueError(f'Annotation "{annotation}" not recognized. {help_msg}')
+        parents = annotations.parents[annotation]
+    except (KeyError, TypeError):
+        raise ValueError(f'Annotation "{annotation}" not recognized.'
+                         f'{_did_you_mean(annotation, annotations)} {help_msg}')
 
-    if len(annotation_nodes) > 1:
+    if len(parents) > 1:
         raise ValueError(f'Class of "{annotation}" could not be guessed'
                          f' because it has multiple possible classes. {help_msg}')
 
-    if annotation_nodes[0].is_root:
+    if parents[0] is None:
         raise ValueError(f'"{annotation}" is a base annotation with no class. {help_msg}')
-    return annotation_nodes[0].parent.name
+    return parents[0]
 
 
 def is_valid_annotation(annotation: Union[str, Tuple[str, str], bool],
@@ -1361,27 +623,28 @@ def is_valid_annotation(annotation: Union[str, Tuple[str, str], bool],
         OR
         Users will not typically do this, but you can also pass in a list or
         dict specifying the valid annotations directly and it will be used. If
-        a dictionary, must map annotation names (str) to anytree.Node objects,
-        as output by running _dict_to_anytree() on a hierarchy of annotations.
+        a dictionary, must be a nested dictionary hierarchy of annotations, or
+        map annotation names (str) to anytree.Node objects, as output by
+        running _dict_to_anytree() on a hierarchy of annotations.
     """
     if isinstance(table_name, str):
-        annotations = rules_governing_tables.get(table_name, None)
+        annotations = _rules_governing_tables().get(table_name, None)
         if annotations is None:
-            client = auth.get_caveclient()
-            if (client.annotation.get_table_metadata(table_name)['schema_type']
+            if (auth.get_table_metadata(table_name)['schema_type']
                     != 'proofreading_boolstatus_user'):
                 if response_on_unrecognized_table == 'raise':
                     raise ValueError(f'No annotation rules found for table "{table_name}"')
                 return response_on_unrecognized_table
             annotations = [True, False]
-    elif isinstance(table_name, (dict, list)):
-        annotations = table_name
+    elif isinstance(table_name, (dict, list, AnnotationRules)):
+        annotations = _compile_rules(table_name)
     else:
         raise TypeError(f'Unrecognized type for table_name: {type(table_name)}')
 
     if isinstance(annotations, list):
         if (annotation not in annotations) and raise_errors:
-            raise ValueError(f'Annotation "{annotation}" not recognized. {help_msg}')
+            raise ValueError(f'Annotation "{annotation}" not recognized.'
+                             f'{_did_you_mean(annotation, annotations)} {help_msg}')
         return annotation in annotations
 
     if raise_errors:
@@ -1457,20 +720,11 @@ def is_valid_pair(annotation_class: str,
         OR
         Users will not typically do this, but you can also pass in a dict
         specifying the valid annotations directly and it will be used. The
-        dict must map annotation names (str) to anytree.Node objects, as
-        output by running _dict_to_anytree() on a hierarchy of annotations.
+        dict must be a nested dictionary hierarchy of annotations, or map
+        annotation names (str) to anytree.Node objects, as output by running
+        _dict_to_anytree() on a hierarchy of annotations.
     """
-    if isinstance(table_name, str):
-        try:
-            annotations = rules_governing_tables[table_name]
-        except KeyError:
-            raise ValueError(f'Table name "{table_name}" not recognized.')
-        if not isinstance(annotations, dict):
-            raise ValueError(f'"{table_name}" does not use paired annotations.')
-    elif isinstance(table_name, dict):
-        annotations = table_name
-    else:
-        raise TypeError(f'Unrecognized type for table_name: {type(table_name)}')
+    annotations = _paired_rules(table_name)
 
     if annotation_class in ['neuron identity', 'freeform']:
         if annotation in annotations:
@@ -1492,31 +746,25 @@ def is_valid_pair(annotation_class: str,
             return False
         return True
 
-    try:
-        class_nodes = annotations[annotation_class]
-    except KeyError:
+    if annotation_class not in annotations:
         if raise_errors:
             raise ValueError(f'Annotation class "{annotation_class}" not'
-                             f' recognized. {help_msg}')
+                             f' recognized.{_did_you_mean(annotation_class, annotations)}'
+                             f' {help_msg}')
         return False
-    try:
-        annotation_nodes = annotations[annotation]
-    except KeyError:
+    if annotation not in annotations:
         if raise_errors:
             raise ValueError(f'Annotation "{annotation}" not recognized.'
-                             f' {help_msg}')
+                             f'{_did_you_mean(annotation, annotations)} {help_msg}')
         return False
 
-    for class_node in class_nodes:
-        for annotation_node in annotation_nodes:
-            if annotation_node in class_node.children:
-                return True
+    if (annotation_class, annotation) in annotations.valid_pairs:
+        return True
 
     if raise_errors:
-        parent_names = [node.parent.name
-                        if node.parent is not None else '<no class>'
-                        for node in annotation_nodes]
-        if len(annotation_nodes) == 1:
+        parent_names = [parent if parent is not None else '<no class>'
+                        for parent in annotations.parents[annotation]]
+        if len(parent_names) == 1:
             raise ValueError(f'Annotation "{annotation}" belongs to class'
                              f' "{parent_names[0]}" but you specified class'
                              f' "{annotation_class}". {help_msg}')
@@ -1583,17 +831,16 @@ def is_allowed_to_post(segid: int,
       If `raise_errors` is True, an exception with an informative error
       message will be raised instead of returning False.
     """
-    annotations = rules_governing_tables.get(table_name, None)
+    annotations = _rules_governing_tables().get(table_name, None)
     if annotations is None:
-        client = auth.get_caveclient()
-        if (client.annotation.get_table_metadata(table_name)['schema_type']
+        if (auth.get_table_metadata(table_name)['schema_type']
                 != 'proofreading_boolstatus_user'):
             if response_on_unrecognized_table == 'raise':
                 raise ValueError(f'No annotation rules found for table "{table_name}"')
             return response_on_unrecognized_table
         if not isinstance(annotation, bool):
             raise ValueError(f'Table "{table_name}" only uses True/False annotations.')
-        existing_annos = client.materialize.live_live_query(
+        existing_annos = auth.get_caveclient().materialize.live_live_query(
             table_name,
             datetime.now(timezone.utc),
             filter_equal_dict={table_name: {
@@ -1602,6 +849,11 @@ def is_allowed_to_post(segid: int,
             }},
             allow_missing_lookups=lookup.allow_missing_lookups
         )
+        recent = lookup.recent_uploads(table_name, [segid])
+        if not recent.empty:
+            recent = recent.loc[(recent.valid_id == segid) &
+                                (recent.proofread == annotation)]
+            existing_annos = pd.concat([existing_annos, recent])
         if raise_errors and not existing_annos.empty:
             raise ValueError(f'Segment {segid} already has this annotation'
                              f' in the table "{table_name}".')
@@ -1633,12 +885,6 @@ def is_allowed_to_post(segid: int,
             return False
 
     # Rule 1
-    multiple_subclasses_allowed = [
-        'other neurotransmitter',
-        'neuron identity',
-        'freeform',
-        'publication'
-    ]
     if annotation_class in multiple_subclasses_allowed:
         # Check if any tag,tag2 pair is the same as annotation,annotation_class
         if ((existing_annos.tag == annotation) &
@@ -1675,9 +921,7 @@ def is_allowed_to_post(segid: int,
         return False
 
     # Rule 2
-    root_classes = [anno for anno, nodes in annotations.items()
-                    if len(nodes) == 1 and nodes[0].is_root]
-    if (annotation_class not in root_classes and
+    if (annotation_class not in annotations.roots and
             not (existing_annos.tag == annotation_class).any()):
         if raise_errors:
             raise MissingParentAnnotationError(
@@ -1688,3 +932,171 @@ def is_allowed_to_post(segid: int,
         return False
 
     return True
+
+
+def validate_bulk(proposed: pd.DataFrame,
+                  table_name: str = default_table,
+                  segid_column: str = 'pt_root_id',
+                  annotation_column: str = 'annotation',
+                  existing: pd.DataFrame = None,
+                  timestamp='now') -> pd.DataFrame:
+    """
+    Check whether each of many proposed annotations is allowed to be posted,
+    applying the same rules as `is_allowed_to_post()` but with a single query
+    for the existing annotations of all segments and with the rules evaluated
+    as vectorized joins instead of one segment at a time.
+
+    Rows are treated as if they were posted in order, so a row may rely on
+    annotations added by earlier rows (e.g. 'primary class: sensory neuron'
+    followed by 'sensory neuron: photoreceptor neuron' for the same segment),
+    and a row that would duplicate or conflict with an earlier allowed row is
+    not allowed.
+
+    Arguments
+    ---------
+    proposed: pd.DataFrame
+      Table of proposed annotations, with one column of segment IDs and one
+      column of annotations. For tables that use paired annotations, each
+      annotation may be in any format that `parse_annotation_pair()` accepts.
+
+    table_name: str
+      The name of the table the annotations would be posted to. Must be one
+      of the tables in `rules_governing_tables`.
+
+    segid_column, annotation_column: str
+      The names of the columns of `proposed` to use.
+
+    existing: pd.DataFrame or None (default)
+      The annotations already in the table for these segments, in the format
+      returned by `lookup.annotations(..., return_details=True)`. If None,
+      they are queried from CAVE.
+
+    timestamp: 'now' (default) OR datetime OR None
+      Passed to `lookup.annotations()` when querying existing annotations.
+
+    Returns
+    -------
+    pd.DataFrame
+      A copy of `proposed` with columns 'allowed' (bool) and 'reason' (str
+      explaining why the row is not allowed, or None) added. For tables that
+      use paired annotations, the parsed annotation pair is also added as
+      columns 'tag2' (the annotation class) and 'tag' (the annotation).
+    """
+    try:
+        rules = _rules_governing_tables()[table_name]
+    except KeyError:
+        raise ValueError(f'No annotation rules found for table "{table_name}"')
+
+    result = proposed.copy()
+    segids = result[segid_column].astype('int64').values
+    if existing is None:
+        existing = lookup.annotations(pd.unique(segids).tolist(),
+                                      source_tables=table_name,
+                                      timestamp=timestamp,
+                                      return_details=True)
+    reason = pd.Series([None] * len(result), index=result.index, dtype=object)
+
+    def reject(mask, message):
+        # Record a reason only for rows that don't already have one
+        mask = pd.Series(mask, index=result.index) & reason.isna()
+        if callable(message):
+            reason[mask] = [message(i) for i in result.index[mask]]
+        else:
+            reason[mask] = message
+        return mask
+
+    if isinstance(rules, list):
+        annos = result[annotation_column]
+        valid_terms = set(rules)
+        reject([anno not in valid_terms for anno in annos],
+               lambda i: f'Annotation "{annos[i]}" not recognized.'
+                         f'{_did_you_mean(annos[i], rules)} {help_msg}')
+        keys = pd.MultiIndex.from_arrays([segids, annos])
+        reject(keys.isin(pd.MultiIndex.from_arrays([existing.pt_root_id,
+                                                     existing.tag])),
+               lambda i: f'Segment {result.at[i, segid_column]} already has'
+                         f' the annotation "{annos[i]}".')
+        reject(keys.duplicated(), 'Duplicate of an earlier row.')
+        result['allowed'] = reason.isna()
+        result['reason'] = reason
+        return result
+
+    # Parse and check the validity of each pair. These checks don't depend
+    # on other rows or on existing annotations, so they're done row by row.
+    tag2, tag = [], []
+    for i, annotation in zip(result.index, result[annotation_column]):
+        try:
+            annotation_class, annotation = parse_annotation_pair(annotation,
+                                                                 table_name)
+            is_valid_pair(annotation_class, annotation, rules)
+        except (ValueError, TypeError) as e:
+            reason[i] = str(e)
+            annotation_class = annotation = None
+        tag2.append(annotation_class)
+        tag.append(annotation)
+    result['tag2'] = tag2
+    result['tag'] = tag
+    tag2 = result['tag2']
+
+    # Rule 0: no exact duplicates of existing annotations or earlier rows
+    pairs = pd.MultiIndex.from_arrays([segids, result.tag2, result.tag])
+    reject(pairs.isin(pd.MultiIndex.from_arrays([existing.pt_root_id,
+                                                  existing.tag2,
+                                                  existing.tag])),
+           lambda i: f'Segment {result.at[i, segid_column]} already has this'
+                     ' exact annotation pair.')
+    reject(pairs.duplicated() & reason.isna().values,
+           'Duplicate of an earlier row.')
+
+    # Rule 1: only one subclass per class, except for a few special classes
+    exclusive = ~tag2.isin(multiple_subclasses_allowed)
+    classes = pd.MultiIndex.from_arrays([segids, tag2])
+    conflicts_existing = classes.isin(pd.MultiIndex.from_arrays(
+        [existing.pt_root_id, existing.tag2]))
+    reject(exclusive & conflicts_existing,
+           lambda i: f'Segment {result.at[i, segid_column]} already has an'
+                     f' annotation with class "{tag2[i]}". {help_msg}')
+
+    # Rule 1 (within the batch) and rule 2: the class must be a root class,
+    # already be an annotation on the segment, or be added to the segment by
+    # an earlier allowed row. Whether a row is allowed depends only on which
+    # earlier rows are allowed, so recompute both rules from the previous
+    # round's allowed rows until nothing changes. Each round settles at least
+    # one more row in order, and in practice this takes a few rounds (about
+    # the depth of the hierarchy).
+    is_root = tag2.isin(rules.roots).values
+    has_existing_parent = classes.isin(pd.MultiIndex.from_arrays(
+        [existing.pt_root_id, existing.tag]))
+    positions = np.arange(len(result))
+    candidates = reason.isna().values
+    allowed = candidates
+
+    def first_allowed(column, allowed):
+        # Position of the first allowed row with each (segment, column value)
+        return pd.Series(positions[allowed], index=pd.MultiIndex.from_arrays(
+            [segids[allowed], result[column][allowed]])).groupby(
+                level=[0, 1]).min().reindex(classes).values
+
+    while True:
+        conflicts_batch = (exclusive.values
+                           & (first_allowed('tag2', allowed) < positions))
+        missing_parent = (~is_root & ~has_existing_parent
+                          & ~(first_allowed('tag', allowed) < positions))
+        now_allowed = candidates & ~conflicts_batch & ~missing_parent
+        if (now_allowed == allowed).all():
+            break
+        allowed = now_allowed
+
+    reject(candidates & conflicts_batch,
+           lambda i: f'Segment {result.at[i, segid_column]} already has an'
+                     f' annotation with class "{tag2[i]}" in an earlier row.'
+                     f' {help_msg}')
+    reject(candidates & missing_parent,
+           lambda i: f'Segment {result.at[i, segid_column]} must be annotated'
+                     f' with "{tag2[i]}" before this term can be used as an'
+                     f' annotation class. {help_msg}')
+
+    result['allowed'] = reason.isna()
+    result['reason'] = reason
+    return result
+
@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
 import os
+import json
+import time
+import random
+import threading
+import functools
+from concurrent import futures
+
+import requests
 
 from caveclient import CAVEclient
 from cloudvolume import CloudVolume
@@ -15,6 +23,11 @@ DATASTACK_NICKNAMES = {
 
 configs = {
     'mesh_cache': os.path.expanduser('~/banc-meshes'),
+    'synapse_count_cache': os.path.expanduser('~/banc-synapse-counts'),
+    'metadata_cache': os.path.expanduser('~/banc-metadata'),
+    'metadata_cache_ttl': 24 * 60 * 60,  # seconds
+    'nuclei_rebuild_workspace': os.path.expanduser('~/banc-nuclei-rebuild'),
+    'upload_journal': os.path.expanduser('~/banc-upload-journal.sqlite'),
     'cave_auth_token_key': 'brain_and_nerve_cord',
 }
 if os.environ.get('BANC_AUTH_TOKEN_KEY'):
@@ -23,6 +36,11 @@ if os.environ.get('BANC_AUTH_TOKEN_KEY'):
 # To enable lazy loading and caching of CAVEclients and cloudvolumes
 _clients = {}
 _cloudvolumes = {}
+# Emulated CAVE deployments (see fanc.cave_emulator), as {dataset: emulator}
+_emulators = {}
+# Datastack info, table metadata and schema definitions, as
+# {dataset: {kind: {key: [time_fetched, value]}}}
+_metadata = {}
 
 
 def save_cave_credentials(token,
@@ -53,9 +71,269 @@ def use_auth_token_key(token_key):
     configs['cave_auth_token_key'] = token_key
 
 
+class RateLimiter(object):
+    """
+    Client-side rate limiting and retries for CAVE requests, shared by all
+    threads.
+
+    Requests are spaced out by a token bucket, and the number of concurrent
+    requests is capped. Both limits adapt to the server (AIMD): they grow a
+    little after each successful request, and are halved when the server
+    signals that it is overloaded (HTTP 429 or 5xx, or a dropped
+    connection). Until the first such signal, they grow by 1 after each
+    success instead ("slow start"), to find the server's capacity quickly.
+    Overloaded requests are retried with exponential backoff and full
+    jitter, honoring the server's Retry-After header if given. Writes are
+    only retried after HTTP 429 or 503, which mean the server did not
+    process them.
+
+    All CAVE clients from `get_caveclient()` send their annotation writes
+    and their bulk reads through `auth.rate_limiter`.
+    """
+    retryable_status_codes = (429, 500, 502, 503, 504)
+    write_retryable_status_codes = (429, 503)
+
+    def __init__(self, rate=10.0, max_rate=100.0, min_rate=0.5,
+                 concurrency=4, max_concurrency=32,
+                 max_retries=6, base_delay=0.5, max_delay=60.0):
+        """
+        Arguments
+        ---------
+        rate, max_rate, min_rate: float
+            Initial, maximum and minimum requests per second.
+
+        concurrency, max_concurrency: int
+            Initial and maximum number of requests in flight at once.
+
+        max_retries: int
+            How many times to retry a request before raising its error.
+
+        base_delay, max_delay: float
+            Seconds to back off before the first retry, and at most.
+        """
+        self.enabled = True
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rate = float(rate)
+        self._concurrency = float(concurrency)
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self._metrics = {'requests': 0, 'successes': 0, 'retries': 0,
+                         'throttled': 0, 'failures': 0,
+                         'wait_seconds': 0.0, 'backoff_seconds': 0.0}
+
+    def metrics(self) -> dict:
+        """
+        Get counts of requests, successes, retries, throttling responses and
+        failures, the total seconds spent waiting for the limits and backing
+        off, and the current limits.
+        """
+        with self._condition:
+            return {**self._metrics,
+                    'rate': self._rate,
+                    'concurrency': int(self._concurrency),
+                    'in_flight': self._in_flight}
+
+    def _acquire(self):
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(max(1.0, self._rate),
+                                   self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._in_flight < int(self._concurrency) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self._metrics['wait_seconds'] += now - start
+                    return
+                if self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self._rate)
+                else:
+                    self._condition.wait()
+
+    def _release(self, overloaded):
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded is None:
+                pass
+            elif not overloaded:
+                # Additive increase, by about 1 per window of requests
+                step = 1 if self._slow_start else 1 / self._concurrency
+                self._concurrency = min(self.max_concurrency, self._concurrency + step)
+                step = 1 if self._slow_start else 1 / self._rate
+                self._rate = min(self.max_rate, self._rate + step)
+            elif time.monotonic() - self._last_decrease > 1:
+                # Multiplicative decrease, at most once per second so that
+                # a burst of rejections of concurrent requests counts once
+                self._concurrency = max(1.0, self._concurrency / 2)
+                self._rate = max(self.min_rate, self._rate / 2)
+                self._last_decrease = time.monotonic()
+                self._slow_start = False
+            self._condition.notify_all()
+
+    def _is_overloaded(self, error):
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code in self.retryable_status_codes
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        response = getattr(error, 'response', None)
+        try:
+            delay = max(delay, float(response.headers['Retry-After']))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+        return min(delay, self.max_delay)
+
+    def _is_retryable(self, error, idempotent):
+        if idempotent:
+            return True
+        # A write that timed out or failed with a 5xx may still have been
+        # applied, so only retry it if the server says it wasn't
+        response = getattr(error, 'response', None)
+        return (isinstance(error, requests.HTTPError) and response is not None
+                and response.status_code in self.write_retryable_status_codes)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs), subject to the limits. The call is
+        assumed to be safe to repeat. For calls that aren't, use `wrap()`
+        with idempotent=False.
+        """
+        return self._call(function, args, kwargs, idempotent=True)
+
+    def _call(self, function, args, kwargs, idempotent):
+        # Requests made from within a limited request pass straight through,
+        # so they can't wait on a slot held by their own caller
+        if not self.enabled or getattr(self._local, 'active', False):
+            return function(*args, **kwargs)
+        attempt = 0
+        while True:
+            self._acquire()
+            self._local.active = True
+            overloaded = None
+            try:
+                result = function(*args, **kwargs)
+                overloaded = False
+                return result
+            except Exception as e:
+                if not self._is_overloaded(e):
+                    raise
+                overloaded = True
+                with self._condition:
+                    self._metrics['throttled'] += 1
+                    if (attempt >= self.max_retries
+                            or not self._is_retryable(e, idempotent)):
+                        self._metrics['failures'] += 1
+                        raise
+                    self._metrics['retries'] += 1
+                error = e
+            finally:
+                self._local.active = False
+                self._release(overloaded)
+                with self._condition:
+                    self._metrics['requests'] += 1
+                    if overloaded is False:
+                        self._metrics['successes'] += 1
+            delay = self._backoff(attempt, error)
+            with self._condition:
+                self._metrics['backoff_seconds'] += delay
+            time.sleep(delay)
+            attempt += 1
+
+    def wrap(self, function, idempotent=True):
+        """
+        Return a version of function that calls it through `call()`.
+
+        Arguments
+        ---------
+        function: callable
+
+        idempotent: bool (default True)
+            Whether calling function twice has the same effect as calling it
+            once. If False, the call is only retried after responses that
+            mean the server did not process it (HTTP 429 or 503), not after
+            other errors or dropped connections, since those may come after
+            the server made the change.
+        """
+        @functools.wraps(function)
+        def rate_limited(*args, **kwargs):
+            return self._call(function, args, kwargs, idempotent)
+        rate_limited._rate_limited = True
+        return rate_limited
+
+
+rate_limiter = RateLimiter()
+
+# CAVE client methods that go through rate_limiter, by sub-client. Uploads
+# of staged annotations go through post_annotation once per batch.
+_rate_limited_methods = {
+    'annotation': ['post_annotation', 'update_annotation', 'delete_annotation',
+                   'get_annotation'],
+    'materialize': ['live_live_query', 'live_query', 'query_table',
+                    'query_view', 'synapse_query'],
+    'chunkedgraph': ['get_roots', 'is_latest_roots', 'get_latest_roots'],
+}
+# Methods that change data, so are only retried when the server says it
+# didn't process the request (see RateLimiter.wrap)
+_write_methods = {'post_annotation', 'update_annotation', 'delete_annotation'}
+
+
+def _install_rate_limiter(client):
+    """
+    Route the client's writes and bulk reads through rate_limiter, by
+    wrapping the methods in `_rate_limited_methods` on its sub-clients.
+    This creates those sub-clients now instead of when first used.
+    """
+    for name, methods in _rate_limited_methods.items():
+        subclient = getattr(client, name, None)
+        if subclient is None or getattr(subclient, '_rate_limited', False):
+            continue
+        for method in methods:
+            if hasattr(subclient, method):
+                setattr(subclient, method, rate_limiter.wrap(
+                    getattr(subclient, method),
+                    idempotent=method not in _write_methods))
+        subclient._rate_limited = True
+    return client
+
+
+def install_emulator(emulator, dataset=DEFAULT_DATASET):
+    """
+    Make get_caveclient() and get_cloudvolume() return the given
+    `cave_emulator.CAVEEmulator` for this dataset, for any auth token key.
+    Metadata fetched from the emulator is cached in memory only.
+    """
+    dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    _emulators[dataset] = _install_rate_limiter(emulator)
+    _metadata[dataset] = {}
+
+
+def uninstall_emulator(dataset=DEFAULT_DATASET):
+    """Undo install_emulator()."""
+    dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    _emulators.pop(dataset, None)
+    _metadata.pop(dataset, None)
+
+
 def get_caveclient(dataset=DEFAULT_DATASET, auth_token_key=None):
     # If a nickname was used, get the proper datastack name
     dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    if dataset in _emulators:
+        return _emulators[dataset]
 
     # If auth_token_key is not provided, use the default
     if auth_token_key is None:
@@ -64,8 +342,8 @@ def get_caveclient(dataset=DEFAULT_DATASET, auth_token_key=None):
     if dataset not in _clients:
         _clients[dataset] = {}
     if auth_token_key not in _clients[dataset]:
-        _clients[dataset][auth_token_key] = CAVEclient(dataset,
-                                                       auth_token_key=auth_token_key)
+        _clients[dataset][auth_token_key] = _install_rate_limiter(
+            CAVEclient(dataset, auth_token_key=auth_token_key))
 
     return _clients[dataset][auth_token_key]
 
@@ -78,6 +356,8 @@ def get_chunkedgraph_path(dataset=DEFAULT_DATASET):
 def get_cloudvolume(dataset=DEFAULT_DATASET):
     # If a nickname was used, get the proper datastack name
     dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    if dataset in _emulators:
+        return _emulators[dataset].get_cloudvolume()
 
     if dataset not in _cloudvolumes:
         _cloudvolumes[dataset] = CloudVolume(
@@ -98,3 +378,129 @@ def get_meshmanager(dataset=DEFAULT_DATASET,
         disk_cache_path=mesh_cache,
         map_gs_to_https=True
     )
+
+
+def _metadata_cache_path(dataset):
+    return os.path.join(configs['metadata_cache'], f'{dataset}.json')
+
+
+def _get_metadata_store(dataset):
+    """
+    Get the metadata cache for a dataset, loading it from disk (if it's been
+    saved there by a previous run) the first time it's needed.
+    """
+    if dataset not in _metadata:
+        _metadata[dataset] = {}
+        try:
+            with open(_metadata_cache_path(dataset), 'r') as f:
+                _metadata[dataset] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return _metadata[dataset]
+
+
+def _save_metadata_store(dataset):
+    path = _metadata_cache_path(dataset)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(_metadata[dataset], f, default=str)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass  # The disk cache is just an optimization
+
+
+def _cached_metadata(dataset, kind, key, fetch, refresh=False, save=True,
+                     client=None):
+    if client is not None:
+        dataset = client.datastack_name
+    dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    store = _get_metadata_store(dataset).setdefault(kind, {})
+    entry = store.get(key)
+    if (refresh or entry is None
+            or time.time() - entry[0] > configs['metadata_cache_ttl']):
+        if client is None:
+            client = get_caveclient(dataset)
+        entry = [time.time(), fetch(client)]
+        store[key] = entry
+        if save and dataset not in _emulators:
+            _save_metadata_store(dataset)
+    return entry[1]
+
+
+def get_datastack_info(dataset=DEFAULT_DATASET, refresh=False, client=None) -> dict:
+    """
+    Get a datastack's info (names of its synapse table, soma table, etc.),
+    using a cache shared by the whole process and saved to disk between runs.
+    Cached values are refetched after configs['metadata_cache_ttl'] seconds,
+    or when `refresh` is True. If a CAVEclient is given, it is used (instead
+    of `dataset`) to determine the datastack and to fetch uncached values.
+    """
+    return _cached_metadata(dataset, 'datastack_info', 'info',
+                            lambda client: client.info.get_datastack_info(),
+                            refresh=refresh, client=client)
+
+
+def get_table_metadata(table_name, dataset=DEFAULT_DATASET, refresh=False,
+                       client=None) -> dict:
+    """
+    Get a CAVE table's metadata (schema type, description, etc.), using the
+    same cache as get_datastack_info(). Any datetimes in the metadata are
+    strings when loaded from the disk cache.
+    """
+    return _cached_metadata(dataset, 'table_metadata', table_name,
+                            lambda client: client.annotation.get_table_metadata(table_name),
+                            refresh=refresh, client=client)
+
+
+def get_schema_definition(schema_name, dataset=DEFAULT_DATASET, refresh=False,
+                          client=None) -> dict:
+    """
+    Get the definition of an annotation schema (e.g. 'nucleus_detection'),
+    using the same cache as get_datastack_info().
+    """
+    return _cached_metadata(dataset, 'schema_definition', schema_name,
+                            lambda client: client.schema.schema_definition(schema_name),
+                            refresh=refresh, client=client)
+
+
+def prefetch_metadata(dataset=DEFAULT_DATASET, max_workers=8):
+    """
+    Fill the metadata cache with the datastack info, the metadata of every
+    CAVE table in the datastack, and the definition of every schema those
+    tables use, then save the cache to disk.
+    """
+    dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    client = get_caveclient(dataset)
+    get_datastack_info(dataset, refresh=True)
+    table_names = client.annotation.get_tables()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        table_metadata = list(executor.map(
+            lambda table_name: _cached_metadata(
+                dataset, 'table_metadata', table_name,
+                lambda client: client.annotation.get_table_metadata(table_name),
+                refresh=True, save=False),
+            table_names))
+    schema_names = sorted({metadata['schema_type'] for metadata in table_metadata})
+    definitions = client.schema.schema_definition_multi(schema_names)
+    if definitions is None:  # Endpoint not available on this deployment
+        definitions = {schema_name: client.schema.schema_definition(schema_name)
+                       for schema_name in schema_names}
+    store = _metadata[dataset].setdefault('schema_definition', {})
+    now = time.time()
+    for schema_name in schema_names:
+        store[schema_name] = [now, definitions[schema_name]]
+    _save_metadata_store(dataset)
+
+
+def clear_metadata_cache(dataset=DEFAULT_DATASET):
+    """
+    Remove a dataset's metadata cache from memory and from disk.
+    """
+    dataset = DATASTACK_NICKNAMES.get(dataset, dataset)
+    _metadata.pop(dataset, None)
+    try:
+        os.remove(_metadata_cache_path(dataset))
+    except FileNotFoundError:
+        pass
+
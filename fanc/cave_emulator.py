@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+"""
+An in-memory stand-in for the parts of CAVEclient that `fanc` uses, so that
+code in `upload`, `lookup` and the bots can be tested, and the throughput of
+bulk code paths measured, without access to a CAVE deployment.
+
+Tables are pandas DataFrames. The segmentation is a mapping from point
+coordinates to supervoxel IDs and from supervoxel IDs to root IDs, which
+can be edited with `merge()` and `split()`. Queries always see the current
+state; past timestamps are not emulated, except that `is_latest_roots`
+reports roots retired by edits as not latest.
+
+Example
+-------
+>>> from fanc import cave_emulator, lookup, upload
+>>> cave = cave_emulator.CAVEEmulator(latency=0.05)
+>>> cave.create_table('cell_info', schema_type='bound_double_tag_user')
+>>> segid = cave.add_segment([[1000, 1000, 100], [1010, 1000, 100]])
+>>> cave.install()
+>>> upload.annotate_neuron([1000, 1000, 100], ('primary class', 'sensory neuron'), 123)
+>>> lookup.annotations(segid)
+['sensory neuron']
+>>> cave.request_counts
+Counter({...})
+>>> cave.uninstall()
+"""
+
+import time
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import requests
+from cloudvolume.frontends.precomputed import CloudVolumePrecomputed
+
+from . import auth
+
+# Field types for the annotation schemas used in this dataset. 'bound_point'
+# fields are linked to the segmentation, so queries return the supervoxel and
+# root ID at the point ('pt_position' gets 'pt_supervoxel_id' and 'pt_root_id').
+schemas = {
+    'bound_tag_user': {'pt_position': 'bound_point', 'tag': 'str',
+                       'user_id': 'int'},
+    'bound_double_tag_user': {'pt_position': 'bound_point', 'tag': 'str',
+                              'tag2': 'str', 'user_id': 'int'},
+    'proofreading_boolstatus_user': {'pt_position': 'bound_point',
+                                     'valid_id': 'int', 'proofread': 'bool',
+                                     'user_id': 'int'},
+    'nucleus_detection': {'pt_position': 'bound_point', 'volume': 'float',
+                          'bb_start_position': 'point',
+                          'bb_end_position': 'point'},
+    'simple_reference': {'target_id': 'int'},
+    'synapse': {'pre_pt_position': 'bound_point',
+                'post_pt_position': 'bound_point', 'size': 'int'},
+}
+_dtypes = {'str': object, 'int': 'Int64', 'bool': 'boolean', 'float': float,
+           'point': object, 'bound_point': object}
+_default_datastack_info = {
+    'viewer_site': 'https://neuroglancer.example.com',
+    'viewer_resolution_x': 4.0,
+    'viewer_resolution_y': 4.0,
+    'viewer_resolution_z': 45.0,
+    'segmentation_source': 'graphene://emulated',
+    'soma_table': 'somas',
+    'synapse_table': 'synapses',
+    'aligned_volume': {'name': 'emulated', 'image_source': 'precomputed://emulated'},
+}
+_first_root_id = 720575940600000000
+_first_supervoxel_id = 72057594037927936
+
+
+def _http_error(status_code, message):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f'{status_code}: {message}', response=response)
+
+
+class _StagedAnnotations(object):
+    """The parts of caveclient's StagedAnnotations that fanc uses."""
+    UPLOADED_ID_FIELD = '_UPLOADED_ID_'
+    IS_UPLOADED_FIELD = '_IS_UPLOADED_'
+    is_update = False
+
+    def __init__(self, table_name, fields, id_field=False):
+        self.table_name = table_name
+        self.fields = list(fields) + (['id'] if id_field else [])
+        self._anno_list = []
+
+    def add(self, **kwargs):
+        # Every CAVE schema has a 'valid' field
+        unknown = set(kwargs) - set(self.fields) - {'valid'}
+        if unknown:
+            raise ValueError(f'Fields {sorted(unknown)} are not in the schema of'
+                             f' table "{self.table_name}": {self.fields}')
+        self._anno_list.append(SimpleNamespace(**kwargs))
+
+    def add_dataframe(self, df):
+        for row in df.to_dict('records'):
+            self.add(**{k: v for k, v in row.items() if k in self.fields})
+
+    def clear_annotations(self):
+        self._anno_list = []
+
+    @property
+    def annotation_list(self):
+        return [{k: v for k, v in vars(anno).items()
+                 if k not in (self.UPLOADED_ID_FIELD, self.IS_UPLOADED_FIELD)}
+                for anno in self._anno_list]
+
+    @property
+    def annotation_dataframe(self):
+        return pd.DataFrame(self.annotation_list)
+
+
+class _Info(object):
+    def __init__(self, cave):
+        self._cave = cave
+
+    def get_datastack_info(self, datastack_name=None, use_stored=True):
+        self._cave._request('info.get_datastack_info')
+        return dict(self._cave.datastack_info)
+
+
+class _Auth(object):
+    token = ''
+
+    def __init__(self, cave):
+        self._cave = cave
+
+    def get_user_information(self, user_ids):
+        self._cave._request('auth.get_user_information', len(user_ids))
+        return [{'id': user_id, 'name': f'User {user_id}', 'pi': ''}
+                for user_id in user_ids]
+
+
+class _Schema(object):
+    def __init__(self, cave):
+        self._cave = cave
+
+    def schema_definition(self, schema_type):
+        self._cave._request('schema.schema_definition')
+        if schema_type not in schemas:
+            raise _http_error(404, f'Schema "{schema_type}" not found')
+        name = ''.join(word.capitalize() for word in schema_type.split('_'))
+        return {'definitions': {name: {
+            'properties': {field: {'type': kind}
+                           for field, kind in schemas[schema_type].items()},
+            'required': list(schemas[schema_type]),
+        }}}
+
+
+class _Chunkedgraph(object):
+    def __init__(self, cave):
+        self._cave = cave
+
+    def get_roots(self, supervoxel_ids, timestamp=None, stop_layer=None):
+        supervoxel_ids = np.asarray(supervoxel_ids, dtype=np.int64)
+        self._cave._request('chunkedgraph.get_roots', len(supervoxel_ids))
+        return self._cave.roots(supervoxel_ids)
+
+    def is_latest_roots(self, root_ids, timestamp=None):
+        root_ids = np.asarray(root_ids, dtype=np.int64).reshape(-1)
+        self._cave._request('chunkedgraph.is_latest_roots', len(root_ids))
+        with self._cave._lock:
+            return np.isin(root_ids, list(self._cave._latest_roots))
+
+
+class _Materialize(object):
+    version = 1
+
+    def __init__(self, cave):
+        self._cave = cave
+
+    def get_timestamp(self, version=None, datastack_name=None):
+        self._cave._request('materialize.get_timestamp')
+        return datetime.now(timezone.utc)
+
+    def most_recent_version(self, datastack_name=None):
+        self._cave._request('materialize.most_recent_version')
+        return self.version
+
+    def live_live_query(self, table, timestamp=None, joins=None,
+                        filter_in_dict=None, filter_out_dict=None,
+                        filter_equal_dict=None, filter_greater_dict=None,
+                        filter_less_dict=None, filter_greater_equal_dict=None,
+                        filter_less_equal_dict=None, select_columns=None,
+                        filter_spatial_dict=None, limit=None,
+                        allow_missing_lookups=False, **kwargs):
+        result = self._cave._query(
+            table, filter_in_dict, filter_out_dict, filter_equal_dict,
+            filter_greater_dict, filter_less_dict, filter_greater_equal_dict,
+            filter_less_equal_dict, select_columns, filter_spatial_dict, limit)
+        self._cave._request('materialize.live_live_query', len(result))
+        return result
+
+    def live_query(self, table, timestamp=None, **kwargs):
+        return self.live_live_query(table, timestamp, **kwargs)
+
+    def query_table(self, table, filter_in_dict=None, filter_out_dict=None,
+                    filter_equal_dict=None, filter_greater_dict=None,
+                    filter_less_dict=None, filter_greater_equal_dict=None,
+                    filter_less_equal_dict=None, select_columns=None,
+                    filter_spatial_dict=None, limit=None, **kwargs):
+        result = self._cave._query(
+            table, filter_in_dict, filter_out_dict, filter_equal_dict,
+            filter_greater_dict, filter_less_dict, filter_greater_equal_dict,
+            filter_less_equal_dict, select_columns, filter_spatial_dict, limit)
+        self._cave._request('materialize.query_table', len(result))
+        return result
+
+    def synapse_query(self, pre_ids=None, post_ids=None, bounding_box=None,
+                      bounding_box_column='post_pt_position', timestamp=None,
+                      remove_autapses=True, include_zeros=True, **kwargs):
+        filters = {}
+        if pre_ids is not None:
+            filters['pre_pt_root_id'] = np.atleast_1d(pre_ids).tolist()
+        if post_ids is not None:
+            filters['post_pt_root_id'] = np.atleast_1d(post_ids).tolist()
+        result = self._cave._query(self._cave.datastack_info['synapse_table'],
+                                   filter_in_dict=filters)
+        if bounding_box is not None:
+            points = np.vstack(result[bounding_box_column].values) if len(result) else np.zeros((0, 3))
+            inside = np.all((points >= bounding_box[0]) & (points < bounding_box[1]), axis=1)
+            result = result.loc[inside].reset_index(drop=True)
+        if remove_autapses:
+            result = result.loc[result.pre_pt_root_id != result.post_pt_root_id]
+        if not include_zeros:
+            result = result.loc[(result.pre_pt_root_id != 0) & (result.post_pt_root_id != 0)]
+        result = result.reset_index(drop=True)
+        self._cave._request('materialize.synapse_query', len(result))
+        return result
+
+
+class _Annotation(object):
+    def __init__(self, cave):
+        self._cave = cave
+
+    def get_tables(self, aligned_volume_name=None):
+        self._cave._request('annotation.get_tables')
+        return list(self._cave._tables)
+
+    def get_table_metadata(self, table_name, aligned_volume_name=None):
+        self._cave._request('annotation.get_table_metadata')
+        if table_name not in self._cave._tables:
+            raise _http_error(404, f'Table "{table_name}" not found')
+        return dict(self._cave._table_metadata[table_name])
+
+    def stage_annotations(self, table_name=None, schema_name=None,
+                          update=False, id_field=False, **kwargs):
+        if table_name not in self._cave._tables:
+            raise _http_error(404, f'Table "{table_name}" not found')
+        return _StagedAnnotations(table_name, self._cave._fields[table_name],
+                                  id_field=id_field)
+
+    def post_annotation(self, table_name, data, aligned_volume_name=None):
+        if isinstance(data, dict):
+            data = [data]
+        self._cave._request('annotation.post_annotation', len(data))
+        ids = self._cave._insert(table_name, data)
+        if self._cave.lost_response_rate and random.random() < self._cave.lost_response_rate:
+            raise requests.Timeout('Response lost after the annotations were'
+                                   ' posted (emulated)')
+        return ids
+
+    def upload_staged_annotations(self, staged_annos, aligned_volume_name=None,
+                                  batch_size=10_000, progress=True, retries=3):
+        ids = []
+        for start in range(0, len(staged_annos._anno_list), batch_size):
+            batch = staged_annos._anno_list[start:start + batch_size]
+            # Like caveclient, post the batch again after any error, up to
+            # `retries` attempts in total (without caveclient's sleeps)
+            for attempt in range(1, retries + 1):
+                try:
+                    batch_ids = self.post_annotation(
+                        staged_annos.table_name,
+                        [{k: v for k, v in vars(anno).items()
+                          if k not in (staged_annos.UPLOADED_ID_FIELD,
+                                       staged_annos.IS_UPLOADED_FIELD)}
+                         for anno in batch])
+                    break
+                except Exception:
+                    if attempt >= retries:
+                        raise
+            for anno, annotation_id in zip(batch, batch_ids):
+                setattr(anno, staged_annos.UPLOADED_ID_FIELD, annotation_id)
+                setattr(anno, staged_annos.IS_UPLOADED_FIELD, True)
+            ids.extend(batch_ids)
+        return ids
+
+    def get_annotation(self, table_name, annotation_ids, aligned_volume_name=None):
+        annotation_ids = np.atleast_1d(annotation_ids).astype(np.int64)
+        self._cave._request('annotation.get_annotation', len(annotation_ids))
+        with self._cave._lock:
+            table = self._cave._tables[table_name]
+            rows = table.loc[table.id.isin(annotation_ids)]
+        return [{k: (v.tolist() if isinstance(v, np.ndarray) else v)
+                 for k, v in row.items() if isinstance(v, np.ndarray) or not pd.isna(v)}
+                for row in rows.to_dict('records')]
+
+    def delete_annotation(self, table_name, annotation_ids, aligned_volume_name=None):
+        annotation_ids = np.atleast_1d(annotation_ids).astype(np.int64)
+        self._cave._request('annotation.delete_annotation', len(annotation_ids))
+        with self._cave._lock:
+            table = self._cave._tables[table_name]
+            self._cave._tables[table_name] = table.loc[~table.id.isin(annotation_ids)]
+        return annotation_ids.tolist()
+
+
+class _Segmentation(CloudVolumePrecomputed):
+    """
+    The parts of a graphene CloudVolume that `fanc.lookup` uses, reading the
+    emulated segmentation. Cutouts hold supervoxel IDs, in voxels of the
+    viewer resolution.
+    """
+    agglomerate = False
+    progress = False
+
+    def __init__(self, cave):
+        # CloudVolumePrecomputed.__init__ needs a real volume, so skip it
+        self._cave = cave
+
+    @property
+    def scale(self):
+        info = self._cave.datastack_info
+        return {'resolution': [info['viewer_resolution_x'],
+                               info['viewer_resolution_y'],
+                               info['viewer_resolution_z']],
+                'chunk_sizes': [[64, 64, 64]]}
+
+    def __getitem__(self, slices):
+        starts = np.array([s.start for s in slices[:3]], dtype=np.int64)
+        stops = np.array([s.stop for s in slices[:3]], dtype=np.int64)
+        cutout = np.zeros((*(stops - starts), 1), dtype=np.uint64)
+        self._cave._request('segmentation.cutout')
+        with self._cave._lock:
+            points = np.array(list(self._cave._point_to_supervoxel),
+                              dtype=np.int64).reshape(-1, 3)
+            supervoxel_ids = np.array(list(self._cave._point_to_supervoxel.values()),
+                                      dtype=np.uint64)
+        inside = np.all((starts <= points) & (points < stops), axis=1)
+        cutout[tuple((points[inside] - starts).T)] = supervoxel_ids[inside, np.newaxis]
+        return cutout
+
+    def get_roots(self, supervoxel_ids, timestamp=None):
+        return self._cave.chunkedgraph.get_roots(supervoxel_ids, timestamp=timestamp)
+
+
+class CAVEEmulator(object):
+    """
+    An in-memory CAVE deployment. See the module docstring for an example.
+
+    Arguments
+    ---------
+    dataset: str
+        The datastack name to install the emulator as (see `install()`).
+
+    latency: float
+        Seconds each request takes, like a network round trip.
+
+    latency_per_row: float
+        Additional seconds per row sent or returned by a request.
+
+    failure_rate: float
+        Fraction of requests that fail with HTTP 503, to test retries.
+
+    lost_response_rate: float
+        Fraction of annotation posts that are applied but then raise
+        requests.Timeout, as if the response was lost, to test that writes
+        aren't repeated.
+
+    datastack_info: dict or None
+        Entries to override in the emulated datastack info.
+
+    Attributes
+    ----------
+    request_counts: collections.Counter
+        Number of requests made to each endpoint, e.g.
+        'materialize.live_live_query'. Useful to check that a bulk code
+        path makes a constant number of requests.
+    """
+    def __init__(self, dataset=auth.DEFAULT_DATASET, latency=0.0,
+                 latency_per_row=0.0, failure_rate=0.0, lost_response_rate=0.0,
+                 datastack_info=None):
+        self.datastack_name = auth.DATASTACK_NICKNAMES.get(dataset, dataset)
+        self.latency = latency
+        self.latency_per_row = latency_per_row
+        self.failure_rate = failure_rate
+        self.lost_response_rate = lost_response_rate
+        self.datastack_info = {**_default_datastack_info, **(datastack_info or {})}
+        self.request_counts = Counter()
+        self._lock = threading.RLock()
+        self._tables = {}
+        self._fields = {}
+        self._table_metadata = {}
+        self._next_annotation_id = {}
+        self._point_to_supervoxel = {}
+        self._supervoxel_to_root = pd.Series(dtype=np.int64)
+        self._latest_roots = set()
+        self._next_supervoxel_id = _first_supervoxel_id
+        self._next_root_id = _first_root_id
+        self._info = _Info(self)
+        self._auth = _Auth(self)
+        self._schema = _Schema(self)
+        self._chunkedgraph = _Chunkedgraph(self)
+        self._materialize = _Materialize(self)
+        self._annotation = _Annotation(self)
+        self._segmentation = _Segmentation(self)
+
+    # Sub-clients are properties, like in CAVEclient
+    info = property(lambda self: self._info)
+    auth = property(lambda self: self._auth)
+    schema = property(lambda self: self._schema)
+    chunkedgraph = property(lambda self: self._chunkedgraph)
+    materialize = property(lambda self: self._materialize)
+    annotation = property(lambda self: self._annotation)
+
+    def install(self):
+        """Make `auth.get_caveclient()` return this emulator."""
+        auth.install_emulator(self, self.datastack_name)
+        return self
+
+    def uninstall(self):
+        """Make `auth.get_caveclient()` return real CAVE clients again."""
+        auth.uninstall_emulator(self.datastack_name)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    def _request(self, endpoint, n_rows=0):
+        with self._lock:
+            self.request_counts[endpoint] += 1
+        delay = self.latency + self.latency_per_row * n_rows
+        if delay > 0:
+            time.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise _http_error(503, 'Service unavailable (emulated)')
+
+    # --- Segmentation --- #
+    def add_segment(self, points, root_id=None) -> int:
+        """
+        Add a segment made of one supervoxel per given point.
+
+        Arguments
+        ---------
+        points: Nx3 iterable
+            Voxel coordinates that belong to the new segment.
+
+        root_id: int or None
+            The segment's root ID. If None, a new one is generated.
+
+        Returns
+        -------
+        int: The segment's root ID
+        """
+        points = np.array(points, dtype=np.int64).reshape(-1, 3)
+        with self._lock:
+            if root_id is None:
+                root_id = self._new_root_id()
+            supervoxels = np.arange(self._next_supervoxel_id,
+                                    self._next_supervoxel_id + len(points))
+            self._next_supervoxel_id += len(points)
+            for point, supervoxel in zip(map(tuple, points.tolist()), supervoxels):
+                self._point_to_supervoxel[point] = supervoxel
+            self._supervoxel_to_root = pd.concat([
+                self._supervoxel_to_root,
+                pd.Series(root_id, index=supervoxels, dtype=np.int64)])
+            self._latest_roots.add(int(root_id))
+        return int(root_id)
+
+    def _new_root_id(self):
+        root_id = self._next_root_id
+        self._next_root_id += 1
+        return root_id
+
+    def _relabel(self, supervoxels, retired_roots):
+        root_id = self._new_root_id()
+        self._supervoxel_to_root.loc[supervoxels] = root_id
+        self._latest_roots.difference_update(retired_roots)
+        self._latest_roots.add(root_id)
+        return root_id
+
+    def merge(self, root_ids) -> int:
+        """Merge segments into one with a new root ID, which is returned."""
+        with self._lock:
+            supervoxels = self._supervoxel_to_root.index[
+                self._supervoxel_to_root.isin(root_ids)]
+            return self._relabel(supervoxels, root_ids)
+
+    def split(self, root_id, points) -> tuple:
+        """
+        Split the supervoxels at the given points off of a segment. Both parts
+        get new root IDs, which are returned as (split off part, remainder).
+        """
+        with self._lock:
+            split_off = self.supervoxels_at(points)
+            rest = self._supervoxel_to_root.index[
+                (self._supervoxel_to_root == root_id).values
+                & ~np.isin(self._supervoxel_to_root.index, split_off)]
+            return (self._relabel(split_off, [root_id]),
+                    self._relabel(rest, [root_id]))
+
+    def supervoxels_at(self, points) -> np.ndarray:
+        """Supervoxel IDs at the given points, or 0 for unsegmented points."""
+        points = np.array(points, dtype=np.int64).reshape(-1, 3)
+        with self._lock:
+            return np.array([self._point_to_supervoxel.get(point, 0)
+                             for point in map(tuple, points.tolist())],
+                            dtype=np.int64)
+
+    def roots(self, supervoxel_ids) -> np.ndarray:
+        """Current root IDs of the given supervoxels, or 0 for unknown ones."""
+        supervoxel_ids = np.asarray(supervoxel_ids, dtype=np.int64)
+        with self._lock:
+            # Not reindex(), which would go through float64 and lose precision
+            index = self._supervoxel_to_root.index.get_indexer(supervoxel_ids)
+            roots = np.append(self._supervoxel_to_root.values, 0)[index]
+        return roots.astype(np.int64)
+
+    def get_cloudvolume(self):
+        """
+        A stand-in for the segmentation's CloudVolume, which
+        `auth.get_cloudvolume()` returns when this emulator is installed.
+        """
+        return self._segmentation
+
+    # --- Tables --- #
+    def create_table(self, table_name, schema_type=None, fields=None, data=None,
+                     **metadata):
+        """
+        Create an annotation table.
+
+        Arguments
+        ---------
+        table_name: str
+
+        schema_type: str or None
+            One of the schemas in `cave_emulator.schemas`.
+
+        fields: dict or None
+            Field names and types ('str', 'int', 'bool', 'float', 'point' or
+            'bound_point'), for a table whose schema isn't in `schemas`.
+
+        data: pd.DataFrame or list of dicts or None
+            Annotations to add to the table right away.
+
+        Additional keyword arguments are added to the table's metadata.
+        """
+        if fields is None:
+            if schema_type not in schemas:
+                raise ValueError(f'Unknown schema_type "{schema_type}". Give fields'
+                                 f' or use one of {list(schemas)}.')
+            fields = schemas[schema_type]
+        with self._lock:
+            self._fields[table_name] = dict(fields)
+            columns = {'id': pd.Series(dtype=np.int64),
+                       'created': pd.Series(dtype='datetime64[ns, UTC]'),
+                       'valid': pd.Series(dtype=bool)}
+            for field, kind in fields.items():
+                columns[field] = pd.Series(dtype=_dtypes[kind])
+                if kind == 'bound_point':
+                    prefix = field[:-len('_position')]
+                    columns[f'{prefix}_supervoxel_id'] = pd.Series(dtype=np.int64)
+            self._tables[table_name] = pd.DataFrame(columns)
+            self._table_metadata[table_name] = {
+                'table_name': table_name,
+                'schema_type': schema_type,
+                'description': '',
+                'voxel_resolution_x': self.datastack_info['viewer_resolution_x'],
+                'voxel_resolution_y': self.datastack_info['viewer_resolution_y'],
+                'voxel_resolution_z': self.datastack_info['viewer_resolution_z'],
+                'flat_segmentation_source': None,
+                **metadata
+            }
+            self._next_annotation_id[table_name] = 1
+        if data is not None:
+            if isinstance(data, pd.DataFrame):
+                data = data.to_dict('records')
+            self._insert(table_name, data)
+
+    def _insert(self, table_name, rows):
+        if table_name not in self._tables:
+            raise _http_error(404, f'Table "{table_name}" not found')
+        fields = self._fields[table_name]
+        rows = [{k: v for k, v in row.items() if k != 'valid'} for row in rows]
+        for row in rows:
+            unknown = set(row) - set(fields) - {'id'}
+            if unknown:
+                raise _http_error(422, f'Fields {sorted(unknown)} are not in'
+                                       f' the schema of "{table_name}"')
+        new = pd.DataFrame(rows, columns=['id', *fields])
+        with self._lock:
+            table = self._tables[table_name]
+            next_id = self._next_annotation_id[table_name]
+            missing_id = new['id'].isna().values
+            new.loc[missing_id, 'id'] = np.arange(next_id, next_id + missing_id.sum())
+            new['id'] = new['id'].astype(np.int64)
+            if new['id'].duplicated().any() or new['id'].isin(table['id']).any():
+                raise _http_error(409, f'Annotation IDs already exist in "{table_name}"')
+            self._next_annotation_id[table_name] = max(next_id, int(new['id'].max()) + 1)
+            new['created'] = pd.Timestamp.now(tz='UTC')
+            new['valid'] = True
+            for field, kind in fields.items():
+                if kind in ('point', 'bound_point'):
+                    new[field] = [None if p is None else np.asarray(p, dtype=np.int64)
+                                  for p in new[field]]
+                if kind == 'bound_point':
+                    prefix = field[:-len('_position')]
+                    new[f'{prefix}_supervoxel_id'] = self.supervoxels_at(
+                        np.vstack(new[field].values))
+                else:
+                    new[field] = new[field].astype(_dtypes[kind])
+            self._tables[table_name] = pd.concat([table, new[table.columns]],
+                                                 ignore_index=True)
+        return new['id'].tolist()
+
+    def table(self, table_name) -> pd.DataFrame:
+        """A table's current contents, with root IDs, as queries return it."""
+        with self._lock:
+            table = self._tables[table_name].copy()
+            for field, kind in self._fields[table_name].items():
+                if kind == 'bound_point':
+                    prefix = field[:-len('_position')]
+                    table[f'{prefix}_root_id'] = self.roots(
+                        table[f'{prefix}_supervoxel_id'].values)
+        return table
+
+    def _query(self, table_name, filter_in_dict=None, filter_out_dict=None,
+               filter_equal_dict=None, filter_greater_dict=None,
+               filter_less_dict=None, filter_greater_equal_dict=None,
+               filter_less_equal_dict=None, select_columns=None,
+               filter_spatial_dict=None, limit=None):
+        if table_name not in self._tables:
+            raise _http_error(404, f'Table "{table_name}" not found')
+        table = self.table(table_name)
+        keep = np.ones(len(table), dtype=bool)
+        comparisons = [
+            (filter_in_dict, lambda column, value: column.isin(list(value))),
+            (filter_out_dict, lambda column, value: ~column.isin(list(value))),
+            (filter_equal_dict, lambda column, value: column == value),
+            (filter_greater_dict, lambda column, value: column > value),
+            (filter_less_dict, lambda column, value: column < value),
+            (filter_greater_equal_dict, lambda column, value: column >= value),
+            (filter_less_equal_dict, lambda column, value: column <= value),
+        ]
+        for filters, compare in comparisons:
+            if not filters:
+                continue
+            # Filters are given as {table_name: {column: value}} to
+            # live_live_query, and as {column: value} to query_table
+            if table_name in filters and isinstance(filters[table_name], dict):
+                filters = filters[table_name]
+            for column, value in filters.items():
+                if column not in table.columns:
+                    raise _http_error(400, f'Column "{column}" not in "{table_name}"')
+                if isinstance(value, str) and table[column].dtype.name == 'boolean':
+                    value = value.lower() in ('t', 'true')
+                keep &= compare(table[column], value).fillna(False).values.astype(bool)
+        if filter_spatial_dict:
+            if table_name in filter_spatial_dict:
+                filter_spatial_dict = filter_spatial_dict[table_name]
+            for column, box in filter_spatial_dict.items():
+                box = np.asarray(box)
+                points = (np.vstack(table[column].values) if len(table)
+                          else np.zeros((0, 3)))
+                # Like CAVE, points on the box's faces count as inside
+                keep &= np.all((points >= box[0]) & (points <= box[1]), axis=1)
+        table = table.loc[keep].reset_index(drop=True)
+        if limit is not None:
+            table = table.iloc[:limit]
+        if select_columns is not None:
+            if isinstance(select_columns, dict):
+                select_columns = select_columns.get(table_name, list(table.columns))
+            table = table[list(select_columns)]
+        return table
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
+import os
 import json
 import re
+import hashlib
 import warnings
 import sqlite3
+from concurrent import futures
+from datetime import datetime, timezone
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
 
 from . import auth
 
+# To avoid rebuilding synapse count tables, cache them by materialization version
+_synapse_counts = {}
+# Group-to-group connectivity, cached by (materialization version, threshold,
+# fingerprint of the group memberships, fingerprint of the synapses)
+_group_adjacencies = {}
+
 
 def get_synapses(seg_ids,
                  direction='outputs',
@@ -82,6 +94,1477 @@ def get_adj(pre_ids,post_ids,symmetric = False):
     return adj
 
 
+class ConnectomeGraph(object):
+    """
+    An in-memory, weighted, directed graph of neuron-to-neuron connections.
+
+    Neurons (root IDs) are integer-coded as positions in the sorted array
+    `node_ids`, and the connection weights are stored twice as sparse CSR
+    matrices: `outgoing[i, j]` and `incoming[j, i]` are both the number of
+    synapses from node i to node j. This makes walking the graph in either
+    direction equally fast, so k-hop expansions, shortest paths, and degree
+    computations run locally instead of requiring repeated CAVE queries.
+
+    Build one with `ConnectomeGraph.from_synapses()` (from a synapse table
+    like the one returned by `get_synapses()` or `synapse_query()`) or with
+    `ConnectomeGraph.from_adjacency()` (from a matrix like the one returned
+    by `get_adj()`).
+    """
+
+    def __init__(self, pre_ids, post_ids, weights=None):
+        """
+        Arguments
+        ---------
+        pre_ids, post_ids: iterables of ints, length N
+          The presynaptic and postsynaptic root IDs of N edges. Repeated
+          (pre, post) pairs are summed, so passing one row per synapse
+          gives a graph weighted by synapse count.
+
+        weights: iterable of numbers, length N, or None (default)
+          The weight of each edge. If None, each edge has a weight of 1.
+        """
+        pre_ids = np.asarray(pre_ids, dtype=np.int64)
+        post_ids = np.asarray(post_ids, dtype=np.int64)
+        if pre_ids.shape != post_ids.shape:
+            raise ValueError('pre_ids and post_ids must have the same length')
+        if weights is None:
+            weights = np.ones(len(pre_ids), dtype=np.int64)
+        else:
+            weights = np.asarray(weights)
+            if weights.shape != pre_ids.shape:
+                raise ValueError('weights must have the same length as pre_ids')
+
+        self.node_ids = np.unique(np.concatenate([pre_ids, post_ids]))
+        n = len(self.node_ids)
+        self.outgoing = sparse.csr_matrix(
+            (weights, (np.searchsorted(self.node_ids, pre_ids),
+                       np.searchsorted(self.node_ids, post_ids))),
+            shape=(n, n)
+        )
+        self.outgoing.sum_duplicates()
+        self.outgoing.eliminate_zeros()
+        self.incoming = self.outgoing.T.tocsr()
+
+    @classmethod
+    def from_synapses(cls, synapses: pd.DataFrame,
+                      pre_column='pre_pt_root_id',
+                      post_column='post_pt_root_id'):
+        """
+        Build a graph from a table with one row per synapse. The weight of
+        each edge is the number of synapses between the two neurons.
+        """
+        return cls(synapses[pre_column].values, synapses[post_column].values)
+
+    @classmethod
+    def from_adjacency(cls, adj: pd.DataFrame):
+        """
+        Build a graph from an adjacency matrix with presynaptic root IDs as
+        the index and postsynaptic root IDs as the columns, like the one
+        returned by `get_adj()`.
+        """
+        values = adj.values
+        pre_idx, post_idx = np.nonzero(values)
+        return cls(np.asarray(adj.index, dtype=np.int64)[pre_idx],
+                   np.asarray(adj.columns, dtype=np.int64)[post_idx],
+                   weights=values[pre_idx, post_idx])
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return self.outgoing.nnz
+
+    def _find(self, root_ids):
+        """
+        Return the node indices of the given root IDs, and a boolean mask
+        indicating which of them are actually in the graph.
+        """
+        root_ids = np.atleast_1d(np.asarray(root_ids, dtype=np.int64))
+        if len(self.node_ids) == 0:
+            return (np.zeros(len(root_ids), dtype=np.int64),
+                    np.zeros(len(root_ids), dtype=bool))
+        idx = np.searchsorted(self.node_ids, root_ids)
+        idx[idx == len(self.node_ids)] = 0
+        return idx, self.node_ids[idx] == root_ids
+
+    def index_of(self, root_ids) -> np.ndarray:
+        """
+        Convert root IDs to node indices. Raises a KeyError if any of the
+        root IDs are not in the graph.
+        """
+        root_ids = np.atleast_1d(np.asarray(root_ids, dtype=np.int64))
+        idx, found = self._find(root_ids)
+        if not found.all():
+            raise KeyError('These root IDs are not in the graph:'
+                           f' {root_ids[~found].tolist()}')
+        return idx
+
+    def _thresholded(self, matrix, threshold):
+        if threshold is None or threshold <= 1:
+            return matrix
+        matrix = matrix.copy()
+        matrix.data[matrix.data < threshold] = 0
+        matrix.eliminate_zeros()
+        return matrix
+
+    # Per-node statistics
+    def in_degree(self, threshold=1) -> pd.Series:
+        """Number of presynaptic partners of each neuron."""
+        matrix = self._thresholded(self.incoming, threshold)
+        return pd.Series(np.diff(matrix.indptr), index=self.node_ids)
+
+    def out_degree(self, threshold=1) -> pd.Series:
+        """Number of postsynaptic partners of each neuron."""
+        matrix = self._thresholded(self.outgoing, threshold)
+        return pd.Series(np.diff(matrix.indptr), index=self.node_ids)
+
+    def in_weight(self, threshold=1) -> pd.Series:
+        """Total weight (e.g. synapse count) of each neuron's inputs."""
+        matrix = self._thresholded(self.incoming, threshold)
+        return pd.Series(np.asarray(matrix.sum(axis=1)).ravel(),
+                         index=self.node_ids)
+
+    def out_weight(self, threshold=1) -> pd.Series:
+        """Total weight (e.g. synapse count) of each neuron's outputs."""
+        matrix = self._thresholded(self.outgoing, threshold)
+        return pd.Series(np.asarray(matrix.sum(axis=1)).ravel(),
+                         index=self.node_ids)
+
+    # Traversal
+    def _expand(self, matrix, seeds, hops, threshold, include_seeds):
+        matrix = self._thresholded(matrix, threshold)
+        distance = np.full(len(self.node_ids), -1, dtype=np.int64)
+        frontier = np.unique(self.index_of(seeds))
+        distance[frontier] = 0
+        for hop in range(1, hops + 1):
+            if len(frontier) == 0:
+                break
+            neighbors = np.unique(matrix[frontier].indices)
+            frontier = neighbors[distance[neighbors] == -1]
+            distance[frontier] = hop
+        reached = distance > (-1 if include_seeds else 0)
+        return pd.Series(distance[reached], index=self.node_ids[reached],
+                         name='hops')
+
+    def downstream(self, seeds, hops=1, threshold=1,
+                   include_seeds=False) -> pd.Series:
+        """
+        Find all neurons within `hops` synaptic steps downstream of any of
+        the seed neurons.
+
+        Arguments
+        ---------
+        seeds: int or iterable of ints
+          Root ID(s) to start the expansion from.
+
+        hops: int (default 1)
+          Maximum number of synaptic steps to take.
+
+        threshold: int (default 1)
+          Only follow connections with at least this weight.
+
+        include_seeds: bool (default False)
+          Whether to include the seeds themselves (at distance 0) in the result.
+
+        Returns
+        -------
+        pd.Series indexed by root ID, with values giving the minimum number of
+        hops needed to reach each neuron from the seeds.
+        """
+        return self._expand(self.outgoing, seeds, hops, threshold, include_seeds)
+
+    def upstream(self, seeds, hops=1, threshold=1,
+                 include_seeds=False) -> pd.Series:
+        """
+        Find all neurons within `hops` synaptic steps upstream of any of the
+        seed neurons. See `downstream()` for a description of the arguments.
+        """
+        return self._expand(self.incoming, seeds, hops, threshold, include_seeds)
+
+    def shortest_path(self, source: int, target: int,
+                      threshold=1, weighted=True) -> list:
+        """
+        Find the shortest directed path from `source` to `target`.
+
+        Arguments
+        ---------
+        source, target: int
+          Root IDs of the neurons at the start and end of the path.
+
+        threshold: int (default 1)
+          Only follow connections with at least this weight.
+
+        weighted: bool (default True)
+          If True, the length of each connection is 1/weight, so paths
+          through strong connections are preferred. If False, every
+          connection has length 1, so the path with the fewest hops is found.
+
+        Returns
+        -------
+        list of root IDs from source to target (inclusive), or an empty list
+        if target cannot be reached from source.
+        """
+        source_idx, target_idx = self.index_of([source, target])
+        matrix = self._thresholded(self.outgoing, threshold).astype(np.float64)
+        if weighted:
+            matrix.data = 1 / matrix.data
+        else:
+            matrix.data[:] = 1
+        _, predecessors = csgraph.dijkstra(matrix, directed=True,
+                                           indices=source_idx,
+                                           return_predecessors=True)
+        if source_idx != target_idx and predecessors[target_idx] < 0:
+            return []
+        path = [target_idx]
+        while path[-1] != source_idx:
+            path.append(predecessors[path[-1]])
+        return self.node_ids[path[::-1]].tolist()
+
+    def connected_components(self, threshold=1,
+                             connection='weak') -> pd.Series:
+        """
+        Label each neuron by the connected component it belongs to.
+
+        Arguments
+        ---------
+        threshold: int (default 1)
+          Only consider connections with at least this weight.
+
+        connection: 'weak' (default) or 'strong'
+          Whether to find weakly connected components (ignoring edge
+          direction) or strongly connected components.
+
+        Returns
+        -------
+        pd.Series indexed by root ID, with values giving component labels.
+        Labels are ordered by component size, so label 0 is the largest
+        component.
+        """
+        matrix = self._thresholded(self.outgoing, threshold)
+        _, labels = csgraph.connected_components(matrix, directed=True,
+                                                 connection=connection)
+        # Relabel so that the largest component is 0
+        sizes = np.bincount(labels)
+        rank = np.empty_like(sizes)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+        return pd.Series(rank[labels], index=self.node_ids, name='component')
+
+
+class SynapseCounts(object):
+    """
+    A table of per-neuron synapse totals, stored as a sorted array of root
+    IDs and a matching Nx4 array of counts so that lookups of many root IDs
+    at once are a single vectorized `np.searchsorted`.
+
+    The four count columns are:
+    - n_inputs: number of postsynaptic sites on the neuron
+    - n_outputs: number of presynaptic sites on the neuron
+    - n_partners_in: number of distinct presynaptic partner neurons
+    - n_partners_out: number of distinct postsynaptic partner neurons
+
+    Typically you'll get one of these from `get_synapse_counts()`, which
+    builds the table once per materialization version and caches it on disk.
+    """
+    columns = ['n_inputs', 'n_outputs', 'n_partners_in', 'n_partners_out']
+
+    def __init__(self, root_ids, counts,
+                 materialization_version=None, timestamp=None):
+        root_ids = np.asarray(root_ids, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int32).reshape(-1, len(self.columns))
+        order = np.argsort(root_ids, kind='stable')
+        self.root_ids = root_ids[order]
+        self.counts = counts[order]
+        self.materialization_version = materialization_version
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_synapses(cls, synapses: pd.DataFrame,
+                      pre_column='pre_pt_root_id',
+                      post_column='post_pt_root_id',
+                      **kwargs):
+        """
+        Count synapses and partners for every neuron in a synapse table
+        (one row per synapse). Root ID 0 (unsegmented) is not counted as a
+        neuron or as a partner. Additional kwargs are passed to __init__.
+        """
+        pre = synapses[pre_column].values.astype(np.int64)
+        post = synapses[post_column].values.astype(np.int64)
+        root_ids = np.unique(np.concatenate([pre, post]))
+        root_ids = root_ids[root_ids != 0]
+        n = len(root_ids)
+        pre_idx = np.searchsorted(root_ids, pre)
+        post_idx = np.searchsorted(root_ids, post)
+        pre_valid = pre != 0
+        post_valid = post != 0
+
+        counts = np.zeros((n, 4), dtype=np.int32)
+        counts[:, 0] = np.bincount(post_idx[post_valid], minlength=n)
+        counts[:, 1] = np.bincount(pre_idx[pre_valid], minlength=n)
+        # Count distinct partners using unique (pre, post) pairs
+        both_valid = pre_valid & post_valid
+        pairs = np.unique(pre_idx[both_valid] * np.int64(n) + post_idx[both_valid])
+        counts[:, 2] = np.bincount(pairs % n, minlength=n)
+        counts[:, 3] = np.bincount(pairs // n, minlength=n)
+        return cls(root_ids, counts, **kwargs)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        """
+        Count synapses and partners for every neuron in a Parquet synapse
+        snapshot written by `export_synapses_to_parquet()`. The snapshot is
+        read one row group at a time, so only the per-neuron totals and the
+        distinct (pre, post) pairs are held in memory, never the full table.
+        Additional kwargs are passed to __init__.
+        """
+        columns = ['pre_pt_root_id', 'post_pt_root_id']
+        totals = {'pre': [], 'post': []}
+        pairs = []
+        for chunk in _iter_synapse_chunks(snapshot, columns):
+            pre = chunk['pre_pt_root_id'].values.astype(np.int64)
+            post = chunk['post_pt_root_id'].values.astype(np.int64)
+            for side, ids in [('pre', pre), ('post', post)]:
+                totals[side].append(np.unique(ids[ids != 0], return_counts=True))
+            valid = (pre != 0) & (post != 0)
+            pairs.append(np.stack(_count_edges(pre[valid], post[valid])[:2]))
+
+        def summed(side):
+            if not totals[side]:
+                return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+            ids = np.concatenate([t[0] for t in totals[side]])
+            n = np.concatenate([t[1] for t in totals[side]])
+            ids, inverse = np.unique(ids, return_inverse=True)
+            return ids, np.bincount(inverse, weights=n, minlength=len(ids))
+
+        pre_ids, n_outputs = summed('pre')
+        post_ids, n_inputs = summed('post')
+        root_ids = np.union1d(pre_ids, post_ids)
+        n = len(root_ids)
+        counts = np.zeros((n, 4), dtype=np.int32)
+        counts[np.searchsorted(root_ids, post_ids), 0] = n_inputs
+        counts[np.searchsorted(root_ids, pre_ids), 1] = n_outputs
+        # Pairs can repeat across row groups, so deduplicate them globally
+        pairs = np.unique(np.concatenate(pairs, axis=1) if pairs
+                          else np.zeros((2, 0), dtype=np.int64), axis=1)
+        counts[:, 2] = np.bincount(np.searchsorted(root_ids, pairs[1]), minlength=n)
+        counts[:, 3] = np.bincount(np.searchsorted(root_ids, pairs[0]), minlength=n)
+        return cls(root_ids, counts, **kwargs)
+
+    def __len__(self):
+        return len(self.root_ids)
+
+    def _index(self, root_ids):
+        if len(self.root_ids) == 0:
+            return (np.zeros(len(root_ids), dtype=np.int64),
+                    np.zeros(len(root_ids), dtype=bool))
+        idx = np.searchsorted(self.root_ids, root_ids)
+        idx[idx == len(self.root_ids)] = 0
+        return idx, self.root_ids[idx] == root_ids
+
+    def lookup(self, root_ids) -> pd.DataFrame:
+        """
+        Get the synapse counts for the given root IDs. Root IDs that are not
+        in the table (because they have no synapses) get counts of 0.
+
+        Returns
+        -------
+        pd.DataFrame indexed by root ID, with one column per count type
+        """
+        root_ids = np.atleast_1d(np.asarray(root_ids, dtype=np.int64))
+        idx, found = self._index(root_ids)
+        counts = np.zeros((len(root_ids), 4), dtype=np.int32)
+        counts[found] = self.counts[idx[found]]
+        return pd.DataFrame(counts, index=root_ids, columns=self.columns)
+
+    def below_threshold(self, root_ids, threshold,
+                        column='n_inputs') -> np.ndarray:
+        """
+        Return the subset of `root_ids` that have fewer than `threshold`
+        counts in the given column.
+        """
+        counts = self.lookup(root_ids)[column]
+        return counts.index.values[counts.values < threshold]
+
+    def save(self, path):
+        np.savez(path, root_ids=self.root_ids, counts=self.counts,
+                 materialization_version=np.array(
+                     -1 if self.materialization_version is None
+                     else self.materialization_version),
+                 timestamp=np.array(
+                     '' if self.timestamp is None else self.timestamp.isoformat()))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            version = int(data['materialization_version'])
+            timestamp = str(data['timestamp'])
+            return cls(data['root_ids'], data['counts'],
+                       materialization_version=None if version == -1 else version,
+                       timestamp=datetime.fromisoformat(timestamp) if timestamp else None)
+
+    def update(self, timestamp='now', client=None, batch_size=50):
+        """
+        Bring the table up to date by recounting only the neurons that have
+        been edited since this table's timestamp. Neurons that no longer
+        exist are removed, and synapses are queried only for the new
+        neurons that replaced them.
+
+        Synapse totals of unedited neurons are unaffected by edits to other
+        neurons, but their partner counts can shift by a few when a partner
+        is split or merged. Those are only corrected by a full rebuild.
+
+        Returns
+        -------
+        self, updated in place
+        """
+        if self.timestamp is None:
+            raise ValueError('This table has no timestamp, so edits since it'
+                             ' was built cannot be determined.')
+        if client is None:
+            client = auth.get_caveclient()
+        if timestamp in ['now', 'live']:
+            timestamp = datetime.now(timezone.utc)
+
+        old_roots, new_roots = client.chunkedgraph.get_delta_roots(self.timestamp,
+                                                                    timestamp)
+        keep = ~np.isin(self.root_ids, old_roots)
+        new_roots = np.unique(np.asarray(new_roots, dtype=np.int64))
+
+        new_counts = []
+        for i in range(0, len(new_roots), batch_size):
+            batch = new_roots[i:i + batch_size]
+            inputs = client.materialize.synapse_query(post_ids=batch,
+                                                      timestamp=timestamp)
+            outputs = client.materialize.synapse_query(pre_ids=batch,
+                                                       timestamp=timestamp)
+            synapses = pd.concat([inputs, outputs]).drop_duplicates(subset='id')
+            counts = SynapseCounts.from_synapses(synapses).lookup(batch)
+            new_counts.append(counts)
+
+        root_ids = [self.root_ids[keep]]
+        counts = [self.counts[keep]]
+        if new_counts:
+            new_counts = pd.concat(new_counts)
+            root_ids.append(new_counts.index.values)
+            counts.append(new_counts.values)
+        self.__init__(np.concatenate(root_ids), np.concatenate(counts),
+                      materialization_version=self.materialization_version,
+                      timestamp=timestamp)
+        return self
+
+
+def get_synapse_counts(materialization_version=None,
+                       synapses=None,
+                       cache_dir=None,
+                       client=None,
+                       build=True) -> SynapseCounts:
+    """
+    Get the synapse count table for a materialization version. The table is
+    built once per version and then cached both in memory and on disk (as a
+    compact .npz file in `cache_dir`), so later calls return immediately.
+
+    Arguments
+    ---------
+    materialization_version: int or None (default)
+      The materialization version to count synapses for. If None, use the
+      most recent version.
+
+    synapses: pd.DataFrame, str, or None (default)
+      The full synapse table for this materialization version, with columns
+      'pre_pt_root_id' and 'post_pt_root_id', or the directory of a Parquet
+      snapshot of it written by `export_synapses_to_parquet()`. Only used if
+      the counts are not already cached. If None, the synapse table is
+      downloaded from CAVE, which only works for tables small enough to be
+      returned by a single query. A ValueError is raised if the query comes
+      back truncated, so that incomplete counts are never cached.
+
+    cache_dir: str or None (default)
+      Directory to cache count tables in. If None, uses
+      auth.configs['synapse_count_cache'].
+
+    client: caveclient.CAVEclient or None
+
+    build: bool (default True)
+      If False, only return counts that are already cached, and raise a
+      KeyError instead of building them. Useful for callers that must respond
+      quickly and can't afford to query or read the synapse table.
+
+    Returns
+    -------
+    SynapseCounts (see its docstring)
+    """
+    if client is None:
+        client = auth.get_caveclient()
+    if cache_dir is None:
+        cache_dir = auth.configs['synapse_count_cache']
+    if materialization_version is None:
+        materialization_version = client.materialize.most_recent_version()
+
+    key = (client.datastack_name, materialization_version)
+    if key in _synapse_counts:
+        return _synapse_counts[key]
+
+    path = os.path.join(cache_dir, '{}_v{}.npz'.format(*key))
+    if os.path.exists(path):
+        _synapse_counts[key] = SynapseCounts.load(path)
+        return _synapse_counts[key]
+    if not build:
+        raise KeyError('No cached synapse counts for materialization'
+                       f' {materialization_version} of {client.datastack_name}')
+
+    if synapses is None:
+        synapses = client.materialize.query_table(
+            client.info.get_datastack_info()['synapse_table'],
+            select_columns=['id', 'pre_pt_root_id', 'post_pt_root_id'],
+            materialization_version=materialization_version
+        )
+        if len(synapses) >= 200000:
+            raise ValueError('The synapse table query was truncated at'
+                             f' {len(synapses)} rows, so counts would be'
+                             ' incomplete. Pass a Parquet snapshot of the full'
+                             ' table (see export_synapses_to_parquet) via'
+                             ' `synapses` instead.')
+    kwargs = {'materialization_version': materialization_version,
+              'timestamp': client.materialize.get_timestamp(materialization_version)}
+    if isinstance(synapses, pd.DataFrame):
+        counts = SynapseCounts.from_synapses(synapses, **kwargs)
+    else:
+        counts = SynapseCounts.from_snapshot(synapses, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    counts.save(path)
+    _synapse_counts[key] = counts
+    return counts
+
+
+def propagate(graph,
+              seeds,
+              n_steps=6,
+              mode='probabilistic',
+              threshold=1,
+              saturation=0.3,
+              min_activation=0.05,
+              batch_size=100,
+              output_dir=None) -> pd.DataFrame:
+    """
+    Simulate activity spreading through the connectome from sets of seed
+    neurons, and report how many steps it takes to reach every neuron.
+
+    Each connection is weighted by the fraction of the postsynaptic neuron's
+    total input that it provides, so a neuron is strongly driven only if a
+    large fraction of its inputs are active. Many seed sets are simulated
+    at once: they are the columns of a sparse (neurons x seed sets) matrix,
+    so each step is a single sparse matrix-matrix product.
+
+    Arguments
+    ---------
+    graph: ConnectomeGraph, or pd.DataFrame
+      The connectivity to propagate over. A DataFrame can be either a
+      synapse table or an adjacency matrix like the one from `get_adj()`.
+
+    seeds: dict, or iterable of ints
+      A dict mapping names (e.g. sensory class names) to iterables of seed
+      root IDs, to simulate many seed sets in one run. Or a single iterable
+      of seed root IDs, which is treated as {0: seeds}.
+
+    n_steps: int (default 6)
+      Number of propagation steps to simulate.
+
+    mode: 'probabilistic' (default) or 'linear'
+      'probabilistic': a neuron's activation at each step is the fraction of
+        its input coming from active neurons divided by `saturation`, capped
+        at 1. Once activated, neurons stay active.
+      'linear': activation is multiplied by the normalized weight matrix at
+        each step, with no saturation or memory.
+
+    threshold: int (default 1)
+      Only use connections with at least this many synapses.
+
+    saturation: float (default 0.3)
+      In probabilistic mode, the input fraction from active neurons at which
+      a neuron becomes fully active.
+
+    min_activation: float (default 0.05)
+      A neuron counts as reached once its activation is at least this much.
+
+    batch_size: int (default 100)
+      Number of seed sets simulated together. Smaller batches use less memory.
+
+    output_dir: str or None (default)
+      If given, the activation matrix of every step and batch is saved here
+      as a sparse .npz file (step{k}_batch{b}.npz, with rows in the order of
+      node_ids.npy and columns in the order of seed_names.json) as soon as
+      it is computed, rather than being discarded.
+
+    Returns
+    -------
+    pd.DataFrame indexed by root ID with one column per seed set, giving the
+    first step at which each neuron was reached (0 for seeds, NaN if never).
+    """
+    if mode not in ['probabilistic', 'linear']:
+        raise ValueError('mode must be either "probabilistic" or "linear"')
+    if isinstance(graph, pd.DataFrame) and 'pre_pt_root_id' in graph.columns:
+        graph = ConnectomeGraph.from_synapses(graph)
+    elif isinstance(graph, pd.DataFrame):
+        graph = ConnectomeGraph.from_adjacency(graph)
+    if not isinstance(seeds, dict):
+        seeds = {0: seeds}
+    names = list(seeds)
+    n = len(graph)
+
+    # Normalize each neuron's inputs by its total input
+    incoming = graph._thresholded(graph.incoming, threshold).astype(np.float64)
+    totals = np.asarray(incoming.sum(axis=1)).ravel()
+    scale = np.divide(1, totals, out=np.zeros_like(totals), where=totals > 0)
+    normalized = sparse.diags(scale) @ incoming
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        np.save(os.path.join(output_dir, 'node_ids.npy'), graph.node_ids)
+        with open(os.path.join(output_dir, 'seed_names.json'), 'w') as f:
+            json.dump([str(name) for name in names], f)
+
+    layers = np.full((n, len(names)), np.nan, dtype=np.float32)
+    for batch_start in range(0, len(names), batch_size):
+        batch = names[batch_start:batch_start + batch_size]
+        seed_idx = [graph.index_of(seeds[name]) for name in batch]
+        activation = sparse.csr_matrix(
+            (np.ones(sum(len(idx) for idx in seed_idx)),
+             (np.concatenate(seed_idx),
+              np.repeat(np.arange(len(batch)), [len(idx) for idx in seed_idx]))),
+            shape=(n, len(batch))
+        )
+        activation.sum_duplicates()
+        activation.data[:] = 1
+        first_step = np.full((n, len(batch)), -1, dtype=np.int16)
+        first_step[activation.nonzero()] = 0
+
+        for step in range(1, n_steps + 1):
+            new_activation = (normalized @ activation).tocsr()
+            if mode == 'probabilistic':
+                new_activation.data = np.minimum(new_activation.data / saturation, 1)
+                new_activation = new_activation.maximum(activation).tocsr()
+            # Drop negligible values to keep the matrix sparse
+            new_activation.data[new_activation.data < min_activation / 100] = 0
+            new_activation.eliminate_zeros()
+            activation = new_activation
+
+            reached = activation.tocoo()
+            is_active = reached.data >= min_activation
+            rows, cols = reached.row[is_active], reached.col[is_active]
+            is_new = first_step[rows, cols] == -1
+            first_step[rows[is_new], cols[is_new]] = step
+
+            if output_dir is not None:
+                sparse.save_npz(os.path.join(output_dir, f'step{step:03d}_batch'
+                                             f'{batch_start // batch_size:05d}.npz'),
+                                activation)
+            if activation.nnz == 0:
+                break
+
+        layers[:, batch_start:batch_start + len(batch)] = np.where(
+            first_step >= 0, first_step, np.nan)
+
+    return pd.DataFrame(layers, index=graph.node_ids, columns=names)
+
+
+def _group_membership(groups):
+    """
+    Convert a root ID -> group mapping into two parallel arrays of
+    (root_id, group) pairs. A root ID may belong to several groups.
+
+    `groups` can be:
+    - a pd.Series indexed by root ID whose values are group names or lists
+      of group names, like `lookup.all_annotations(group_by_segid=True)`
+    - a pd.DataFrame with 'pt_root_id' and 'tag' columns, like
+      `lookup.all_annotations(group_by_segid=False)`
+    - a dict mapping root IDs to a group name or a list of group names
+    """
+    if isinstance(groups, dict):
+        groups = pd.Series(groups)
+    if isinstance(groups, pd.DataFrame):
+        groups = groups.set_index('pt_root_id')['tag']
+    if not isinstance(groups, pd.Series):
+        raise TypeError(f'Unrecognized type for groups: {type(groups)}')
+    groups = groups.explode().dropna()
+    membership = pd.DataFrame({'root_id': groups.index.values.astype(np.int64),
+                               'group': groups.values}).drop_duplicates()
+    return membership.root_id.values, membership.group.values
+
+
+def _fingerprint(*arrays) -> str:
+    """A hash of the contents of some arrays, for use in cache keys."""
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        digest.update(str((array.dtype, array.shape)).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def get_group_adj(synapses: pd.DataFrame,
+                  groups,
+                  threshold=1,
+                  pre_column='pre_pt_root_id',
+                  post_column='post_pt_root_id',
+                  materialization_version=None,
+                  return_as='table'):
+    """
+    Aggregate neuron-to-neuron connectivity into group-to-group
+    (e.g. cell type to cell type) connectivity.
+
+    Everything is computed with sparse matrix products: if W is the
+    neuron x neuron synapse count matrix and M is the neuron x group
+    membership matrix, the group x group weights are M.T @ W @ M.
+
+    Arguments
+    ---------
+    synapses: pd.DataFrame
+      Synapse table with one row per synapse.
+
+    groups: pd.Series, pd.DataFrame, or dict
+      Mapping from root IDs to groups. A neuron may belong to several groups
+      (for example if it has several annotations), in which case its
+      synapses count towards each of them. Neurons without a group are
+      ignored. See `_group_membership()` for the accepted formats, which
+      include the outputs of `lookup.all_annotations()`.
+
+    threshold: int (default 1)
+      Only count neuron-to-neuron connections with at least this many synapses.
+
+    materialization_version: int or None (default)
+      If given, results are cached in memory under this version together
+      with the threshold and fingerprints of the group memberships and of
+      the synapses (their IDs, or their root IDs if there is no 'id'
+      column), so repeated calls with the same inputs return immediately.
+      Only pass this if `synapses` and `groups` both come from this
+      materialization.
+
+    return_as: 'table' (default) or 'sparse'
+      Controls output format, see Returns section below
+
+    Returns
+    -------
+    If return_as == 'table':
+      pd.DataFrame with one row per connected (pre_group, post_group) pair and
+      columns 'weight' (total synapses), 'n_connections' (number of connected
+      neuron pairs) and 'mean_weight' (weight / n_connections), sorted by weight.
+    If return_as == 'sparse':
+      3-tuple of (group_names, weights, n_connections), where the latter two
+      are scipy.sparse.csr_matrix of shape (n_groups, n_groups) indexed in
+      the order of group_names.
+    """
+    if return_as not in ['table', 'sparse']:
+        raise ValueError('return_as must be either "table" or "sparse"')
+    member_ids, member_groups = _group_membership(groups)
+    group_names, group_codes = np.unique(member_groups.astype(str),
+                                         return_inverse=True)
+
+    cache_key = None
+    if materialization_version is not None:
+        order = np.lexsort((group_codes, member_ids))
+        synapse_columns = (['id'] if 'id' in synapses.columns
+                           else [pre_column, post_column])
+        cache_key = (materialization_version, threshold,
+                     _fingerprint(group_names, member_ids[order], group_codes[order]),
+                     _fingerprint(*[synapses[c].values for c in synapse_columns]))
+    if cache_key in _group_adjacencies:
+        group_names, weights, counts = _group_adjacencies[cache_key]
+    else:
+        graph = ConnectomeGraph.from_synapses(synapses, pre_column=pre_column,
+                                              post_column=post_column)
+        adj = graph._thresholded(graph.outgoing, threshold)
+
+        # Drop memberships of neurons that have no synapses in the table
+        idx, in_graph = graph._find(member_ids)
+        membership = sparse.csr_matrix(
+            (np.ones(in_graph.sum(), dtype=np.int64),
+             (idx[in_graph], group_codes[in_graph])),
+            shape=(len(graph), len(group_names))
+        )
+        weights = (membership.T @ adj @ membership).tocsr()
+        connected = adj.copy()
+        connected.data[:] = 1
+        counts = (membership.T @ connected @ membership).tocsr()
+        if cache_key is not None:
+            _group_adjacencies[cache_key] = (group_names, weights, counts)
+
+    if return_as == 'sparse':
+        return group_names, weights, counts
+
+    weights = weights.tocoo()
+    table = pd.DataFrame({
+        'pre_group': group_names[weights.row],
+        'post_group': group_names[weights.col],
+        'weight': weights.data,
+        'n_connections': np.asarray(counts[weights.row, weights.col]).ravel()
+    })
+    table['mean_weight'] = table['weight'] / table['n_connections']
+    return table.sort_values('weight', ascending=False, kind='stable').reset_index(drop=True)
+
+
+# Columns of synapse tables that hold IDs, and how to encode them in Parquet.
+# Root IDs repeat a lot (every synapse of a neuron), so dictionary-encode
+# them; supervoxel and synapse IDs are nearly unique but numerically close
+# together within a sorted row group, so delta-encode them.
+_parquet_dictionary_columns = ['pre_pt_root_id', 'post_pt_root_id']
+_parquet_delta_columns = ['id', 'pre_pt_supervoxel_id', 'post_pt_supervoxel_id']
+
+
+def _split_positions(synapses: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replace each column of xyz point coordinates (e.g. 'pre_pt_position')
+    with three int32 columns (e.g. 'pre_pt_position_x', ..._y, ..._z), the
+    same naming used by CAVE queries with split_positions=True. Points may
+    be arrays or, as in a synapse table read from CSV, strings like
+    '[1 2 3]' or '(1, 2, 3)'.
+    """
+    synapses = synapses.copy()
+    for column in [c for c in synapses.columns if c.endswith('_position')]:
+        values = synapses[column].values
+        if len(values) > 0 and isinstance(values[0], str):
+            values = [re.findall(r'-?\d+', value) for value in values]
+        points = np.vstack(values).astype(np.int32)
+        position = synapses.columns.get_loc(column)
+        synapses.drop(columns=column, inplace=True)
+        for i, axis in enumerate('xyz'):
+            synapses.insert(position + i, f'{column}_{axis}', points[:, i])
+    return synapses
+
+
+def _merge_positions(synapses: pd.DataFrame) -> pd.DataFrame:
+    """Undo `_split_positions()`."""
+    for column in [c[:-2] for c in synapses.columns if c.endswith('_position_x')]:
+        axes = [f'{column}_{axis}' for axis in 'xyz']
+        if not all(axis in synapses.columns for axis in axes):
+            continue
+        position = synapses.columns.get_loc(axes[0])
+        points = synapses[axes].values
+        synapses = synapses.drop(columns=axes)
+        synapses.insert(position, column, list(points))
+    return synapses
+
+
+def export_synapses_to_parquet(synapses,
+                               directory,
+                               materialization_version=None,
+                               row_group_size=100_000,
+                               rows_per_file=10_000_000):
+    """
+    Write a synapse table to a directory of Parquet files designed for fast
+    filtered reads with `read_synapses_parquet()`:
+    - Rows are sorted by presynaptic root ID, so each row group covers a
+      narrow range of pre_pt_root_id values and has min/max statistics
+      that readers can use to skip irrelevant row groups.
+    - Point coordinates are stored as int32 x/y/z columns.
+    - Root IDs are dictionary-encoded and supervoxel/synapse IDs are
+      delta-encoded, which keeps files compact.
+
+    Arguments
+    ---------
+    synapses: pd.DataFrame, or iterable of pd.DataFrames
+      The synapse table, for example as returned by a CAVE query for one
+      materialization version. To export a table too large to fit in
+      memory, pass an iterable of chunks (for example
+      `pd.read_csv(fname, chunksize=...)`, whose point columns are parsed
+      from strings). Each chunk is sorted and written as its own file(s)
+      without merging across chunks, so the files' pre_pt_root_id ranges
+      overlap. Reads are still correct, but a read for one neuron may touch
+      a row group in every file. Presort the table by pre_pt_root_id (or
+      pass chunks covering disjoint ranges of it) to avoid this.
+
+    directory: str
+      Directory to write Parquet files into. Will be created if needed.
+
+    materialization_version: int or None
+      Stored in each file's metadata to record where the data came from.
+
+    row_group_size: int (default 100,000)
+      Number of rows per row group. Smaller row groups make single-neuron
+      reads touch less data, at the cost of slightly larger files.
+
+    rows_per_file: int (default 10,000,000)
+      Maximum number of rows per file.
+
+    Returns
+    -------
+    list of the paths of the files written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq  # pip install pyarrow
+
+    if isinstance(synapses, pd.DataFrame):
+        synapses = [synapses]
+    os.makedirs(directory, exist_ok=True)
+    metadata = {'materialization_version': str(materialization_version)}
+
+    paths = []
+    for chunk in synapses:
+        chunk = _split_positions(chunk)
+        for column in _parquet_dictionary_columns + _parquet_delta_columns:
+            if column in chunk.columns:
+                chunk[column] = chunk[column].astype(np.int64)
+        sort_by = [c for c in ['pre_pt_root_id', 'post_pt_root_id']
+                   if c in chunk.columns]
+        chunk = chunk.sort_values(sort_by, kind='stable').reset_index(drop=True)
+        for start in range(0, len(chunk), rows_per_file):
+            table = pa.Table.from_pandas(chunk.iloc[start:start + rows_per_file],
+                                         preserve_index=False)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   **metadata})
+            path = os.path.join(directory, f'part-{len(paths):05d}.parquet')
+            pq.write_table(
+                table, path,
+                row_group_size=row_group_size,
+                use_dictionary=[c for c in _parquet_dictionary_columns
+                                if c in table.column_names],
+                column_encoding={c: 'DELTA_BINARY_PACKED'
+                                 for c in _parquet_delta_columns
+                                 if c in table.column_names},
+                compression='zstd',
+                write_statistics=True
+            )
+            paths.append(path)
+    return paths
+
+
+def _select_row_groups(parquet_file, filters: dict) -> list:
+    """
+    Given a pyarrow.parquet.ParquetFile and a dict mapping column names to
+    sorted arrays of requested values, return the indices of the row groups
+    whose min/max statistics show they may contain a requested value in
+    every filtered column.
+    """
+    metadata = parquet_file.metadata
+    keep = np.ones(metadata.num_row_groups, dtype=bool)
+    for column, values in filters.items():
+        column_index = parquet_file.schema_arrow.get_field_index(column)
+        if column_index == -1:
+            raise ValueError(f'Column "{column}" not found in {parquet_file}')
+        for i in np.nonzero(keep)[0]:
+            stats = metadata.row_group(i).column(column_index).statistics
+            if stats is None or not stats.has_min_max:
+                continue
+            first = np.searchsorted(values, stats.min)
+            keep[i] = first < len(values) and values[first] <= stats.max
+    return np.nonzero(keep)[0].tolist()
+
+
+def read_synapses_parquet(directory,
+                          pre_ids=None,
+                          post_ids=None,
+                          columns=None,
+                          merge_positions=True) -> pd.DataFrame:
+    """
+    Read synapses from a Parquet snapshot written by
+    `export_synapses_to_parquet()`, reading only the row groups that can
+    contain the requested neurons.
+
+    Arguments
+    ---------
+    directory: str
+      Directory containing the Parquet files.
+
+    pre_ids, post_ids: int, iterable of ints, or None (default)
+      If given, only return synapses from these presynaptic neurons and/or
+      onto these postsynaptic neurons. Filtering on pre_ids is the fastest
+      because the files are sorted by presynaptic root ID.
+
+    columns: list of str or None (default)
+      Columns to read. If None, read all columns.
+
+    merge_positions: bool (default True)
+      Whether to combine x/y/z coordinate columns back into one column of
+      points per position (e.g. 'pre_pt_position'), as in CAVE query results.
+
+    Returns
+    -------
+    pd.DataFrame of synapses
+    """
+    import pyarrow.parquet as pq  # pip install pyarrow
+
+    filters = {}
+    for column, ids in [('pre_pt_root_id', pre_ids), ('post_pt_root_id', post_ids)]:
+        if ids is not None:
+            filters[column] = np.unique(np.atleast_1d(np.asarray(ids, dtype=np.int64)))
+    if columns is not None:
+        columns = list(columns) + [c for c in filters if c not in columns]
+
+    paths = sorted(os.path.join(directory, fn) for fn in os.listdir(directory)
+                   if fn.endswith('.parquet'))
+    if not paths:
+        raise FileNotFoundError(f'No .parquet files found in {directory}')
+    tables = []
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        row_groups = _select_row_groups(parquet_file, filters)
+        if row_groups:
+            tables.append(parquet_file.read_row_groups(row_groups,
+                                                       columns=columns).to_pandas())
+    if tables:
+        result = pd.concat(tables, ignore_index=True)
+    else:
+        result = pq.read_schema(paths[0]).empty_table().to_pandas()
+        if columns is not None:
+            result = result[columns]
+
+    for column, ids in filters.items():
+        result = result.loc[result[column].isin(ids)]
+    result = result.reset_index(drop=True)
+    if merge_positions:
+        result = _merge_positions(result)
+    return result
+
+
+def _split_box(box, min_box_size):
+    """
+    Split a bounding box [[xmin, ymin, zmin], [xmax, ymax, zmax]] in half
+    along every axis that is at least twice as long as min_box_size, giving
+    up to 8 sub-boxes (an octree split). Returns [] if no axis can be split.
+    """
+    box = np.asarray(box, dtype=np.int64)
+    splittable = (box[1] - box[0]) >= 2 * np.asarray(min_box_size)
+    if not splittable.any():
+        return []
+    mid = (box[0] + box[1]) // 2
+    edges = [[(box[0][i], mid[i]), (mid[i], box[1][i])] if splittable[i]
+             else [(box[0][i], box[1][i])] for i in range(3)]
+    return [np.array([[x[0], y[0], z[0]], [x[1], y[1], z[1]]])
+            for x in edges[0] for y in edges[1] for z in edges[2]]
+
+
+def get_synapses_in_box(bounding_box,
+                        output_path=None,
+                        position_column='post_pt_position',
+                        materialization_version=None,
+                        max_rows=200000,
+                        min_box_size=(256, 256, 16),
+                        max_workers=8,
+                        client=None):
+    """
+    Get every synapse within a bounding box, however large.
+
+    The box is queried as tiles of an adaptive octree: tiles are queried
+    concurrently, and any tile whose query returns `max_rows` rows (meaning
+    the server truncated the result) is split into up to 8 sub-tiles that
+    are queried in turn. Synapses that lie exactly on a border between
+    tiles are returned by both tiles' queries, so rows on tile borders are
+    deduplicated by synapse ID.
+
+    Arguments
+    ---------
+    bounding_box: 2x3 iterable
+      [[xmin, ymin, zmin], [xmax, ymax, zmax]] in voxel coordinates.
+
+    output_path: str or None (default)
+      If given, results are streamed to a Parquet file at this path as tiles
+      finish (with point coordinates stored as int32 x/y/z columns) instead
+      of being held in memory.
+
+    position_column: str (default 'post_pt_position')
+      Which synapse point must fall within the box.
+
+    materialization_version: int or None (default)
+      The materialization version to query. All tiles use the same version,
+      so results are consistent. If None, use the most recent version.
+
+    max_rows: int (default 200000)
+      Row limit for each query. A tile that returns this many rows is
+      considered saturated and is subdivided.
+
+    min_box_size: 3-length iterable (default (256, 256, 16))
+      Tiles are never split smaller than this. If a tile this small is still
+      saturated, a warning is issued and its synapses will be incomplete.
+
+    max_workers: int (default 8)
+      Number of tiles to query concurrently.
+
+    client: caveclient.CAVEclient or None
+
+    Returns
+    -------
+    If output_path is None: pd.DataFrame of synapses
+    Otherwise: int, the number of synapses written to output_path
+    """
+    if client is None:
+        client = auth.get_caveclient()
+    if materialization_version is None:
+        materialization_version = client.materialize.most_recent_version()
+    synapse_table = client.info.get_datastack_info()['synapse_table']
+
+    def query_tile(box):
+        return client.materialize.query_table(
+            synapse_table,
+            filter_spatial_dict={synapse_table: {position_column: box.tolist()}},
+            materialization_version=materialization_version,
+            limit=max_rows
+        )
+
+    writer = None
+    results = []
+    n_rows = 0
+    border_ids = set()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+            pending = {ex.submit(query_tile, box): box for box in
+                       [np.asarray(bounding_box, dtype=np.int64)]}
+            while pending:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    box = pending.pop(future)
+                    tile = future.result()
+                    if len(tile) >= max_rows:
+                        sub_boxes = _split_box(box, min_box_size)
+                        if sub_boxes:
+                            for sub_box in sub_boxes:
+                                pending[ex.submit(query_tile, sub_box)] = sub_box
+                            continue
+                        warnings.warn(f'Tile {box.tolist()} is saturated but too'
+                                      ' small to split, so some synapses in it'
+                                      ' are missing. Reduce min_box_size.')
+
+                    # Only synapses on a tile's faces can be returned twice
+                    if len(tile):
+                        points = np.vstack(tile[position_column].values)
+                        on_border = ((points == box[0]) | (points == box[1])).any(axis=1)
+                        is_duplicate = np.zeros(len(tile), dtype=bool)
+                        for i in np.nonzero(on_border)[0]:
+                            synapse_id = tile['id'].iat[i]
+                            is_duplicate[i] = synapse_id in border_ids
+                            border_ids.add(synapse_id)
+                        tile = tile.loc[~is_duplicate]
+                    if len(tile) == 0:
+                        continue
+
+                    n_rows += len(tile)
+                    if output_path is None:
+                        results.append(tile)
+                        continue
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq  # pip install pyarrow
+                    table = pa.Table.from_pandas(_split_positions(tile),
+                                                 preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(output_path, table.schema,
+                                                  compression='zstd')
+                    writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if output_path is not None:
+        return n_rows
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
+
+
+def _count_edges(pre, post, weights=None):
+    """
+    Sum weights over repeated (pre, post) pairs. Returns three arrays
+    (pre, post, weight) sorted by pre then post.
+    """
+    pre = np.asarray(pre, dtype=np.int64)
+    post = np.asarray(post, dtype=np.int64)
+    weights = (np.ones(len(pre), dtype=np.int64) if weights is None
+               else np.asarray(weights))
+    if len(pre) == 0:
+        return pre, post, weights
+    order = np.lexsort((post, pre))
+    pre, post, weights = pre[order], post[order], weights[order]
+    starts = np.nonzero(np.r_[True, (pre[1:] != pre[:-1]) |
+                                    (post[1:] != post[:-1])])[0]
+    return pre[starts], post[starts], np.add.reduceat(weights, starts)
+
+
+def _iter_synapse_chunks(snapshot, columns):
+    """
+    Yield a synapse snapshot in chunks containing the given columns. A
+    Parquet snapshot (a directory path) is read one row group at a time,
+    so memory use is bounded by the row group size.
+    """
+    if isinstance(snapshot, pd.DataFrame):
+        yield snapshot[columns]
+        return
+    import pyarrow.parquet as pq  # pip install pyarrow
+    for fn in sorted(os.listdir(snapshot)):
+        if not fn.endswith('.parquet'):
+            continue
+        parquet_file = pq.ParquetFile(os.path.join(snapshot, fn))
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i, columns=columns).to_pandas()
+
+
+def _supervoxel_root_map(snapshot):
+    """
+    Return two parallel arrays (sorted supervoxel IDs, root IDs) listing the
+    root ID of every supervoxel that has a synapse in the snapshot.
+    """
+    columns = ['pre_pt_supervoxel_id', 'pre_pt_root_id',
+               'post_pt_supervoxel_id', 'post_pt_root_id']
+    svids, roots = [], []
+    for chunk in _iter_synapse_chunks(snapshot, columns):
+        for side in ['pre', 'post']:
+            sv = chunk[f'{side}_pt_supervoxel_id'].values.astype(np.int64)
+            sv, idx = np.unique(sv, return_index=True)
+            svids.append(sv)
+            roots.append(chunk[f'{side}_pt_root_id'].values[idx].astype(np.int64))
+    svids = np.concatenate(svids)
+    svids, idx = np.unique(svids, return_index=True)
+    return svids, np.concatenate(roots)[idx]
+
+
+def _relabel(ids, keys, values):
+    """
+    Return a copy of `ids` with each ID found in the sorted array `keys`
+    replaced by the corresponding entry of `values`.
+    """
+    ids = np.array(ids, dtype=np.int64)
+    if len(keys) == 0 or len(ids) == 0:
+        return ids
+    idx = np.searchsorted(keys, ids)
+    idx[idx == len(keys)] = 0
+    found = keys[idx] == ids
+    ids[found] = values[idx[found]]
+    return ids
+
+
+def _iter_snapshot_edges(snapshot, supervoxel_map=None, lineage=None):
+    """
+    Yield a synapse snapshot as a series of sorted (pre, post, weight) edge
+    arrays, one per chunk of the snapshot, optionally relabeling root IDs by
+    supervoxel (using `supervoxel_map`, from `_supervoxel_root_map()` on
+    another snapshot) or by an explicit mapping (`lineage`, a pair of arrays
+    of sorted old roots and new roots). The same edge may appear in several
+    chunks.
+    """
+    if isinstance(snapshot, ConnectomeGraph):
+        edges = snapshot.outgoing.tocoo()
+        chunks = [(snapshot.node_ids[edges.row], snapshot.node_ids[edges.col],
+                   edges.data, None, None)]
+    else:
+        columns = ['pre_pt_root_id', 'post_pt_root_id']
+        if supervoxel_map is not None:
+            columns += ['pre_pt_supervoxel_id', 'post_pt_supervoxel_id']
+        chunks = ((chunk['pre_pt_root_id'].values, chunk['post_pt_root_id'].values,
+                   None,
+                   chunk.get('pre_pt_supervoxel_id'),
+                   chunk.get('post_pt_supervoxel_id'))
+                  for chunk in _iter_synapse_chunks(snapshot, columns))
+
+    for pre, post, weights, pre_sv, post_sv in chunks:
+        pre = np.asarray(pre, dtype=np.int64)
+        post = np.asarray(post, dtype=np.int64)
+        if lineage is not None:
+            pre = _relabel(pre, *lineage)
+            post = _relabel(post, *lineage)
+        if supervoxel_map is not None:
+            svids, roots = supervoxel_map
+            # Synapses whose supervoxel isn't in the new snapshot keep their
+            # old root ID, so they'll be reported as removed
+            found = np.isin(pre_sv, svids)
+            pre = np.where(found, _relabel(pre_sv, svids, roots), pre)
+            found = np.isin(post_sv, svids)
+            post = np.where(found, _relabel(post_sv, svids, roots), post)
+        yield _count_edges(pre, post, weights)
+
+
+def _merge_edges(edges):
+    """
+    Combine an iterable of (pre, post, weight) edge arrays into one sorted
+    set of edge arrays, summing the weights of edges that appear repeatedly.
+    """
+    edges = list(edges)
+    if not edges:
+        return _count_edges([], [])
+    return _count_edges(*[np.concatenate(arrays) for arrays in zip(*edges)])
+
+
+def _edge_partition(pre, partitions):
+    """
+    Assign each presynaptic root ID to one of `partitions` partitions. The
+    IDs are hashed first so that partitions stay balanced regardless of how
+    root IDs are laid out.
+    """
+    hashed = pre.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return (hashed >> np.uint64(32)) % np.uint64(partitions)
+
+
+def _spill_edges(edges, directory, partitions):
+    """
+    Write an iterable of (pre, post, weight) edge arrays to one file per
+    partition of presynaptic root IDs in `directory`, so that each partition
+    can later be read back on its own with `_read_spilled_edges()`. Returns
+    the list of file paths.
+    """
+    paths = [os.path.join(directory, f'edges-{i:05d}.npy')
+             for i in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for pre, post, weight in edges:
+            partition = _edge_partition(pre, partitions)
+            for i in np.unique(partition):
+                selected = partition == i
+                for array in [pre, post, weight]:
+                    np.save(files[i], array[selected])
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def _read_spilled_edges(path):
+    """Read back one partition written by `_spill_edges()`."""
+    size = os.path.getsize(path)
+    pieces = []
+    with open(path, 'rb') as f:
+        while f.tell() < size:
+            pieces.append(tuple(np.load(f) for _ in range(3)))
+    return _merge_edges(pieces)
+
+
+def _diff_edges(old_edges, new_edges, min_change):
+    """
+    Compare two sorted sets of (pre, post, weight) edge arrays and return a
+    DataFrame in the format returned by `diff_connectivity()`.
+    """
+    old_pre, old_post, old_weight = old_edges
+    new_pre, new_post, new_weight = new_edges
+
+    # Sorted merge: stack both edge lists, sort by (pre, post, snapshot), and
+    # look for consecutive rows with the same key from the two snapshots
+    pre = np.concatenate([old_pre, new_pre])
+    post = np.concatenate([old_post, new_post])
+    weight = np.concatenate([old_weight, new_weight])
+    is_new = np.repeat([False, True], [len(old_pre), len(new_pre)])
+    order = np.lexsort((is_new, post, pre))
+    pre, post, weight, is_new = pre[order], post[order], weight[order], is_new[order]
+
+    matched = np.zeros(len(pre), dtype=bool)
+    pair_start = np.nonzero((pre[1:] == pre[:-1]) & (post[1:] == post[:-1]))[0]
+    matched[pair_start] = matched[pair_start + 1] = True
+
+    added = is_new & ~matched
+    removed = ~is_new & ~matched
+    reweighted = pair_start[np.abs(weight[pair_start + 1] - weight[pair_start]) >= min_change]
+
+    return pd.concat([
+        pd.DataFrame({'pre_pt_root_id': pre[added], 'post_pt_root_id': post[added],
+                      'old_weight': 0, 'new_weight': weight[added],
+                      'change': 'added'}),
+        pd.DataFrame({'pre_pt_root_id': pre[removed], 'post_pt_root_id': post[removed],
+                      'old_weight': weight[removed], 'new_weight': 0,
+                      'change': 'removed'}),
+        pd.DataFrame({'pre_pt_root_id': pre[reweighted],
+                      'post_pt_root_id': post[reweighted],
+                      'old_weight': weight[reweighted],
+                      'new_weight': weight[reweighted + 1],
+                      'change': 'reweighted'}),
+    ], ignore_index=True)
+
+
+def diff_connectivity(old_snapshot,
+                      new_snapshot,
+                      lineage='supervoxel',
+                      min_change=1,
+                      partitions=None) -> pd.DataFrame:
+    """
+    Compare the neuron-to-neuron connectivity of two synapse snapshots (for
+    example, two materialization versions) and report which connections
+    were added, removed, or changed weight.
+
+    Connections are reduced to sorted (pre, post) integer keys and compared
+    with a vectorized sorted-merge. To bound memory use, each snapshot is
+    read once, one Parquet row group at a time, and its connections are
+    spilled to temporary files partitioned by a hash of the presynaptic root
+    ID. The partitions are then compared one at a time, so only one
+    partition of each snapshot's connection list is in memory at once. For
+    lineage='supervoxel', the root ID of every supervoxel with a synapse in
+    `new_snapshot` is also held in memory while the old snapshot is read.
+
+    Arguments
+    ---------
+    old_snapshot, new_snapshot: pd.DataFrame, str, or ConnectomeGraph
+      A synapse table (e.g. from a CAVE query), the path to a directory of
+      Parquet files written by `export_synapses_to_parquet()`, or a
+      ConnectomeGraph.
+
+    lineage: 'supervoxel' (default), dict/pd.Series, or None
+      How to match up root IDs that changed between snapshots, so that
+      neurons that merely received a new root ID (for example because of an
+      edit somewhere else on the neuron) don't show up as churn.
+      'supervoxel': relabel each synapse in the old snapshot with the root ID
+        that its supervoxel has in the new snapshot. Requires both snapshots
+        to be synapse tables with supervoxel ID columns.
+      dict or pd.Series: an explicit mapping of old root IDs to new root IDs.
+      None: compare root IDs as they are.
+
+    min_change: int (default 1)
+      Only report reweighted connections whose weight changed by at least
+      this many synapses.
+
+    partitions: int or None (default)
+      Number of partitions to split the connections into. More partitions
+      use less memory at the cost of more temporary files. If None, use 64
+      when either snapshot is a Parquet directory, and otherwise compare
+      everything in memory at once (1 partition), since in-memory inputs
+      are already loaded anyway.
+
+    Returns
+    -------
+    pd.DataFrame with columns 'pre_pt_root_id', 'post_pt_root_id',
+    'old_weight', 'new_weight' and 'change' (one of 'added', 'removed',
+    'reweighted'), sorted by pre then post root ID.
+    """
+    supervoxel_map = None
+    if isinstance(lineage, str):
+        if lineage != 'supervoxel':
+            raise ValueError('lineage must be "supervoxel", a mapping, or None')
+        if isinstance(new_snapshot, ConnectomeGraph) or \
+                isinstance(old_snapshot, ConnectomeGraph):
+            raise ValueError('lineage="supervoxel" requires synapse tables,'
+                             ' not ConnectomeGraphs.')
+        supervoxel_map = _supervoxel_root_map(new_snapshot)
+        lineage = None
+    elif lineage is not None:
+        lineage = pd.Series(lineage).sort_index()
+        lineage = (lineage.index.values.astype(np.int64),
+                   lineage.values.astype(np.int64))
+    if partitions is None:
+        partitions = 64 if any(isinstance(snapshot, str) for snapshot in
+                               [old_snapshot, new_snapshot]) else 1
+    if partitions < 1:
+        raise ValueError('partitions must be a positive integer')
+
+    old_edges = _iter_snapshot_edges(old_snapshot,
+                                     supervoxel_map=supervoxel_map,
+                                     lineage=lineage)
+    new_edges = _iter_snapshot_edges(new_snapshot)
+    if partitions == 1:
+        diffs = [_diff_edges(_merge_edges(old_edges), _merge_edges(new_edges),
+                             min_change)]
+    else:
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'old'))
+            os.mkdir(os.path.join(directory, 'new'))
+            old_paths = _spill_edges(old_edges, os.path.join(directory, 'old'),
+                                     partitions)
+            # Only needed while reading the old snapshot
+            del supervoxel_map
+            new_paths = _spill_edges(new_edges, os.path.join(directory, 'new'),
+                                     partitions)
+            diffs = [_diff_edges(_read_spilled_edges(old_path),
+                                 _read_spilled_edges(new_path),
+                                 min_change)
+                     for old_path, new_path in zip(old_paths, new_paths)]
+
+    diff = pd.concat(diffs, ignore_index=True)
+    return diff.sort_values(['pre_pt_root_id', 'post_pt_root_id'],
+                            kind='stable').reset_index(drop=True)
+
+
 def get_partner_synapses_csv(root_id, 
                              df, 
                              direction='inputs', 
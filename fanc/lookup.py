@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import re
+import threading
 import collections
 from concurrent import futures
 from datetime import datetime
@@ -37,6 +38,17 @@ default_anchor_point_sources = [
 default_svid_lookup_url = '<not implemented>'
 allow_missing_lookups = False
 
+# Annotations uploaded or deleted by this process are remembered for this
+# many seconds, so that lookups see them even if the server doesn't yet
+recent_upload_ttl = 600
+# {(table_name, root_id): [row dict, ...]}
+_recent_uploads = {}
+# {(table_name, annotation_id): time deleted}
+_recent_deletions = {}
+# Guards the two dicts above, which e.g. upload.UploadQueue's worker thread
+# updates while other threads run lookups
+_recent_writes_lock = threading.RLock()
+
 
 # --- START CAVE TABLES / ANNOTATIONS SECTION --- #
 def proofreading_status(segids: int or list[int],
@@ -130,6 +142,7 @@ def cells_annotated_with(tags: str or list[str],
                          source_tables=default_annotation_sources,
                          timestamp='now',
                          return_as: Literal['list', 'url'] = 'list',
+                         include_subclasses=False,
                          raise_not_found=True):
     """
     Get all the cells annotated with a given text tag / all of the given text
@@ -169,6 +182,13 @@ def cells_annotated_with(tags: str or list[str],
     return_as: 'list' (default) OR 'url'
       Controls output format, see Returns section below
 
+    include_subclasses: bool (default False)
+      If True, a cell matches a tag if it is annotated with that tag or with
+      any of its subclasses in the annotation hierarchy (see
+      `annotations.subclasses()`). For example, 'sensory neuron' would also
+      match cells annotated with 'photoreceptor neuron' or 'R7'. This also
+      applies to exclude_tags.
+
     Returns
     -------
     If return_as == 'list':
@@ -197,22 +217,54 @@ def cells_annotated_with(tags: str or list[str],
     annos = all_annotations(source_tables=source_tables,
                             timestamp=timestamp,
                             group_by_segid=False)
-    is_invalid = [tag not in annos.tag.unique() for tag in tags]
+    segids = annos.pt_root_id.values
+    if include_subclasses:
+        from . import annotations
+        pairs = pd.MultiIndex.from_arrays([annos.tag2, annos.tag])
+        segid_tag2 = pd.MultiIndex.from_arrays([segids, annos.tag2])
+
+    def annotated_with(tag):
+        # Segment IDs annotated with the tag or, if requested, its subclasses
+        is_tag = (annos.tag == tag).values
+        if not include_subclasses:
+            return np.unique(segids[is_tag])
+        # A term can sit under several parents, so follow each segment's own
+        # chain of (annotation_class, annotation) pairs down from the tag
+        # rather than matching the subclass terms on their own. This way
+        # 'innervates T1 leg' doesn't match a cell annotated
+        # 'innervates T2 leg: innervates coxa'.
+        below = pairs.isin(list(annotations.subclass_pairs(tag)))
+        matched = is_tag | (below & (annos.tag2 == tag).values)
+        while True:
+            reached = pd.MultiIndex.from_arrays([segids[matched],
+                                                 annos.tag[matched]])
+            newly_matched = below & ~matched & segid_tag2.isin(reached)
+            if not newly_matched.any():
+                return np.unique(segids[matched])
+            matched |= newly_matched
+
+    tag_segids = [annotated_with(tag) for tag in tags]
+    exclude_segids = [annotated_with(tag) for tag in exclude_tags]
+    is_invalid = [len(s) == 0 for s in tag_segids]
     if any(is_invalid):
         raise KeyError('Check your spelling – the following tags are not'
                        ' present at all in the annotation tables:'
                        f' {np.array(tags)[is_invalid].tolist()}')
-    is_invalid = [tag not in annos.tag.unique() for tag in exclude_tags]
+    is_invalid = [len(s) == 0 for s in exclude_segids]
     if any(is_invalid):
         raise KeyError('Check your spelling – the following tags are not'
                        ' present at all in the annotation tables:'
                        f' {np.array(exclude_tags)[is_invalid].tolist()}')
 
-    annos_grouped = annos.groupby('pt_root_id')['tag'].apply(list)
-    do_tags_match = lambda x: (all([tag in x for tag in tags]) and
-                               all([tag not in x for tag in exclude_tags]))
-    matching_segids = annos_grouped.index[annos_grouped.apply(do_tags_match)]
-    matching_segids = matching_segids.to_list()
+    # Intersect the sets of cells that have each tag, then remove the cells
+    # that have any excluded tag
+    matching_segids = np.unique(segids)
+    for tagged in tag_segids:
+        matching_segids = np.intersect1d(matching_segids, tagged,
+                                         assume_unique=True)
+    for tagged in exclude_segids:
+        matching_segids = matching_segids[~np.isin(matching_segids, tagged)]
+    matching_segids = matching_segids.tolist()
     if len(matching_segids) == 0 and raise_not_found:
         if exclude_tags is None:
             raise LookupError(f'Found no objects annotated with all of: {tags}')
@@ -223,7 +275,7 @@ def cells_annotated_with(tags: str or list[str],
         return matching_segids
     # else, return_as == 'url'
     points = annos.loc[annos.pt_root_id.isin(matching_segids) &
-                       annos.tag.isin(tags)].groupby('pt_root_id')['pt_position'].apply(lambda x: list(x)[0])
+                       annos.tag.isin(set().union(*tag_terms))].groupby('pt_root_id')['pt_position'].apply(lambda x: list(x)[0])
     return statebuilder.render_scene(neurons=matching_segids,
                                      annotations={'name': 'annotation points',
                                                   'type': 'points',
@@ -276,6 +328,7 @@ def all_annotations(source_tables=default_annotation_sources,
     for table_name, column_name in source_tables:
         table = client.materialize.live_live_query(table_name, timestamp,
                                                    allow_missing_lookups=allow_missing_lookups)
+        table = _merge_recent_writes(table, table_name)
         table.sort_values(by='created', inplace=True)
         table['source_table'] = table_name
         table['created'] = table['created'].apply(datetime.date)
@@ -383,6 +436,7 @@ def annotations(segids: int or list[int],
             filter_in_dict={table_name: {'pt_root_id': segids}},
             allow_missing_lookups=allow_missing_lookups
         )
+        table = _merge_recent_writes(table, table_name, segids)
         table['source_table'] = table_name
         table.sort_values(by='created', inplace=True)
         if 'user_id' not in table.columns:
@@ -429,6 +483,113 @@ def _format_annotation_sources(source_tables):
                 raise ValueError('source_tables must be a str, a list of str, or a list of 2-tuple of str')
         return source_tables
     raise ValueError('source_tables must be a str, a list of str, or a list of 2-tuple of str')
+
+
+def record_uploaded_annotations(table_name: str, rows: list) -> None:
+    """
+    Remember annotations that were just uploaded to a CAVE table, so that
+    `annotations()`, `all_annotations()`, `anchor_point()` and the
+    validation functions in `annotations` include them right away, even
+    before the server returns them in queries ("read your writes").
+
+    Each row is a dict with at least 'id' (the new annotation ID),
+    'pt_root_id' and 'pt_position', plus the table's other columns (e.g.
+    'tag', 'tag2' and 'user_id'). Rows are forgotten once the server returns
+    them or after `recent_upload_ttl` seconds.
+
+    The upload functions in `upload` call this automatically.
+    """
+    now = pd.Timestamp.now(tz='UTC')
+    with _recent_writes_lock:
+        for row in rows:
+            row = {'valid': True, 'created': now, **row}
+            key = (table_name, int(row['pt_root_id']))
+            _recent_uploads.setdefault(key, []).append(row)
+
+
+def record_deleted_annotations(table_name: str, annotation_ids: list) -> None:
+    """
+    Remember that annotations were just deleted from a CAVE table, so that
+    lookups exclude them right away, even if the server still returns them.
+    Also forgets them if they were recorded by
+    `record_uploaded_annotations()`.
+
+    The deletion functions in `upload` call this automatically.
+    """
+    annotation_ids = set(annotation_ids)
+    now = pd.Timestamp.now(tz='UTC')
+    with _recent_writes_lock:
+        for annotation_id in annotation_ids:
+            _recent_deletions[(table_name, annotation_id)] = now
+        for key in [key for key in _recent_uploads if key[0] == table_name]:
+            rows = [row for row in _recent_uploads[key]
+                    if row['id'] not in annotation_ids]
+            if rows:
+                _recent_uploads[key] = rows
+            else:
+                del _recent_uploads[key]
+
+
+def recent_uploads(table_name: str, segids=None) -> pd.DataFrame:
+    """
+    Get the annotations recorded by `record_uploaded_annotations()` for a
+    table (optionally only those on the given segment IDs) that haven't
+    expired yet.
+    """
+    cutoff = pd.Timestamp.now(tz='UTC') - pd.Timedelta(seconds=recent_upload_ttl)
+    if segids is not None:
+        segids = set(np.asarray(segids, dtype=np.int64).reshape(-1).tolist())
+    rows = []
+    with _recent_writes_lock:
+        for key in [key for key, time in _recent_deletions.items() if time < cutoff]:
+            del _recent_deletions[key]
+        for key in [key for key in _recent_uploads if key[0] == table_name]:
+            kept = [row for row in _recent_uploads[key] if row['created'] > cutoff]
+            if not kept:
+                del _recent_uploads[key]
+                continue
+            _recent_uploads[key] = kept
+            if segids is None or key[1] in segids:
+                rows.extend(kept)
+    return pd.DataFrame(rows)
+
+
+def _merge_recent_writes(table: pd.DataFrame, table_name: str, segids=None) -> pd.DataFrame:
+    """
+    Given the result of a query to a CAVE table, remove annotations this
+    process recently deleted and add annotations it recently uploaded that
+    the server doesn't return yet.
+    """
+    with _recent_writes_lock:
+        if not _recent_uploads and not _recent_deletions:
+            return table
+        deleted = [annotation_id for t, annotation_id in _recent_deletions
+                   if t == table_name]
+    if 'id' in table.columns:
+        if deleted:
+            table = table.loc[~table['id'].isin(deleted)].copy()
+        # Uploads that the server returns no longer need to be remembered
+        returned = set(table['id'])
+        with _recent_writes_lock:
+            for key in [key for key in _recent_uploads if key[0] == table_name]:
+                _recent_uploads[key] = [row for row in _recent_uploads[key]
+                                        if row['id'] not in returned]
+    recent = recent_uploads(table_name, segids)
+    if recent.empty:
+        return table
+    if table.empty:
+        return recent
+    if 'created' in table.columns and getattr(table['created'].dtype, 'tz', None) is None:
+        recent['created'] = recent['created'].dt.tz_localize(None)
+    recent = recent[recent.columns.intersection(table.columns)]
+    for column in recent.columns:
+        try:
+            recent[column] = recent[column].astype(table[column].dtype)
+        except (TypeError, ValueError):
+            pass
+    return pd.concat([table, recent], ignore_index=True)
+
+
 # --- END CAVE TABLES / ANNOTATIONS SECTION --- #
 
 
@@ -633,7 +794,8 @@ def cellid_from_segid(segids: int or list[int],
 def anchor_point(segids: int or list[int],
                  source_tables=default_anchor_point_sources,
                  timestamp='now', resolve_duplicates=False,
-                 select_nth_duplicate: int = 0, slow_mode=False) -> np.ndarray:
+                 select_nth_duplicate: int = 0, slow_mode=False,
+                 raise_not_found=True) -> np.ndarray:
     """
     Return a representative "anchor" point for each of the given
     segment ID(s).
@@ -676,6 +838,10 @@ def anchor_point(segids: int or list[int],
       this option exists is that server-side filtering has been buggy at times,
       but generally users should be fine leaving this as False.
 
+    raise_not_found: bool (default True)
+      If True, raise a ValueError if any segment has no anchor point.
+      If False, return NaNs as the point for those segments.
+
     Returns
     -------
     points: np.ndarray (3-length vector or Nx3 array)
@@ -687,7 +853,9 @@ def anchor_point(segids: int or list[int],
     except:
         return anchor_point(
             [segids], source_tables=source_tables, timestamp=timestamp,
-            resolve_duplicates=resolve_duplicates
+            resolve_duplicates=resolve_duplicates,
+            select_nth_duplicate=select_nth_duplicate, slow_mode=slow_mode,
+            raise_not_found=raise_not_found
         )[0]
 
     client = auth.get_caveclient()
@@ -717,6 +885,7 @@ def anchor_point(segids: int or list[int],
                 timestamp=timestamp,
                 allow_missing_lookups=allow_missing_lookups
             )
+        points = _merge_recent_writes(points, table, unanchored_ids)
         for seg, point in points.groupby('pt_root_id'):
             if len(point) > 1:
                 # Sort points by x coordinate
@@ -740,9 +909,12 @@ def anchor_point(segids: int or list[int],
             break
 
     if any(anchor_points.isna()):
-        raise ValueError(f'No anchor point found for segid(s)'
-                         f' {anchor_points[anchor_points.isna()].index.values}'
-                         f' in tables {source_tables}')
+        if raise_not_found:
+            raise ValueError(f'No anchor point found for segid(s)'
+                             f' {anchor_points[anchor_points.isna()].index.values}'
+                             f' in tables {source_tables}')
+        for seg in anchor_points.index[anchor_points.isna()]:
+            anchor_points.loc[seg] = np.full(3, np.nan)
     return np.vstack(anchor_points[segids])
 
 
@@ -774,9 +946,8 @@ def nucleusid_from_pt(points, nucleus_segmentation_path=None):
 
 
     if nucleus_segmentation_path is None:
-        client = auth.get_caveclient()
-        table_name = client.info.get_datastack_info()['soma_table']
-        table_info = client.annotation.get_table_metadata(table_name)
+        table_name = auth.get_datastack_info()['soma_table']
+        table_info = auth.get_table_metadata(table_name)
         nucleus_segmentation_path = table_info['flat_segmentation_source']
     nucleus_cv = cloudvolume.CloudVolume( # mip4
         nucleus_segmentation_path,
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
 import os
+import json
+import time
+import uuid
+import random
+import queue
+import threading
+import multiprocessing
+from concurrent import futures
 from datetime import datetime, timezone
-from xml.etree import ElementTree
 
 import numpy as np
-import requests
 import cloudvolume
 
 from . import auth, lookup, transforms
@@ -15,52 +21,266 @@ PUBLISHED_MESHES_CLOUDVOLUME = ('gs://lee-lab_female-adult-nerve-cord/'
 PUBLISHED_MESHES_GCLOUDPROJECT = 'prime-sunset-531'
 VALID_TEMPLATE_SPACES = ('FANC', 'JRC2018_VNC_FEMALE',
                          'JRC2018_VNC_UNISEX', 'JRC2018_VNC_MALE')
+# Sorted list of published segment IDs plus metadata, kept in the
+# cloudvolume next to its mesh folder
+MANIFEST_FILENAME = 'published_segids.json'
 
 
 def list_public_segment_ids(template_space='JRC2018_VNC_FEMALE',
-                            cloudvolume_path=PUBLISHED_MESHES_CLOUDVOLUME):
+                            cloudvolume_path=PUBLISHED_MESHES_CLOUDVOLUME,
+                            refresh=False) -> np.ndarray:
     """
     List the segment IDs of all neurons that have been published to the
     specified template space.
+
+    The IDs are read from the manifest of published meshes kept next to the
+    mesh folder (see `read_manifest()`), which takes milliseconds. If there is
+    no manifest yet or `refresh` is True, the mesh folder is listed instead
+    (see `list_mesh_ids()`) and the manifest is rebuilt from the listing.
+
+    Returns
+    -------
+    A sorted np.ndarray of int64 segment IDs.
     """
     if template_space not in VALID_TEMPLATE_SPACES:
         raise ValueError('{} not in {}'.format(template_space,
                                                VALID_TEMPLATE_SPACES))
     cloudvolume_path = cloudvolume_path.format(template_space)
-    # Implementation aided by GPT-4
-    url = f'https://storage.googleapis.com/{cloudvolume_path.split("/")[2]}'
-    params = {'prefix': '/'.join(cloudvolume_path.split('/')[3:])}
-
-    segids = []
-    while True:
-        response = requests.get(url, params=params)
-        tree = ElementTree.fromstring(response.text)
-
-        # namespaces cause trouble, so find them and remove them
-        namespaces = {'ns': 'http://doc.s3.amazonaws.com/2006-03-01'}
-
-        for elem in tree.findall('ns:Contents/ns:Key', namespaces):
-            filename = elem.text.split('/')[-1]
-            if filename.endswith(':0'):
-                segids.append(np.int64(filename[:-2]))
-
-        # Each query can only get 500 neurons, so we need to check whether
-        # there are more results to fetch
-        marker_elem = tree.find('ns:NextMarker', namespaces)
-        if marker_elem is None:
-            break
-        # If there are, add the marker to the params and allow the while loop
-        # to continue, making a request for the next batch
-        params['marker'] = marker_elem.text
+    if not refresh:
+        manifest = read_manifest(cloudvolume_path)
+        if manifest is not None:
+            return manifest['segids']
 
+    segids = list_mesh_ids(cloudvolume_path)
+    write_manifest(cloudvolume_path, segids, source='listing')
     return segids
 
 
+def is_published(segids, template_space='JRC2018_VNC_FEMALE',
+                 cloudvolume_path=PUBLISHED_MESHES_CLOUDVOLUME) -> np.ndarray:
+    """
+    Check which of the given segment IDs have been published to the
+    specified template space.
+
+    Returns
+    -------
+    A boolean np.ndarray with one entry per segment ID.
+    """
+    published = list_public_segment_ids(template_space=template_space,
+                                        cloudvolume_path=cloudvolume_path)
+    segids = np.atleast_1d(np.asarray(segids, dtype=np.int64))
+    # published is sorted, so a binary search is enough
+    index = np.searchsorted(published, segids)
+    found = index < len(published)
+    found[found] = published[index[found]] == segids[found]
+    return found
+
+
+def list_mesh_ids(cloudvolume_path, prefix_digits=2, max_workers=32) -> np.ndarray:
+    """
+    List the IDs of all meshes in a cloudvolume's mesh folder, by listing
+    the folder in parallel shards that each cover the IDs starting with one
+    `prefix_digits`-digit prefix. Works with any protocol supported by
+    cloud-files, including file:// for testing.
+
+    Arguments
+    ---------
+    cloudvolume_path: str
+      Path to the cloudvolume. Mesh manifests named '{id}:0' are expected in
+      its 'meshes' folder.
+
+    prefix_digits: int, default 2
+      Number of leading digits to shard the listing by. Two digits gives 90
+      shards (IDs don't start with 0). IDs with fewer digits than this are
+      checked for individually instead of listed.
+
+    max_workers: int, default 32
+      Number of shards to list concurrently.
+
+    Returns
+    -------
+    A sorted np.ndarray of int64 mesh IDs. Note that mesh aliases (see
+    `add_mesh_alias()`) are listed too.
+    """
+    from cloudfiles import CloudFiles
+    cf = CloudFiles(cloudvolume_path)
+    if cf.protocol == 'file' and not cf.isdir('meshes'):
+        # Nothing published yet. (Other protocols just list nothing.)
+        return np.array([], dtype=np.int64)
+    prefixes = range(10 ** (prefix_digits - 1), 10 ** prefix_digits)
+
+    def list_shard(prefix):
+        ids = []
+        for key in cf.list(prefix=f'meshes/{prefix}', flat=True):
+            filename = key.split('/')[-1]
+            stem = filename[:-2]
+            if filename.endswith(':0') and stem.isdigit():
+                ids.append(int(stem))
+        return ids
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shards = list(executor.map(list_shard, prefixes))
+    # Listing a shorter prefix would list all the longer IDs again
+    short_ids = range(1, 10 ** (prefix_digits - 1))
+    exists = cf.exists([f'meshes/{i}:0' for i in short_ids])
+    shards.append([i for i in short_ids if exists[f'meshes/{i}:0']])
+    return np.unique(np.array([i for shard in shards for i in shard],
+                              dtype=np.int64))
+
+
+def read_manifest(cloudvolume_path):
+    """
+    Read the manifest of published meshes for a cloudvolume, which is kept
+    in the file named by `MANIFEST_FILENAME` next to the mesh folder.
+
+    Returns
+    -------
+    None if there is no manifest, otherwise a dict with keys 'segids' (a
+    sorted np.ndarray of int64 IDs), 'count', 'updated' (an ISO 8601 UTC
+    time string) and 'source' ('listing' or 'publish').
+    """
+    from cloudfiles import CloudFiles
+    manifest = CloudFiles(cloudvolume_path).get_json(MANIFEST_FILENAME)
+    if manifest is None:
+        return None
+    manifest['segids'] = np.array(manifest['segids'], dtype=np.int64)
+    return manifest
+
+
+def _manifest_contents(segids, source):
+    segids = np.unique(np.asarray(segids, dtype=np.int64))
+    return {
+        'segids': segids.tolist(),
+        'count': len(segids),
+        'updated': datetime.now(timezone.utc).isoformat(),
+        'source': source,
+    }
+
+
+def write_manifest(cloudvolume_path, segids, source='publish'):
+    """
+    Replace the manifest of published meshes for a cloudvolume. The manifest
+    is written to a temporary file and then moved into place, so readers
+    never see a partially written manifest. Use `add_to_manifest()` instead
+    to add IDs while others may be updating the manifest too.
+    """
+    from cloudfiles import CloudFiles
+    cf = CloudFiles(cloudvolume_path)
+    temp_filename = f'{MANIFEST_FILENAME}.{uuid.uuid4().hex}.tmp'
+    cf.put_json(temp_filename, _manifest_contents(segids, source),
+                cache_control='no-cache')
+    cf.move(temp_filename, cf.join(cf.cloudpath, MANIFEST_FILENAME))
+
+
+def add_to_manifest(cloudvolume_path, segids, gcs_client=None,
+                    max_attempts=10):
+    """
+    Add segment IDs to the manifest of published meshes for a cloudvolume,
+    creating the manifest from a listing of the mesh folder if needed.
+
+    Concurrent calls don't lose each other's IDs on gs:// and file://
+    paths. On gs://, the manifest is only replaced if it hasn't changed
+    since it was read (a generation-matched write), and otherwise read and
+    merged again, up to max_attempts times. On file://, the update holds an
+    exclusive lock on the file `{MANIFEST_FILENAME}.lock` next to the
+    manifest. On other protocols the update is not guarded, so concurrent
+    calls can drop IDs; `list_public_segment_ids(refresh=True)` rebuilds
+    the manifest from the mesh folder.
+
+    Arguments
+    ---------
+    cloudvolume_path: str
+
+    segids: iterable of int
+
+    gcs_client: google.cloud.storage.Client, optional
+      Client to use for gs:// paths. If None, one is created.
+
+    max_attempts: int, default 10
+      Number of times to try a gs:// update before giving up because other
+      writers keep changing the manifest.
+
+    Returns
+    -------
+    The updated sorted np.ndarray of published segment IDs.
+    """
+    segids = np.asarray(segids, dtype=np.int64)
+    if cloudvolume_path.startswith('gs://'):
+        return _add_to_gcs_manifest(cloudvolume_path, segids, gcs_client,
+                                    max_attempts)
+
+    def update():
+        manifest = read_manifest(cloudvolume_path)
+        if manifest is None:
+            published = list_mesh_ids(cloudvolume_path)
+        else:
+            published = manifest['segids']
+        published = np.union1d(published, segids)
+        write_manifest(cloudvolume_path, published)
+        return published
+
+    if not cloudvolume_path.startswith('file://'):
+        return update()
+    import fcntl
+    folder = cloudvolume_path[len('file://'):]
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f'{MANIFEST_FILENAME}.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return update()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _add_to_gcs_manifest(cloudvolume_path, segids, gcs_client, max_attempts):
+    """The gs:// case of `add_to_manifest()`."""
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    if gcs_client is None:
+        from google.cloud import storage
+        gcs_client = storage.Client(project=PUBLISHED_MESHES_GCLOUDPROJECT)
+    bucket_name, _, folder = cloudvolume_path[len('gs://'):].partition('/')
+    blob = gcs_client.bucket(bucket_name).blob(
+        '/'.join([*filter(None, folder.split('/')), MANIFEST_FILENAME]))
+    for attempt in range(max_attempts):
+        try:
+            blob.reload()
+            generation = blob.generation
+            manifest = json.loads(blob.download_as_bytes(if_generation_match=generation))
+            published = np.asarray(manifest['segids'], dtype=np.int64)
+        except NotFound:
+            # Generation 0 means the write only succeeds if there's still
+            # no manifest
+            generation = 0
+            published = list_mesh_ids(cloudvolume_path)
+        except PreconditionFailed:
+            continue
+        published = np.union1d(published, segids)
+        blob.cache_control = 'no-cache'
+        try:
+            blob.upload_from_string(
+                json.dumps(_manifest_contents(published, 'publish')),
+                content_type='application/json',
+                if_generation_match=generation)
+            return published
+        except PreconditionFailed:
+            # Someone else updated the manifest since it was read
+            time.sleep(random.uniform(0, min(5, 0.1 * 2**attempt)))
+    raise RuntimeError(f'Could not update the manifest in {cloudvolume_path}'
+                       f' after {max_attempts} attempts, because it kept'
+                       ' being changed by others.')
+
+
 def publish_mesh_to_gcloud(segids,
                            template_space='JRC2018_VNC_FEMALE',
                            cloudvolume_path=PUBLISHED_MESHES_CLOUDVOLUME,
                            link_to_cellid=True,
-                           timestamp='now'):
+                           timestamp='now',
+                           download_workers=8,
+                           warp_processes=None,
+                           upload_workers=8,
+                           queue_size=32,
+                           checkpoint='default',
+                           report_interval=60):
     """
     Download the mesh for a neuron, warp it into alignment with the specified
     VNC template (optional), and upload it to a public google cloud storage bucket.
@@ -72,7 +292,8 @@ def publish_mesh_to_gcloud(segids,
     you when you have a list of neurons you're ready to make public.
 
     Get a complete list of IDs of public neurons by running the function
-    `list_public_segment_ids()`, or by opening one of the the following
+    `list_public_segment_ids()`, which reads the manifest of published
+    meshes that this function updates, or by opening one of the the following
     links in your browser, depending on which space you want to see neurons in:
     https://console.cloud.google.com/storage/browser/lee-lab_female-adult-nerve-cord/meshes/FANC/FANC_neurons/meshes
     https://console.cloud.google.com/storage/browser/lee-lab_female-adult-nerve-cord/meshes/JRC2018_VNC_FEMALE/FANC_neurons/meshes
@@ -109,6 +330,34 @@ def publish_mesh_to_gcloud(segids,
       If 'now', use the current time.
       If datetime, use the time specified by the user.
       If None, use the timestamp of the latest materialization.
+
+    download_workers, warp_processes, upload_workers: int
+      Neurons go through a pipeline of three stages connected by bounded
+      queues: mesh downloads in `download_workers` threads, warping in a pool
+      of `warp_processes` processes (default: one per CPU core), and uploads
+      in `upload_workers` threads. The warping processes are started with
+      the 'spawn' method, so a script that calls this function to publish to
+      a template space other than 'FANC' must do so under
+      `if __name__ == '__main__':`.
+
+    queue_size: int, default 32
+      The maximum number of meshes waiting between two stages, which bounds
+      memory use when one stage is slower than the one feeding it.
+
+    checkpoint: 'default' (default) OR str OR None
+      Path to a local file recording each neuron as soon as it's published,
+      so that a rerun after a crash skips those neurons. 'default' uses a
+      file in the mesh cache folder named after the template space. The file
+      is deleted once all neurons have been published. None disables it.
+
+    report_interval: float, default 60
+      Print the throughput of each stage every this many seconds.
+
+    Returns
+    -------
+    A dict with keys 'published' (list of segment IDs published by this
+    call), 'failed' ({segid: error message}) and 'stages' (throughput stats
+    of each stage, see `_PipelineStage.stats()`).
     """
     try:
         iter(segids)
@@ -119,33 +368,291 @@ def publish_mesh_to_gcloud(segids,
         raise ValueError('{} not in {}'.format(template_space,
                                                VALID_TEMPLATE_SPACES))
 
+    cloudvolume_path = cloudvolume_path.format(template_space)
     already_published_ids = list_public_segment_ids(template_space=template_space,
                                                     cloudvolume_path=cloudvolume_path)
-    already_published_ids = set(already_published_ids)
+    already_published_ids = set(already_published_ids.tolist())
 
-    fancneurons_cloudvolume = cloudvolume.CloudVolume(cloudvolume_path.format(template_space))
+    if checkpoint == 'default':
+        checkpoint = os.path.join(auth.configs['mesh_cache'],
+                                  f'publish_checkpoint_{template_space}.txt')
+    checkpointed_ids = _read_publish_checkpoint(checkpoint, cloudvolume_path)
+    todo = []
+    for segid in segids:
+        if segid in already_published_ids or segid in checkpointed_ids:
+            print(f'Segment {segid} already published in {template_space}-space, skipping.')
+        else:
+            todo.append(segid)
+            already_published_ids.add(segid)
 
     if timestamp == 'now':
         timestamp = datetime.now(timezone.utc)
-    mm = auth.get_meshmanager()
+    cellids = {}
+    if link_to_cellid and todo:
+        cellids = dict(zip(todo, lookup.cellid_from_segid(todo, timestamp=timestamp)))
+
+    print(f'Publishing {len(todo)} segments to {template_space}-space.')
+    newly_published_ids = []
+    try:
+        result = _run_publish_pipeline(
+            todo, template_space, cloudvolume_path, cellids, checkpoint,
+            newly_published_ids,
+            download_workers=download_workers, warp_processes=warp_processes,
+            upload_workers=upload_workers, queue_size=queue_size,
+            report_interval=report_interval)
+    finally:
+        # Record whatever got published, even if the pipeline was interrupted,
+        # plus neurons in the checkpoint from a previous interrupted run
+        newly_published_ids.extend(checkpointed_ids)
+        if newly_published_ids:
+            add_to_manifest(cloudvolume_path, newly_published_ids)
+    if checkpoint is not None and not result['failed'] and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    for segid, error in result['failed'].items():
+        print(f'Failed to publish segment {segid}: {error}')
+    return result
+
+
+class _PipelineStage(object):
+    """Thread-safe throughput accounting for one stage of a pipeline."""
+    def __init__(self, name):
+        self.name = name
+        self.done = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.n_bytes = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, n_bytes=0, failed=False):
+        with self._lock:
+            self.busy_seconds += seconds
+            if failed:
+                self.failed += 1
+            else:
+                self.done += 1
+                self.n_bytes += n_bytes
+
+    def stats(self) -> dict:
+        """
+        Returns
+        -------
+        A dict with the numbers of neurons done and failed, the neurons
+        per second of wall time, the MB per second of wall time, and the
+        mean seconds spent per neuron by one worker.
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+            n = self.done + self.failed
+            return {
+                'done': self.done,
+                'failed': self.failed,
+                'neurons_per_second': self.done / elapsed,
+                'megabytes_per_second': self.n_bytes / elapsed / 1e6,
+                'seconds_per_neuron': self.busy_seconds / n if n else None,
+            }
+
+    def __str__(self):
+        stats = self.stats()
+        return (f"{self.name}: {stats['done']} done, {stats['failed']} failed,"
+                f" {stats['neurons_per_second']:.2f} neurons/s,"
+                f" {stats['megabytes_per_second']:.1f} MB/s")
+
+
+def _warp_mesh(vertices, faces, template_space):
+    """
+    Warp a mesh into alignment with a template space. Runs in a worker
+    process of the publish pipeline, so it takes and returns plain arrays.
+    """
+    import trimesh
+    mesh = trimesh.Trimesh(vertices, faces, process=False)
+    transforms.template_alignment.align_mesh(mesh, target_space=template_space,
+                                             output_units='nanometers')
+    return np.asarray(mesh.vertices), np.asarray(mesh.faces)
+
+
+def _read_publish_checkpoint(checkpoint, cloudvolume_path) -> set:
+    """
+    Read the segment IDs recorded in a publish checkpoint file, ignoring
+    files that were written for a different cloudvolume.
+    """
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint, 'r') as f:
+        lines = f.read().splitlines()
+    if not lines or lines[0] != f'# {cloudvolume_path}':
+        return set()
+    return {int(line) for line in lines[1:] if line.strip()}
+
+
+def _run_publish_pipeline(segids, template_space, cloudvolume_path, cellids,
+                          checkpoint, published, download_workers=8,
+                          warp_processes=None, upload_workers=8, queue_size=32,
+                          report_interval=60):
+    """
+    Download, warp and upload the meshes of the given segments in a
+    three-stage pipeline. See `publish_mesh_to_gcloud()` for the arguments.
+    Segment IDs are appended to the list `published` as they get published.
+    """
+    warp = template_space != 'FANC'
+    if warp_processes is None:
+        warp_processes = os.cpu_count()
+    stages = {name: _PipelineStage(name) for name in ('download', 'warp', 'upload')}
+    failed = {}
+    failed_lock = threading.Lock()
+    # Set if the pipeline is interrupted, to make the workers skip the rest
+    stop = threading.Event()
+
+    if checkpoint is not None:
+        if not _read_publish_checkpoint(checkpoint, cloudvolume_path):
+            os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+            with open(checkpoint, 'w') as f:
+                f.write(f'# {cloudvolume_path}\n')
+        checkpoint_file = open(checkpoint, 'a')
+
+    # MeshMeta and CloudVolume objects aren't shared between threads
+    local = threading.local()
+
+    def fail(stage, segid, start, error):
+        stage.record(time.time() - start, failed=True)
+        with failed_lock:
+            failed[segid] = f'{stage.name} failed: {error!r}'
+
+    def download(segid):
+        if not hasattr(local, 'mm'):
+            local.mm = auth.get_meshmanager()
+        mesh = local.mm.mesh(seg_id=segid)
+        return np.asarray(mesh.vertices), np.asarray(mesh.faces)
+
+    def upload(segid, vertices, faces):
+        if not hasattr(local, 'cv'):
+            local.cv = cloudvolume.CloudVolume(cloudvolume_path, progress=False)
+        local.cv.mesh.put(cloudvolume.mesh.Mesh(vertices, faces, segid=segid))
+        if cellids.get(segid) is not None:
+            add_mesh_alias(segid, cellids[segid], cloudvolume_path + '/meshes',
+                           force=True, gcs_client=gcs_client)
+
+    def download_worker(inbox, outbox):
+        for segid in iter(inbox.get, None):
+            if stop.is_set():
+                continue
+            start = time.time()
+            try:
+                vertices, faces = download(segid)
+            except Exception as e:
+                fail(stages['download'], segid, start, e)
+                continue
+            stages['download'].record(time.time() - start,
+                                      vertices.nbytes + faces.nbytes)
+            outbox.put((segid, vertices, faces))
+
+    def warp_worker(inbox, outbox):
+        for segid, vertices, faces in iter(inbox.get, None):
+            if stop.is_set():
+                continue
+            start = time.time()
+            try:
+                if warp:
+                    vertices, faces = pool.submit(_warp_mesh, vertices, faces,
+                                                  template_space).result()
+            except Exception as e:
+                fail(stages['warp'], segid, start, e)
+                continue
+            stages['warp'].record(time.time() - start,
+                                  vertices.nbytes + faces.nbytes)
+            outbox.put((segid, vertices, faces))
+
+    def upload_worker(inbox, outbox):
+        for segid, vertices, faces in iter(inbox.get, None):
+            if stop.is_set():
+                continue
+            start = time.time()
+            try:
+                upload(segid, vertices, faces)
+            except Exception as e:
+                fail(stages['upload'], segid, start, e)
+                continue
+            stages['upload'].record(time.time() - start,
+                                    vertices.nbytes + faces.nbytes)
+            with failed_lock:
+                published.append(segid)
+                if checkpoint is not None:
+                    checkpoint_file.write(f'{segid}\n')
+                    checkpoint_file.flush()
+            print(f'Published segment {segid} to {template_space}-space.')
+
+    gcs_client = None
+    if cellids and cloudvolume_path.startswith('gs://'):
+        from google.cloud import storage
+        gcs_client = storage.Client(project=PUBLISHED_MESHES_GCLOUDPROJECT)
+    pool = None
+    if warp and segids:
+        # The pool starts its processes when work is submitted, which is
+        # after the pipeline's threads are running, when forking isn't safe
+        pool = futures.ProcessPoolExecutor(
+            max_workers=warp_processes,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    todo = queue.Queue()
     for segid in segids:
-        if segid in already_published_ids:
-            print(f'Segment {segid} already published in {template_space}-space, skipping.')
-            continue
-        print(f'Publishing segment {segid} to {template_space}-space.')
-        mesh = mm.mesh(seg_id=segid)
-        if template_space != 'FANC':
-            transforms.template_alignment.align_mesh(mesh, target_space=template_space)
-            mesh.vertices *= 1000  # TODO delete this after adding nm/um to align_mesh
-        mesh = cloudvolume.mesh.Mesh(mesh.vertices, mesh.faces, segid=segid)
-        fancneurons_cloudvolume.mesh.put(mesh)
-        del mesh
-        if link_to_cellid:
-            add_cellid_alias(segid,
-                             template_space=template_space,
-                             cloudvolume_path=cloudvolume_path,
-                             force=True,
-                             timestamp=timestamp)
+        todo.put(segid)
+    downloaded = queue.Queue(maxsize=queue_size)
+    warped = queue.Queue(maxsize=queue_size)
+    pipeline = [(download_worker, download_workers, todo, downloaded),
+                (warp_worker, warp_processes if warp else 1, downloaded, warped),
+                (upload_worker, upload_workers, warped, None)]
+    # Waiting for these rather than joining the threads, since an
+    # interrupted Thread.join() can mark a running thread as stopped
+    finished = [[threading.Event() for _ in range(n_workers)]
+                for _, n_workers, _, _ in pipeline]
+
+    def run(worker, inbox, outbox, done):
+        try:
+            worker(inbox, outbox)
+        finally:
+            done.set()
+
+    for (worker, _, inbox, outbox), stage_finished in zip(pipeline, finished):
+        for done in stage_finished:
+            threading.Thread(target=run, args=(worker, inbox, outbox, done),
+                             name=worker.__name__, daemon=True).start()
+
+    last_report = time.time()
+    stopped_stages = set()
+
+    def shut_down():
+        nonlocal last_report
+        # Shut each stage down once the one feeding it is done
+        for i, (stage_finished, (_, _, inbox, _)) in enumerate(zip(finished, pipeline)):
+            if i not in stopped_stages:
+                for _ in stage_finished:
+                    inbox.put(None)
+                stopped_stages.add(i)
+            for done in stage_finished:
+                while not done.wait(timeout=1):
+                    if time.time() - last_report > report_interval:
+                        print(' | '.join(str(stage) for stage in stages.values()))
+                        last_report = time.time()
+
+    try:
+        shut_down()
+    except BaseException:
+        # Interrupted, for example by Ctrl+C. Let the workers finish the
+        # neurons they're on and skip the rest, so that none of them is
+        # still running when the checkpoint file is closed.
+        stop.set()
+        shut_down()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if checkpoint is not None:
+            checkpoint_file.close()
+    print(' | '.join(str(stage) for stage in stages.values()))
+
+    return {'published': published,
+            'failed': failed,
+            'stages': {name: stage.stats() for name, stage in stages.items()}}
 
 
 def add_cellid_alias(segid,
@@ -165,7 +672,8 @@ def add_mesh_alias(meshid,
                    alias,
                    gcloud_mesh_folder,
                    gcloud_project=PUBLISHED_MESHES_GCLOUDPROJECT,
-                   force=False):
+                   force=False,
+                   gcs_client=None):
     """
     Add an alias to a mesh in the google cloud storage bucket.
 
@@ -186,10 +694,14 @@ def add_mesh_alias(meshid,
 
     force: bool
       Whether to overwrite the alias if it already exists.
+
+    gcs_client: google.cloud.storage.Client, optional
+      A client to reuse, instead of creating one for this call.
     """
-    from google.cloud import storage
     from google.cloud.exceptions import NotFound
-    gcs_client = storage.Client(project=gcloud_project)
+    if gcs_client is None:
+        from google.cloud import storage
+        gcs_client = storage.Client(project=gcloud_project)
     bucket = gcs_client.get_bucket(gcloud_mesh_folder.replace('gs://', '').split('/')[0])
     mesh_folder = '/'.join(gcloud_mesh_folder.replace('gs://', '').split('/')[1:])
 
@@ -231,7 +743,8 @@ def publish_all_meshes(published_tag='publication',
                        template_space='JRC2018_VNC_FEMALE',
                        cloudvolume_path=PUBLISHED_MESHES_CLOUDVOLUME,
                        timestamp='now',
-                       n=None):
+                       n=None,
+                       **kwargs):
     """
     Copy to a public location the meshes of all neurons marked as
     published.
@@ -260,16 +773,20 @@ def publish_all_meshes(published_tag='publication',
       If 'now', use the current time.
       If datetime, use the time specified by the user.
       If None, use the timestamp of the latest materialization.
+
+    Other keyword arguments are passed to `publish_mesh_to_gcloud()` to
+    configure its pipeline, for example `warp_processes` or `checkpoint`.
     """
     segids_with_published_annotation = lookup.cells_annotated_with(
         published_tag,
         source_tables=[tag_location],
         timestamp=timestamp
     )
-    publish_mesh_to_gcloud(segids_with_published_annotation[:n],
-                           template_space=template_space,
-                           cloudvolume_path=cloudvolume_path,
-                           timestamp=timestamp)
+    return publish_mesh_to_gcloud(segids_with_published_annotation[:n],
+                                  template_space=template_space,
+                                  cloudvolume_path=cloudvolume_path,
+                                  timestamp=timestamp,
+                                  **kwargs)
 
 
 def publish_skeleton_to_catmaid(segids,
@@ -5,21 +5,201 @@ Upload data to CAVE tables
 See some examples at https://github.com/htem/FANC_auto_recon/blob/main/example_notebooks/update_cave_tables.ipynb
 """
 
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+import uuid
 from typing import Literal, Tuple, Union
 from datetime import datetime, timezone
 from textwrap import dedent
-import time
+from concurrent import futures
+from functools import partial
 
 import numpy as np
 import pandas as pd
 from requests.exceptions import HTTPError
 from caveclient.chunkedgraph import root_id_int_list_check
 from cloudvolume import CloudVolume
+from cloudfiles import CloudFiles
+from taskqueue import LocalTaskQueue, TaskQueue, queueable
 from cloudvolume.lib import green, red
 
 from . import annotations, auth, lookup, statebuilder
 
 
+pt_types = ['soma', 'peripheral nerve', 'neck connective', 'backbone',
+            'cut-off soma', 'orphan']
+cell_id_ranges = {
+    'descending': range(1, 1_999),
+    'ascending': range(2_000, 5_999),
+    'brain motor': range(6_000, 7_999),
+    'VNC motor': range(8_000, 9_999),
+    'brain sensory': range(10_000, 29_999),
+    'neck sensory': range(30_000, 49_999),
+    'VNC sensory': range(50_000, 99_999),
+    'brain intrinsic': range(100_000, 199_999),
+    'VNC intrinsic': range(200_000, 299_999),
+    'brain glia': range(1_000_000, 1_199_999),
+    'VNC glia': range(2_000_000, 2_199_999),
+}
+# Annotation to add to each new cell, by cell type
+_cell_type_annotations = {
+    'descending': ('anterior-posterior projection pattern', 'descending'),
+    'ascending': ('anterior-posterior projection pattern', 'ascending'),
+    'brain motor': ('primary class', 'motor neuron'),
+    'VNC motor': ('primary class', 'motor neuron'),
+    'brain sensory': ('primary class', 'sensory neuron'),
+    'neck sensory': ('primary class', 'sensory neuron'),
+    'VNC sensory': ('primary class', 'sensory neuron'),
+    'brain intrinsic': ('primary class', 'central neuron'),
+    'VNC intrinsic': ('primary class', 'central neuron'),
+    'brain glia': ('primary class', 'glia'),
+    'VNC glia': ('primary class', 'glia'),
+}
+
+
+class CellIdAllocator(object):
+    """
+    Hands out unused cell IDs from the range of each cell type (see
+    `cell_id_ranges`).
+
+    The highest ID in use in each range is cached, and each allocation only
+    queries the cell IDs table for IDs above it. Candidate IDs are checked
+    against existing annotation IDs with one query per allocation, and
+    allocated IDs are reserved so that later allocations in this process
+    never hand them out again, even before they are uploaded.
+
+    Use `get_cell_id_allocator()` to get a shared allocator for a table.
+    """
+    def __init__(self, cell_ids_table=lookup.default_cellid_source, client=None):
+        self.table_name, self.column_name = cell_ids_table
+        self._client = client
+        self._high_water_marks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = auth.get_caveclient()
+        return self._client
+
+    def high_water_mark(self, cell_type) -> int:
+        """
+        Get the highest cell ID that is in use or reserved in the range of
+        the given cell type, checking the table only for IDs above the
+        cached value.
+        """
+        if cell_type not in cell_id_ranges:
+            raise ValueError(f'cell_type "{cell_type}" is not valid')
+        id_range = cell_id_ranges[cell_type]
+        mark = self._high_water_marks.get(cell_type, id_range.start - 1)
+        new_ids = self.client.materialize.live_live_query(
+            self.table_name,
+            datetime.now(timezone.utc),
+            filter_greater_dict={self.table_name: {self.column_name: mark}},
+            filter_less_dict={self.table_name: {self.column_name: id_range.stop}},
+            allow_missing_lookups=lookup.allow_missing_lookups
+        )
+        new_ids = lookup._merge_recent_writes(new_ids, self.table_name)[self.column_name]
+        new_ids = new_ids[(new_ids > mark) & (new_ids < id_range.stop)]
+        if not new_ids.empty:
+            mark = int(new_ids.max())
+        self._high_water_marks[cell_type] = mark
+        return mark
+
+    def allocate(self, cell_type, n=1, reserve=True) -> list:
+        """
+        Get n unused cell IDs for cells of the given type.
+
+        Arguments
+        ---------
+        cell_type: str
+            One of the keys of `cell_id_ranges`.
+
+        n: int
+            Number of IDs to get.
+
+        reserve: bool
+            If True, these IDs won't be handed out again by this allocator.
+            Use False to preview which IDs would be used.
+
+        Returns
+        -------
+        list of int
+        """
+        with self._lock:
+            id_range = cell_id_ranges.get(cell_type)
+            candidate = self.high_water_mark(cell_type) + 1
+            ids = []
+            while len(ids) < n:
+                block = list(range(candidate, min(candidate + n - len(ids), id_range.stop)))
+                if not block:
+                    raise ValueError(f'Not enough unused cell IDs left for cell'
+                                     f' type "{cell_type}" ({id_range}).')
+                existing = self.client.annotation.get_annotation(self.table_name, block)
+                existing = {annotation['id'] for annotation in existing}
+                if existing:
+                    print(f'WARNING: IDs {sorted(existing)} already exist in'
+                          f' {self.table_name}, skipping them.')
+                ids.extend(i for i in block if i not in existing)
+                candidate = block[-1] + 1
+            if reserve:
+                self._high_water_marks[cell_type] = ids[-1]
+            return ids
+
+
+_cell_id_allocators = {}
+# Owner tokens of the UploadQueues open in this process
+_upload_queue_owners = set()
+
+
+def get_cell_id_allocator(cell_ids_table=lookup.default_cellid_source) -> CellIdAllocator:
+    """
+    Get the CellIdAllocator for a cell IDs table, creating it on first use.
+    """
+    cell_ids_table = tuple(cell_ids_table)
+    if cell_ids_table not in _cell_id_allocators:
+        _cell_id_allocators[cell_ids_table] = CellIdAllocator(cell_ids_table)
+    return _cell_id_allocators[cell_ids_table]
+
+
+def _upload_in_batches(client, table_name: str, rows: list, batch_size: int,
+                       id_field=False) -> tuple:
+    """
+    Upload annotations to a CAVE table one batch at a time, stopping at the
+    first batch that fails, so that the caller knows exactly which rows made
+    it to the server.
+
+    Arguments
+    ---------
+    rows: list of dict
+        The annotations, as keyword arguments for `stage.add()`.
+
+    Returns
+    -------
+    (ids, error): The annotation IDs of the uploaded rows, which are the first
+    len(ids) rows, and the exception that stopped the upload (or None).
+    """
+    ids = []
+    for start in range(0, len(rows), batch_size):
+        stage = client.annotation.stage_annotations(table_name, id_field=id_field)
+        for row in rows[start:start + batch_size]:
+            stage.add(**row)
+        try:
+            # caveclient would re-post a batch after any error, including
+            # ones the server may have already processed. auth.rate_limiter
+            # retries post_annotation itself when that's safe.
+            ids += client.annotation.upload_staged_annotations(
+                stage, batch_size=batch_size, progress=False, retries=1)
+        except Exception as e:
+            return ids, e
+    return ids, None
+
+
 def new_cell(pt_position,
              pt_type: Literal['soma', 'peripheral nerve', 'neck connective', 'backbone'],
              cell_type: Literal['descending', 'ascending', 'brain motor', 'VNC motor',
@@ -35,36 +215,22 @@ def new_cell(pt_position,
     """
     table_name, column_name = cell_ids_table
     client = auth.get_caveclient()
-    cell_ids = client.materialize.live_live_query(table_name, timestamp=datetime.utcnow())
     segid = lookup.segid_from_pt(pt_position)
     if segid == 0:
         raise ValueError(f'Point {pt_position} is a location with no segmentation')
+    cell_ids = client.materialize.live_live_query(
+        table_name, datetime.now(timezone.utc),
+        filter_equal_dict={table_name: {'pt_root_id': int(segid)}},
+        allow_missing_lookups=lookup.allow_missing_lookups
+    )
+    cell_ids = lookup._merge_recent_writes(cell_ids, table_name, segids=[segid])
     if segid in cell_ids.pt_root_id.values:
         raise ValueError(f"Segment {segid} already has a cell ID, {cell_ids.loc[cell_ids.pt_root_id == segid, column_name].values[0]}")
-    if pt_type not in ['soma', 'peripheral nerve', 'neck connective', 'backbone', 'cut-off soma', 'orphan']:
+    if pt_type not in pt_types:
         raise ValueError(f'pt_type "{pt_type}" is not valid')
-    id_ranges = {
-        'descending': range(1, 1_999),
-        'ascending': range(2_000, 5_999),
-        'brain motor': range(6_000, 7_999),
-        'VNC motor': range(8_000, 9_999),
-        'brain sensory': range(10_000, 29_999),
-        'neck sensory': range(30_000, 49_999),
-        'VNC sensory': range(50_000, 99_999),
-        'brain intrinsic': range(100_000, 199_999),
-        'VNC intrinsic': range(200_000, 299_999),
-        'brain glia': range(1_000_000, 1_199_999),
-        'VNC glia': range(2_000_000, 2_199_999),
-    }
-    if cell_type not in start_ids.keys():
+    if cell_type not in cell_id_ranges:
         raise ValueError(f'cell_type "{cell_type}" is not valid')
-    id_range = id_ranges[cell_type]
-    max_existing_id = cell_ids.loc[cell_ids[column_name].isin(id_range), column_name].max()
-    upload_id = int(max_existing_id) + 1
-    while client.annotation.get_annotation(table_name, upload_id) != []:
-        print(f'WARNING: ID {upload_id} already exists in {table_name},'
-              ' incrementing by 1 to try to find an unused ID.')
-        upload_id += 1
+    upload_id = get_cell_id_allocator(cell_ids_table).allocate(cell_type, reserve=not fake)[0]
     stage = client.annotation.stage_annotations(table_name, id_field=True)
     stage.add(id=upload_id,
               **{column_name: upload_id},
@@ -86,13 +252,6 @@ def new_cell(pt_position,
                 print(type(e))
                 print(e)
 
-    def try_annotate_neuron(*args, **kwargs):
-        try:
-            annotate_neuron(*args, **kwargs)
-        except ValueError as e:
-            print(type(e))
-            print(e)
-
     if fake:
         if add_to_soma_table:
             print(f'FAKE – would add new soma table entry and cell_id for {cell_type} neuron:')
@@ -100,31 +259,150 @@ def new_cell(pt_position,
             print(f'FAKE – would new cell_id for {cell_type} neuron:')
         print(stage.annotation_dataframe)
     else:
-        response = client.annotation.upload_staged_annotations(stage)
-        time.sleep(1)
+        # caveclient would re-post a batch after any error, including ones
+        # the server may have already processed. auth.rate_limiter retries
+        # post_annotation itself when that's safe, so caveclient mustn't.
+        response = client.annotation.upload_staged_annotations(stage, retries=1)
+        lookup.record_uploaded_annotations(table_name, [{
+            'id': response[0], 'pt_root_id': int(segid),
+            column_name: upload_id, 'pt_position': np.array(pt_position),
+            'tag': pt_type
+        }])
         print('New cell ID posted:', response)
-        if cell_type == 'descending':
-            try_annotate_neuron(segid, ('anterior-posterior projection pattern', 'descending'), user_id)
-        if cell_type == 'ascending':
-            try_annotate_neuron(segid, ('anterior-posterior projection pattern', 'ascending'), user_id)
-        if cell_type == 'brain motor':
-            try_annotate_neuron(segid, ('primary class', 'motor neuron'), user_id)
-        if cell_type == 'VNC motor':
-            try_annotate_neuron(segid, ('primary class', 'motor neuron'), user_id)
-        if cell_type == 'brain sensory':
-            try_annotate_neuron(segid, ('primary class', 'sensory neuron'), user_id)
-        if cell_type == 'neck sensory':
-            try_annotate_neuron(segid, ('primary class', 'sensory neuron'), user_id)
-        if cell_type == 'VNC sensory':
-            try_annotate_neuron(segid, ('primary class', 'sensory neuron'), user_id)
-        if cell_type == 'brain intrinsic':
-            try_annotate_neuron(segid, ('primary class', 'central neuron'), user_id)
-        if cell_type == 'VNC intrinsic':
-            try_annotate_neuron(segid, ('primary class', 'central neuron'), user_id)
-        if cell_type == 'brain glia':
-            try_annotate_neuron(segid, ('primary class', 'glia'), user_id)
-        if cell_type == 'VNC glia':
-            try_annotate_neuron(segid, ('primary class', 'glia'), user_id)
+        try:
+            annotate_neuron(segid, _cell_type_annotations[cell_type], user_id)
+        except ValueError as e:
+            print(type(e))
+            print(e)
+
+
+def new_cells(cells: pd.DataFrame,
+              user_id: int,
+              cell_ids_table=lookup.default_cellid_source,
+              pt_position_column='pt_position',
+              pt_type_column='pt_type',
+              cell_type_column='cell_type',
+              batch_size=10_000,
+              fake=True) -> pd.DataFrame:
+    """
+    Add many new cells to the cell_ids table and annotate their types, like
+    calling `new_cell()` on each row of `cells`, but with a few bulk queries
+    and uploads for all rows.
+
+    Arguments
+    ---------
+    cells: pd.DataFrame
+        One row per new cell, with columns for the point, point type and cell
+        type (see `new_cell()` for valid values).
+
+    user_id: int
+        The CAVE user ID number to associate with the cell type annotations.
+
+    pt_position_column, pt_type_column, cell_type_column: str
+        Names of the columns of `cells` to use.
+
+    batch_size: int
+        Maximum number of cell IDs to upload per request.
+
+    fake: bool
+        If True, do all the checks but don't upload anything.
+
+    Returns
+    -------
+    pd.DataFrame: A copy of `cells` with these columns added:
+        'pt_root_id': The segment ID at each row's point.
+        'cell_id': The new cell ID, if uploaded (or to be uploaded if fake).
+        'status': One of 'uploaded', 'not allowed', 'upload failed', or (if
+            `fake` is True) 'would upload'.
+        'reason': Why the row was not uploaded, or None.
+        'annotation_status': The 'status' returned by `annotate_neurons()`
+            for the cell type annotation of each uploaded row, or None for
+            rows that were not uploaded.
+        'annotation_reason': Why the cell type annotation was not uploaded,
+            or None.
+    """
+    table_name, column_name = cell_ids_table
+    client = auth.get_caveclient()
+    result = cells.copy()
+    points = np.vstack(result[pt_position_column].values)
+    segids = np.asarray(lookup.segid_from_pt(points), dtype=np.int64)
+    reason = pd.Series([None] * len(result), index=result.index, dtype=object)
+
+    def reject(mask, message):
+        mask = np.asarray(mask) & reason.isna().values
+        reason[mask] = [message(i) for i in np.nonzero(mask)[0]]
+
+    reject(~result[pt_type_column].isin(pt_types).values,
+           lambda i: f'pt_type "{result[pt_type_column].iloc[i]}" is not valid.')
+    reject(~result[cell_type_column].isin(cell_id_ranges.keys()).values,
+           lambda i: f'cell_type "{result[cell_type_column].iloc[i]}" is not valid.')
+    reject(segids == 0,
+           lambda i: f'Point {points[i]} is a location with no segmentation.')
+    existing = client.materialize.live_live_query(
+        table_name, datetime.now(timezone.utc),
+        filter_in_dict={table_name: {'pt_root_id': np.unique(segids[segids != 0]).tolist()}},
+        allow_missing_lookups=lookup.allow_missing_lookups
+    )
+    existing = lookup._merge_recent_writes(existing, table_name, segids=segids)
+    existing = existing.drop_duplicates('pt_root_id').set_index('pt_root_id')[column_name]
+    reject(np.isin(segids, existing.index.values),
+           lambda i: f'Segment {segids[i]} already has a cell ID, {existing[segids[i]]}.')
+    reject(pd.Series(segids).duplicated().values,
+           lambda i: f'Segment {segids[i]} is in more than one row.')
+
+    ok = reason.isna().values
+    cell_ids = pd.Series(pd.NA, index=result.index, dtype='Int64')
+    allocator = get_cell_id_allocator(cell_ids_table)
+    for cell_type, rows in result[ok].groupby(cell_type_column).groups.items():
+        try:
+            cell_ids[rows] = allocator.allocate(cell_type, len(rows), reserve=not fake)
+        except ValueError as e:
+            reason[rows] = str(e)
+    result['pt_root_id'] = segids
+    result['cell_id'] = cell_ids
+
+    stage = client.annotation.stage_annotations(table_name, id_field=True)
+    staged_rows = np.nonzero(reason.isna().values)[0]
+    staged = []
+    for i in staged_rows:
+        row = {'id': int(cell_ids.iloc[i]),
+               column_name: int(cell_ids.iloc[i]),
+               'pt_position': points[i],
+               'tag': result[pt_type_column].iloc[i],
+               'valid': True}
+        stage.add(**row)
+        staged.append(row)
+
+    status = np.where(reason.isna().values, 'would upload', 'not allowed').astype(object)
+    annotation_status = np.full(len(result), None, dtype=object)
+    annotation_reason = pd.Series([None] * len(result), index=result.index, dtype=object)
+    if not fake and len(staged_rows) > 0:
+        ids, error = _upload_in_batches(client, table_name, staged, batch_size,
+                                        id_field=True)
+        uploaded = len(ids)
+        status[staged_rows[:uploaded]] = 'uploaded'
+        status[staged_rows[uploaded:]] = 'upload failed'
+        reason.iloc[staged_rows[uploaded:]] = f'{type(error).__name__}: {error}'
+        lookup.record_uploaded_annotations(table_name, [
+            {**row, 'pt_root_id': int(segids[i])}
+            for i, row in zip(staged_rows[:uploaded], staged)
+        ])
+        annotated = annotate_neurons(pd.DataFrame({
+            'neuron': segids[staged_rows[:uploaded]],
+            'annotation': [_cell_type_annotations[cell_type] for cell_type
+                           in result[cell_type_column].iloc[staged_rows[:uploaded]]]
+        }), user_id)
+        annotation_status[staged_rows[:uploaded]] = annotated['status'].values
+        annotation_reason.iloc[staged_rows[:uploaded]] = annotated['reason'].values
+    result['status'] = status
+    result['reason'] = reason
+    result['annotation_status'] = annotation_status
+    result['annotation_reason'] = annotation_reason
+    n_failed = np.isin(annotation_status, ['not allowed', 'upload failed']).sum()
+    if n_failed:
+        print(f'WARNING: {n_failed} new cells got a cell ID but not their'
+              ' cell type annotation. See the "annotation_reason" column.')
+    return result
 
 
 def annotate_neuron(neuron: 'segID (int) or point (xyz)',
@@ -245,7 +523,8 @@ def annotate_neuron(neuron: 'segID (int) or point (xyz)',
         )
         print(f'Success posting parent annotation "{e.missing_annotation}"'
               f' with ID {parent_posting_result}')
-        time.sleep(3)
+        # The parent annotation was recorded by lookup.record_uploaded_annotations,
+        # so this check sees it even if the server doesn't return it yet
         allowed_to_post = annotations.is_allowed_to_post(segid, annotation,
                                                          table_name=table_name,
                                                          raise_errors=True)
@@ -258,26 +537,30 @@ def annotate_neuron(neuron: 'segID (int) or point (xyz)',
 
     if 'tag' not in stage.fields:
         if 'valid_id' in stage.fields and 'proofread' in stage.fields:
-            stage.add(pt_position=point,
-                      valid_id=int(segid),
-                      proofread=annotation,
-                      user_id=user_id)
+            row = dict(pt_position=point,
+                       valid_id=int(segid),
+                       proofread=annotation,
+                       user_id=user_id)
         else:
             raise ValueError(f'Table "{table_name}" is not a supported schema.')
     elif isinstance(annotation, tuple):
         assert len(annotation) == 2
-        stage.add(pt_position=point,
-                  tag=annotation[1],
-                  tag2=annotation[0],
-                  user_id=user_id)
+        row = dict(pt_position=point,
+                   tag=annotation[1],
+                   tag2=annotation[0],
+                   user_id=user_id)
     elif isinstance(annotation, str):
-        stage.add(pt_position=point,
-                  tag=annotation,
-                  user_id=user_id)
+        row = dict(pt_position=point,
+                   tag=annotation,
+                   user_id=user_id)
     else:
         raise TypeError('annotation must be a string or a tuple of 2 strings')
+    stage.add(**row)
 
-    response = client.annotation.upload_staged_annotations(stage)
+    response = client.annotation.upload_staged_annotations(stage, retries=1)
+    lookup.record_uploaded_annotations(table_name, [
+        {**row, 'id': response[0], 'pt_root_id': int(segid)}
+    ])
     if not isinstance(parent_posting_result, list):
         parent_posting_result = [parent_posting_result]
     response = parent_posting_result + response
@@ -287,6 +570,196 @@ def annotate_neuron(neuron: 'segID (int) or point (xyz)',
         return response
 
 
+def annotate_neurons(neurons_and_annotations: pd.DataFrame,
+                     user_id: int,
+                     table_name='cell_info',
+                     neuron_column='neuron',
+                     annotation_column='annotation',
+                     convert_given_point_to_anchor_point=True,
+                     resolve_duplicate_anchor_points=False,
+                     select_nth_anchor_point=0,
+                     batch_size=10_000,
+                     fake=False) -> pd.DataFrame:
+    """
+    Upload many annotations to a CAVE table at once. This does the same
+    checks as `annotate_neuron()`, but with a few bulk queries for all rows
+    instead of several queries per row, and uploads everything from a single
+    staged set of annotations.
+
+    Rows are checked as if they were posted in order, so a row may provide
+    the parent annotation needed by a later row (e.g. 'primary class:
+    sensory neuron' followed by 'sensory neuron: photoreceptor neuron' for
+    the same neuron). Rows that fail a check are reported and skipped, and
+    all other rows are still uploaded.
+
+    Arguments
+    ---------
+    neurons_and_annotations: pd.DataFrame
+        Table with one row per annotation to upload. The `neuron_column`
+        holds segment IDs or xyz point coordinates, and the
+        `annotation_column` holds annotations in any format accepted by
+        `annotate_neuron()`.
+
+    user_id: int
+        The CAVE user ID number to associate with these annotations
+
+    table_name: str
+        Name of the CAVE table to upload information to. See
+        `annotate_neuron()` for supported table schemas.
+
+    neuron_column, annotation_column: str
+        Names of the columns of `neurons_and_annotations` to use.
+
+    convert_given_point_to_anchor_point, resolve_duplicate_anchor_points,
+    select_nth_anchor_point:
+        See `annotate_neuron()`.
+
+    batch_size: int
+        Maximum number of annotations to upload per request.
+
+    fake: bool
+        If True, do all the checks but don't upload anything.
+
+    Returns
+    -------
+    pd.DataFrame: A copy of `neurons_and_annotations` with these columns added:
+        'pt_root_id': The segment ID of each row's neuron.
+        'pt_position': The point that was (or would be) posted.
+        'status': One of 'uploaded', 'not allowed', 'upload failed', or (if
+            `fake` is True) 'would upload'.
+        'reason': Why the row was not uploaded, or None.
+        'annotation_id': The ID of the new annotation, if uploaded.
+    """
+    if not isinstance(user_id, (int, np.integer)):
+        raise TypeError(f'user_id must be an integer but got "{user_id}".')
+    client = auth.get_caveclient()
+    result = neurons_and_annotations.copy()
+    n = len(result)
+    neurons = result[neuron_column].tolist()
+    segids = np.zeros(n, dtype=np.int64)
+    points = [None] * n
+    reason = pd.Series([None] * n, index=result.index, dtype=object)
+
+    def reject(mask, message):
+        mask = np.asarray(mask) & reason.isna().values
+        reason[mask] = [message(i) for i in np.nonzero(mask)[0]]
+
+    # Look up the segment IDs of all given points at once
+    is_segid = np.array([isinstance(neuron, (int, np.integer)) for neuron in neurons],
+                        dtype=bool)
+    given_points = [i for i in range(n) if not is_segid[i]]
+    if given_points:
+        try:
+            pts = np.vstack([np.asarray(neurons[i]).reshape(3) for i in given_points])
+        except (TypeError, ValueError):
+            raise TypeError(f'Column "{neuron_column}" must contain segIDs or'
+                            ' point coordinates.')
+        segids[given_points] = lookup.segid_from_pt(pts)
+        for i, point in zip(given_points, pts):
+            points[i] = point
+    segids[is_segid] = [int(neurons[i]) for i in np.nonzero(is_segid)[0]]
+    reject(~is_segid & (segids == 0),
+           lambda i: f'Point {neurons[i]} is a location with no segmentation.')
+
+    # Check that all given segment IDs are current, in one query
+    given_segids = np.unique(segids[is_segid])
+    if len(given_segids) > 0:
+        is_latest = np.asarray(client.chunkedgraph.is_latest_roots(given_segids))
+        reject(np.isin(segids, given_segids[~is_latest]) & is_segid,
+               lambda i: f'{neurons[i]} is not a current segment ID.')
+
+    # Look up anchor points for all segments that need one, in one query
+    needs_anchor = (is_segid | convert_given_point_to_anchor_point) & reason.isna().values
+    if needs_anchor.any():
+        anchor_segids = np.unique(segids[needs_anchor])
+        anchor_points = lookup.anchor_point(
+            anchor_segids,
+            resolve_duplicates=resolve_duplicate_anchor_points,
+            select_nth_duplicate=select_nth_anchor_point,
+            raise_not_found=False
+        )
+        for i in np.nonzero(needs_anchor)[0]:
+            points[i] = anchor_points[np.searchsorted(anchor_segids, segids[i])]
+        reject(needs_anchor & np.array([np.isnan(np.asarray(p, dtype=float)).any()
+                                        if p is not None else False
+                                        for p in points]),
+               lambda i: f'No anchor point found for segment {segids[i]}.')
+    result['pt_root_id'] = segids
+    result['pt_position'] = points
+
+    # Check all rows against the table's rules at once
+    ok = reason.isna().values
+    to_post = result[annotation_column].tolist()
+    if table_name in annotations.rules_governing_tables:
+        verdicts = annotations.validate_bulk(result[ok], table_name,
+                                             segid_column='pt_root_id',
+                                             annotation_column=annotation_column)
+        reason[ok] = verdicts.reason.values
+        if 'tag2' in verdicts.columns:
+            for i, pair in zip(np.nonzero(ok)[0], zip(verdicts.tag2, verdicts.tag)):
+                to_post[i] = pair
+    elif auth.get_table_metadata(table_name)['schema_type'] == 'proofreading_boolstatus_user':
+        reject([not isinstance(anno, (bool, np.bool_)) for anno in to_post],
+               lambda i: f'Table "{table_name}" only uses True/False annotations.')
+        existing = client.materialize.live_live_query(
+            table_name,
+            datetime.now(timezone.utc),
+            filter_in_dict={table_name: {'valid_id': np.unique(segids[ok]).tolist()}},
+            allow_missing_lookups=lookup.allow_missing_lookups
+        )
+        existing = lookup._merge_recent_writes(existing, table_name)
+        keys = pd.MultiIndex.from_arrays([segids, [str(anno) for anno in to_post]])
+        reject(keys.isin(pd.MultiIndex.from_arrays([existing.valid_id.values,
+                                                    existing.proofread.astype(str)]))
+               | keys.duplicated(),
+               lambda i: f'Segment {segids[i]} already has this annotation'
+                         f' in the table "{table_name}".')
+
+    # Stage all allowed rows together
+    stage = client.annotation.stage_annotations(table_name)
+    if 'tag' not in stage.fields and not ('valid_id' in stage.fields and
+                                          'proofread' in stage.fields):
+        raise ValueError(f'Table "{table_name}" is not a supported schema.')
+    staged_rows = np.nonzero(reason.isna().values)[0]
+    staged = []
+    for i in staged_rows:
+        annotation = to_post[i]
+        if 'tag' not in stage.fields:
+            row = dict(pt_position=points[i],
+                       valid_id=int(segids[i]),
+                       proofread=bool(annotation),
+                       user_id=user_id)
+        elif isinstance(annotation, tuple):
+            row = dict(pt_position=points[i],
+                       tag=annotation[1],
+                       tag2=annotation[0],
+                       user_id=user_id)
+        else:
+            row = dict(pt_position=points[i],
+                       tag=annotation,
+                       user_id=user_id)
+        stage.add(**row)
+        staged.append(row)
+
+    status = np.where(reason.isna().values, 'would upload', 'not allowed').astype(object)
+    annotation_ids = pd.Series(pd.NA, index=result.index, dtype='Int64')
+    if not fake and len(staged_rows) > 0:
+        ids, error = _upload_in_batches(client, table_name, staged, batch_size)
+        uploaded = []
+        for i, row, annotation_id in zip(staged_rows, staged, ids):
+            status[i] = 'uploaded'
+            annotation_ids.iloc[i] = annotation_id
+            uploaded.append({**row, 'id': annotation_id,
+                             'pt_root_id': int(segids[i])})
+        lookup.record_uploaded_annotations(table_name, uploaded)
+        status[staged_rows[len(ids):]] = 'upload failed'
+        reason.iloc[staged_rows[len(ids):]] = f'{type(error).__name__}: {error}'
+    result['status'] = status
+    result['reason'] = reason
+    result['annotation_id'] = annotation_ids
+    return result
+
+
 def delete_annotation(segid: int,
                       annotation: str,
                       user_id: int,
@@ -347,6 +820,7 @@ def delete_annotation(segid: int,
             assert anno_returned in [anno_raw.get('proofread', -1),
                                      anno_raw.get('tag', -1)]
             client.annotation.delete_annotation(table_name, match['id'])
+            lookup.record_deleted_annotations(table_name, [match['id']])
             return (table_name,
                     match['id'],
                     client.annotation.get_annotation(table_name, match['id'])[0])
@@ -365,6 +839,608 @@ def delete_annotation(segid: int,
                      f' in these tables/columns: {annotation_sources}')
 
 
+def delete_annotations(rows,
+                       user_id: int,
+                       annotation_sources=lookup.default_annotation_sources,
+                       dry_run=False,
+                       max_workers=8) -> pd.DataFrame:
+    """
+    Delete many annotations from CAVE tables at once. This applies the same
+    rules as `delete_annotation()` (users may only delete annotations they
+    made themselves), but looks up all requested annotations with one query
+    per table (run concurrently), verifies them all with one point-to-segment
+    lookup, and deletes them with one request per table.
+
+    Arguments
+    ---------
+    rows: pd.DataFrame with columns 'pt_root_id' and 'annotation', OR
+          list of (segid, annotation) 2-tuples
+        The annotations to delete, and the segments to delete them from.
+
+    user_id: int
+        The CAVE user ID who is requesting the deletion. Users
+        may only delete annotations that they themselves have made.
+
+    annotation_sources: list of 2-tuples of str
+        List of (table_name, tag_column) pairs to search for the annotations.
+        If an annotation is found in multiple tables, it is deleted from the
+        first table in this list that has a match.
+
+    dry_run: bool
+        If True, do all the checks but don't delete anything.
+
+    max_workers: int
+        Maximum number of tables to query at the same time.
+
+    Returns
+    -------
+    pd.DataFrame: One row per requested deletion, with columns 'pt_root_id',
+        'annotation', 'table_name', 'annotation_id', 'status' (one of
+        'deleted', 'would delete' or 'not deleted') and 'reason' (why the
+        annotation was not deleted, or None).
+    """
+    if not isinstance(rows, pd.DataFrame):
+        rows = pd.DataFrame(list(rows), columns=['pt_root_id', 'annotation'])
+    report = rows[['pt_root_id', 'annotation']].reset_index(drop=True)
+    report['pt_root_id'] = report['pt_root_id'].astype(np.int64)
+    report['table_name'] = None
+    report['annotation_id'] = pd.Series(pd.NA, index=report.index, dtype='Int64')
+    report['reason'] = None
+
+    if isinstance(annotation_sources, str):
+        annotation_sources = [(annotation_sources, 'tag')]
+    if not isinstance(annotation_sources, list):
+        raise TypeError('annotation_sources is an unexpected type. See docstring.')
+
+    client = auth.get_caveclient()
+    segids = report['pt_root_id'].unique()
+    is_latest = np.asarray(client.chunkedgraph.is_latest_roots(segids))
+    stale = report['pt_root_id'].isin(segids[~is_latest])
+    report.loc[stale, 'reason'] = [f'{segid} is not a current segment ID.'
+                                   for segid in report.loc[stale, 'pt_root_id']]
+
+    # Find all annotations on these segments, querying all tables concurrently
+    timestamp = datetime.now(timezone.utc)
+    def query(source):
+        table_name, _ = source
+        return client.materialize.live_live_query(
+            table_name, timestamp,
+            filter_in_dict={table_name: {'pt_root_id': segids[is_latest].tolist()}},
+            allow_missing_lookups=lookup.allow_missing_lookups
+        )
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(query, annotation_sources))
+
+    # Match each requested deletion to an annotation made by this user. If
+    # the same deletion is requested several times, use different matches.
+    claimed = set()
+    matched_columns = {}
+    owners = {}
+    for i in report.index[report.reason.isna()]:
+        segid, annotation = report.at[i, 'pt_root_id'], report.at[i, 'annotation']
+        others = None
+        for (table_name, annotation_column), table in zip(annotation_sources, tables):
+            if annotation.replace(' ', '_') == table_name:
+                matches = table.loc[(table.pt_root_id == segid) &
+                                    (table[annotation_column] == True)]
+            elif annotation_column in table.columns:
+                matches = table.loc[(table.pt_root_id == segid) &
+                                    (table[annotation_column] == annotation)]
+            else:
+                continue
+            user_ids = (matches['user_id'] if 'user_id' in matches.columns
+                        else pd.Series(None, index=matches.index, dtype=object))
+            mine = [annotation_id for annotation_id in matches.loc[user_ids == user_id, 'id']
+                    if (table_name, annotation_id) not in claimed]
+            if mine:
+                claimed.add((table_name, mine[0]))
+                report.at[i, 'table_name'] = table_name
+                report.at[i, 'annotation_id'] = mine[0]
+                matched_columns[i] = annotation_column
+                break
+            if others is None and not matches.empty:
+                # Prefer reporting an annotation made by someone else
+                not_mine = user_ids.loc[user_ids != user_id]
+                others = (table_name, not_mine.iloc[0] if len(not_mine)
+                          else user_ids.iloc[0])
+        else:
+            if others is not None and others[1] == user_id:
+                report.at[i, 'reason'] = (f'Annotation "{annotation}" on segment'
+                                          f' {segid} was requested more times'
+                                          ' than it exists.')
+            elif others is None:
+                report.at[i, 'reason'] = (f'Annotation "{annotation}" on segment'
+                                          f' {segid} not found in these'
+                                          f' tables/columns: {annotation_sources}')
+            elif others[1] is None or pd.isna(others[1]):
+                report.at[i, 'reason'] = (f'Annotation "{annotation}" on segment'
+                                          f' {segid} is in table "{others[0]}"'
+                                          ' which does not support this operation.'
+                                          ' Contact an admin if you think this'
+                                          ' annotation should be removed.')
+            else:
+                owners[i] = int(others[1])
+
+    # Say who owns the annotations this user isn't allowed to delete
+    if owners:
+        try:
+            names = {info['id']: info['name'] for info in
+                     client.auth.get_user_information(sorted(set(owners.values())))}
+        except Exception:
+            names = {}
+        for i, owner in owners.items():
+            owner = (f'{names[owner]} (ID {owner})' if owner in names
+                     else f'the user with ID {owner}')
+            report.at[i, 'reason'] = (f'Annotation "{report.at[i, "annotation"]}"'
+                                      f' on segment {report.at[i, "pt_root_id"]}'
+                                      ' can only be deleted by the user who'
+                                      f' made it, {owner}.')
+
+    # Verify, with one query per table and one point lookup in total, that
+    # each annotation is this user's, still has the requested tag, and its
+    # point is still on the segment
+    matched = report.index[report.annotation_id.notna()]
+    if len(matched) > 0:
+        ids_by_table = report.loc[matched].groupby('table_name')['annotation_id']
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            raw = dict(zip(ids_by_table.groups.keys(), executor.map(
+                lambda item: client.annotation.get_annotation(
+                    item[0], [int(annotation_id) for annotation_id in item[1]]),
+                ids_by_table)))
+        raw = {(table_name, anno['id']): anno
+               for table_name, annos in raw.items() for anno in annos}
+        raw_annos = [raw.get((report.at[i, 'table_name'],
+                              int(report.at[i, 'annotation_id'])))
+                     for i in matched]
+        points_segids = lookup.segid_from_pt(np.vstack(
+            [anno['pt_position'] if anno is not None else [0, 0, 0]
+             for anno in raw_annos]))
+        for i, anno, point_segid in zip(matched, raw_annos, points_segids):
+            annotation = report.at[i, 'annotation']
+            if annotation.replace(' ', '_') == report.at[i, 'table_name']:
+                expected = True
+            else:
+                expected = annotation
+            if anno is None:
+                report.at[i, 'reason'] = (f'Annotation {report.at[i, "annotation_id"]}'
+                                          ' could not be found.')
+            elif anno.get('user_id') != user_id:
+                report.at[i, 'reason'] = (f'Annotation {report.at[i, "annotation_id"]}'
+                                          ' was made by the user with ID'
+                                          f' {anno.get("user_id")}, not by the'
+                                          f' requesting user (ID {user_id}).')
+            elif anno.get(matched_columns[i]) != expected:
+                report.at[i, 'reason'] = (f'Annotation {report.at[i, "annotation_id"]}'
+                                          f' is "{anno.get(matched_columns[i])}",'
+                                          f' not "{annotation}".')
+            elif point_segid != report.at[i, 'pt_root_id']:
+                report.at[i, 'reason'] = (f'The point of annotation'
+                                          f' {report.at[i, "annotation_id"]} is no'
+                                          f' longer on segment'
+                                          f' {report.at[i, "pt_root_id"]}.')
+
+    to_delete = report.annotation_id.notna() & report.reason.isna()
+    report['status'] = np.where(to_delete, 'would delete', 'not deleted').astype(object)
+    if not dry_run:
+        for table_name, ids in report.loc[to_delete].groupby('table_name')['annotation_id']:
+            try:
+                client.annotation.delete_annotation(
+                    table_name, [int(annotation_id) for annotation_id in ids])
+            except HTTPError as e:
+                report.loc[ids.index, 'status'] = 'not deleted'
+                report.loc[ids.index, 'reason'] = f'Deletion failed: {e}'
+                continue
+            lookup.record_deleted_annotations(table_name, ids.astype(int).tolist())
+            report.loc[ids.index, 'status'] = 'deleted'
+    return report[['pt_root_id', 'annotation', 'table_name', 'annotation_id',
+                   'status', 'reason']]
+
+
+def _to_json(row: dict) -> str:
+    return json.dumps(row, sort_keys=True,
+                      default=lambda x: x.tolist() if hasattr(x, 'tolist') else str(x))
+
+
+class UploadQueue(object):
+    """
+    Collect annotations from many callers and upload them to CAVE in the
+    background, in batches grouped by table.
+
+    Every annotation is first saved to a local SQLite journal, so nothing is
+    lost if the process stops. When a queue is created on an existing
+    journal, pending annotations are uploaded again. Annotations that were
+    being uploaded when the process stopped get status 'unknown', because
+    they may or may not have reached the server. Check them in CAVE, then
+    requeue them with `retry('unknown')` if needed.
+
+    Several processes may share a journal. Each batch is claimed in a
+    single write transaction, so no two queues upload the same annotation,
+    and claimed annotations record which queue is uploading them. They are
+    only marked 'unknown' once that queue's process has exited (checked by
+    PID on the same host) or its lease has expired.
+
+    Each annotation has an idempotency key, by default derived from its table
+    and contents. Adding an annotation whose key is already in the journal
+    does nothing, so a caller that retries after a crash won't post
+    duplicates.
+
+    Annotations are uploaded as given, without any of the checks that
+    `annotate_neuron()` does. Check them first, for example with
+    `annotations.validate_bulk()`.
+
+    Example
+    -------
+    >>> queue = UploadQueue()
+    >>> key = queue.put('cell_info', {'pt_position': [1, 2, 3],
+    ...                               'tag': 'neuron', 'user_id': 123},
+    ...                 segid=720575940000000000)
+    >>> queue.wait([key])
+    """
+    statuses = ('pending', 'in flight', 'uploaded', 'failed', 'unknown')
+
+    def __init__(self, journal_path=None, batch_size=1000, flush_interval=2.0,
+                 start=True, lease=3600):
+        """
+        Arguments
+        ---------
+        journal_path: str or None
+            Path of the SQLite journal. If None, uses
+            auth.configs['upload_journal'].
+
+        batch_size: int
+            Maximum number of annotations to upload per request.
+
+        flush_interval: float
+            Seconds the background worker waits between uploads, letting
+            annotations from many callers accumulate into batches. Reaching
+            batch_size pending annotations triggers an upload right away.
+
+        start: bool
+            If True, start the background worker now. Otherwise call
+            `start()` later, or call `flush()` to upload on demand.
+
+        lease: float
+            Seconds after which another queue may assume an upload claimed by
+            this queue was interrupted, even if this queue's process can't be
+            checked (e.g. because it runs on another host). Must be longer
+            than uploading one batch can take.
+        """
+        if journal_path is None:
+            journal_path = auth.configs['upload_journal']
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lease = lease
+        self._owner = f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}'
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+        self._db = sqlite3.connect(journal_path, check_same_thread=False,
+                                   isolation_level=None, timeout=60)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                ' key TEXT PRIMARY KEY,'
+                ' table_name TEXT NOT NULL,'
+                ' row TEXT NOT NULL,'
+                ' pt_root_id INTEGER,'
+                ' status TEXT NOT NULL,'
+                ' annotation_id INTEGER,'
+                ' error TEXT,'
+                ' created REAL NOT NULL,'
+                ' updated REAL NOT NULL,'
+                ' owner TEXT,'
+                ' lease REAL)'
+            )
+            # Journals written before uploads had owners
+            columns = [c[1] for c in self._db.execute('PRAGMA table_info(uploads)')]
+            for column, column_type in [('owner', 'TEXT'), ('lease', 'REAL')]:
+                if column not in columns:
+                    self._db.execute(f'ALTER TABLE uploads ADD COLUMN {column} {column_type}')
+            self._db.execute('CREATE INDEX IF NOT EXISTS uploads_status'
+                             ' ON uploads (status, table_name)')
+        _upload_queue_owners.add(self._owner)
+        self._release_abandoned()
+        if start:
+            self.start()
+
+    def put(self, table_name: str, row: dict, key: str = None,
+            segid: int = None) -> str:
+        """
+        Add an annotation to the queue.
+
+        Arguments
+        ---------
+        table_name: str
+            The CAVE table to upload the annotation to.
+
+        row: dict
+            The annotation, as keyword arguments for `stage.add()`.
+
+        key: str or None
+            Idempotency key. If None, a hash of table_name and row is used.
+
+        segid: int or None
+            The segment the annotation is on, if known. Once uploaded, the
+            annotation is then passed to `lookup.record_uploaded_annotations()`
+            so that lookups include it right away.
+
+        Returns
+        -------
+        str: The annotation's key
+        """
+        return self.put_many(table_name, [row],
+                             None if key is None else [key],
+                             None if segid is None else [segid])[0]
+
+    def put_many(self, table_name: str, rows: list, keys: list = None,
+                 segids: list = None) -> list:
+        """
+        Add many annotations for the same table to the queue. See `put()`.
+        """
+        rows = [_to_json(row) for row in rows]
+        if segids is None:
+            segids = [None] * len(rows)
+        segids = [None if segid is None else int(segid) for segid in segids]
+        if keys is None:
+            keys = [hashlib.sha256(f'{table_name}\n{row}'.encode()).hexdigest()
+                    for row in rows]
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT OR IGNORE INTO uploads (key, table_name, row, pt_root_id,'
+                " status, created, updated) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                [(key, table_name, row, segid, now, now)
+                 for key, row, segid in zip(keys, rows, segids)]
+            )
+            self._db.execute('COMMIT')
+            n_pending = self._db.execute("SELECT COUNT(*) FROM uploads"
+                                         " WHERE status = 'pending'").fetchone()[0]
+        if n_pending >= self.batch_size:
+            self._wake.set()
+        return list(keys)
+
+    def status(self, keys: list = None) -> pd.DataFrame:
+        """
+        Get the status of annotations in the journal.
+
+        Arguments
+        ---------
+        keys: list of str or None
+            Keys of the annotations to get. If None, get all annotations.
+
+        Returns
+        -------
+        pd.DataFrame indexed by key, with columns 'table_name', 'row',
+        'status', 'annotation_id' and 'error'. Only includes keys that are in
+        the journal.
+        """
+        query = 'SELECT key, table_name, row, status, annotation_id, error FROM uploads'
+        with self._lock:
+            if keys is None:
+                result = self._db.execute(query).fetchall()
+            else:
+                result = []
+                keys = list(keys)
+                for i in range(0, len(keys), 900):  # SQLite's parameter limit
+                    chunk = keys[i:i+900]
+                    result += self._db.execute(
+                        query + f' WHERE key IN ({",".join("?" * len(chunk))})',
+                        chunk).fetchall()
+        result = pd.DataFrame(result, columns=['key', 'table_name', 'row', 'status',
+                                               'annotation_id', 'error'])
+        result['row'] = result['row'].map(json.loads)
+        result['annotation_id'] = result['annotation_id'].astype('Int64')
+        return result.set_index('key')
+
+    def wait(self, keys: list = None, timeout=None) -> pd.DataFrame:
+        """
+        Wait until the given annotations (or all annotations, if keys is None)
+        are no longer pending or in flight, then return their `status()`.
+        Raises TimeoutError if that takes more than timeout seconds.
+        """
+        start = time.time()
+        while True:
+            result = self.status(keys)
+            if not result.status.isin(['pending', 'in flight']).any():
+                return result
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f'Uploads not done after {timeout} seconds.')
+            if self._worker is None or not self._worker.is_alive():
+                self.flush()
+            else:
+                self._wake.set()
+                time.sleep(0.1)
+
+    def retry(self, statuses=('failed',)) -> int:
+        """
+        Requeue annotations with the given status(es), for example after
+        fixing the cause of a failure. Returns how many were requeued.
+        """
+        if isinstance(statuses, str):
+            statuses = [statuses]
+        with self._lock:
+            n = self._db.execute(
+                "UPDATE uploads SET status = 'pending', error = NULL, owner = NULL,"
+                ' lease = NULL, updated = ?'
+                f' WHERE status IN ({",".join("?" * len(statuses))})',
+                (time.time(), *statuses)).rowcount
+        self._wake.set()
+        return n
+
+    def _set_status(self, updates):
+        """
+        Record the outcome of uploads claimed by this queue.
+        updates: list of (status, annotation_id, error, key) tuples
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany(
+                'UPDATE uploads SET status = ?, annotation_id = ?, error = ?,'
+                ' lease = NULL, updated = ? WHERE key = ? AND owner = ?',
+                [(status, annotation_id, error, now, key, self._owner)
+                 for status, annotation_id, error, key in updates]
+            )
+            self._db.execute('COMMIT')
+
+    @staticmethod
+    def _is_abandoned(owner, lease, now):
+        """
+        Whether an upload claimed by `owner` was interrupted: its process has
+        exited, or (for queues on other hosts) its lease has expired.
+        """
+        if owner is None or (lease is not None and lease < now):
+            return True
+        host, pid, _ = owner.split(' ')
+        if host != socket.gethostname():
+            return False
+        if int(pid) == os.getpid():
+            return owner not in _upload_queue_owners
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:  # e.g. the process belongs to another user
+            pass
+        return False
+
+    def _release_abandoned(self):
+        """
+        Mark annotations whose upload was interrupted as 'unknown', since
+        they may or may not have reached the server.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                abandoned = [(now, key) for key, owner, lease in self._db.execute(
+                    "SELECT key, owner, lease FROM uploads WHERE status = 'in flight'")
+                    if self._is_abandoned(owner, lease, now)]
+                self._db.executemany("UPDATE uploads SET status = 'unknown',"
+                                     ' updated = ? WHERE key = ?', abandoned)
+            finally:
+                self._db.execute('COMMIT')
+
+    def _claim_batch(self):
+        """
+        Claim up to batch_size pending annotations for the same table, in a
+        single write transaction so that no other queue sharing the journal
+        can claim them too. Returns (table_name, [(key, row, segid), ...]),
+        or (None, []) if nothing is pending.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                pending = self._db.execute(
+                    "SELECT table_name FROM uploads WHERE status = 'pending'"
+                    ' ORDER BY created LIMIT 1').fetchone()
+                if pending is None:
+                    return None, []
+                table_name = pending[0]
+                batch = self._db.execute(
+                    'SELECT key, row, pt_root_id FROM uploads WHERE status = ?'
+                    ' AND table_name = ? ORDER BY created LIMIT ?',
+                    ('pending', table_name, self.batch_size)).fetchall()
+                self._db.executemany(
+                    "UPDATE uploads SET status = 'in flight', owner = ?,"
+                    ' lease = ?, updated = ? WHERE key = ?',
+                    [(self._owner, now + self.lease, now, key)
+                     for key, _, _ in batch])
+            finally:
+                self._db.execute('COMMIT')
+        return table_name, batch
+
+    def flush(self) -> int:
+        """
+        Upload all pending annotations now, in batches grouped by table.
+        Returns how many annotations were uploaded.
+        """
+        n_uploaded = 0
+        with self._flush_lock:
+            self._release_abandoned()
+            while True:
+                table_name, batch = self._claim_batch()
+                if not batch:
+                    return n_uploaded
+                n_uploaded += self._upload_batch(table_name, batch)
+
+    def _upload_batch(self, table_name, batch):
+        client = auth.get_caveclient()
+        try:
+            stage = client.annotation.stage_annotations(table_name)
+        except Exception as e:
+            self._set_status([('failed', None, f'{type(e).__name__}: {e}', key)
+                              for key, _, _ in batch])
+            return 0
+        staged, updates = [], []
+        for key, row, segid in batch:
+            row = json.loads(row)
+            try:
+                stage.add(**row)
+                staged.append((key, row, segid))
+            except Exception as e:
+                updates.append(('failed', None, f'{type(e).__name__}: {e}', key))
+        ids, error = _upload_in_batches(client, table_name,
+                                        [row for _, row, _ in staged],
+                                        self.batch_size)
+        uploaded = []
+        for (key, row, segid), annotation_id in zip(staged, ids):
+            updates.append(('uploaded', int(annotation_id), None, key))
+            if segid is not None:
+                uploaded.append({**row, 'id': int(annotation_id), 'pt_root_id': segid})
+        updates += [('failed', None, f'{type(error).__name__}: {error}', key)
+                    for key, _, _ in staged[len(ids):]]
+        self._set_status(updates)
+        lookup.record_uploaded_annotations(table_name, uploaded)
+        return sum(status == 'uploaded' for status, _, _, _ in updates)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            # close() flushes itself if asked to
+            if self._stop.is_set():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                print(red(f'UploadQueue: {type(e).__name__}: {e}'))
+
+    def start(self):
+        """Start the background worker."""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, daemon=True,
+                                        name='UploadQueue')
+        self._worker.start()
+
+    def close(self, flush=True):
+        """Stop the background worker, and by default upload what's pending."""
+        self._stop.set()
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        if flush:
+            self.flush()
+        _upload_queue_owners.discard(self._owner)
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def xyz_StringSeries2List(StringSeries: pd.Series):
     pts = StringSeries.str.strip('()').str.split(',',expand=True)
     return pts.astype(int).values.tolist()
@@ -395,13 +1471,14 @@ class SomaTableOrganizer(object):
         if soma_table_name != "":
             self._soma_table_name = soma_table_name
         else:
-            self._soma_table_name = self._client.info.get_datastack_info()['soma_table'].split("neuron_")[-1]
+            self._soma_table_name = auth.get_datastack_info(client=self._client)['soma_table'].split("neuron_")[-1]
 
         self._subset_table_dict = {"neuron": "neuron_" + self._soma_table_name, "glia": "glia_" + self._soma_table_name}
 
-        self._voxel_size = [self._client.info.get_datastack_info()['viewer_resolution_x'],
-                            self._client.info.get_datastack_info()['viewer_resolution_y'],
-                            self._client.info.get_datastack_info()['viewer_resolution_z']]
+        info = auth.get_datastack_info(client=self._client)
+        self._voxel_size = [info['viewer_resolution_x'],
+                            info['viewer_resolution_y'],
+                            info['viewer_resolution_z']]
 
         if subset_table_name in list(self._subset_table_dict.keys()):
             self._subset_table_name = self._subset_table_dict[subset_table_name]
@@ -450,47 +1527,57 @@ class SomaTableOrganizer(object):
         self._subset_table_dict = value
 
     def _required_props(self):
-        return self._client.schema.schema_definition('nucleus_detection')['definitions']['NucleusDetection']['required']
+        return auth.get_schema_definition('nucleus_detection', client=self._client)['definitions']['NucleusDetection']['required']
 
     def add_radius_column(self, soma_table):
         if ('bb_start_position' not in soma_table.columns) or ('bb_end_position' not in soma_table.columns):
             raise ValueError("Need 'bb_start_position' and 'bb_end_position' columns.")
 
-        soma_table['radius_nm'] = 0
-        for i, r in soma_table.iterrows():
-            if soma_table['bb_start_position'][i] is not np.nan and soma_table['bb_end_position'][i] is not np.nan:
-                dist = np.array(soma_table['bb_end_position'][i]) - np.array(soma_table['bb_start_position'][i])
-                soma_table.at[i,'radius_nm'] = np.linalg.norm(dist[:2])/2 # distance in nm in xy plane
-            else:
-                soma_table.at[i,'radius_nm'] = 10 # np.nan
+        has_bbox = (soma_table['bb_start_position'].map(np.ndim).eq(1) &
+                    soma_table['bb_end_position'].map(np.ndim).eq(1)).values
+        radius = np.full(len(soma_table), 10.0)  # Default for somas without a bounding box
+        if has_bbox.any():
+            dist = (np.stack(soma_table['bb_end_position'].values[has_bbox]) -
+                    np.stack(soma_table['bb_start_position'].values[has_bbox]))
+            radius[has_bbox] = np.linalg.norm(dist[:, :2], axis=1) / 2  # distance in nm in xy plane
+        soma_table['radius_nm'] = radius
         return soma_table
 
     @staticmethod
     def find_manual_ids(existing_ids, initial_digit=1):
-        initials = [int(str(i)[0]) for i in existing_ids]
-        idx = np.where(np.array(initials)==initial_digit)
-        return existing_ids[idx]
+        existing_ids = np.asarray(existing_ids, dtype=np.int64)
+        # Leading digit of each ID, computed with exact integer arithmetic
+        powers_of_ten = 10 ** np.arange(19, dtype=np.int64)
+        n_digits = np.searchsorted(powers_of_ten, existing_ids, side='right')
+        initials = existing_ids // powers_of_ten[np.maximum(n_digits - 1, 0)]
+        return existing_ids[(existing_ids > 0) & (initials == initial_digit)]
+
+    def _max_man_id(self, initial_digit=1, digit=17):
+        ExistingID = self.find_manual_ids(self._soma_table.id.values, initial_digit=initial_digit)
+        if len(ExistingID) > 0:
+            return ExistingID.max()
+        return initial_digit * 10**(digit-1)
 
     def _get_man_id(self, initial_digit=1, digit=17):
-        ExistingID = self.find_manual_ids(self._soma_table.id.values, initial_digit=1)
-        if len(ExistingID) >0:
-            MaxExistingID = np.max(ExistingID)
-        else:
-            MaxExistingID = initial_digit*10**(digit-1)
-        return MaxExistingID + 1
+        return self._max_man_id(initial_digit, digit) + 1
 
     def _get_man_id_column(self, length, initial_digit=1, digit=17):
-        ExistingID = self.find_manual_ids(self._soma_table.id.values, initial_digit=1)
-        if len(ExistingID) >0:
-            MaxExistingID = np.max(ExistingID)
-        else:
-            MaxExistingID =initial_digit*10**(digit-1)
-        return [MaxExistingID + i for i in range(1, 1+length)]
+        return self._max_man_id(initial_digit, digit) + np.arange(1, 1+length, dtype=np.int64)
 
     def _check_change(self, table_name, timestamp=datetime.utcnow()):
         try:
             return self._client.materialize.live_live_query(table_name, timestamp, allow_missing_lookups=False).reset_index(level=0)
         except HTTPError as e:
+            status = getattr(e.response, 'status_code', None)
+            if status == 429:
+                raise UpdateUnsuccessful(red(
+                    'CAVE is rate limiting requests (HTTP 429) and retries'
+                    ' ran out. Try again in a few minutes, or lower'
+                    ' auth.rate_limiter.max_rate.')) from e
+            if status is not None and status >= 500:
+                raise UpdateUnsuccessful(red(
+                    f'CAVE server error (HTTP {status}), still failing after'
+                    f' retries: {e.response.text}')) from e
             raise UpdateUnsuccessful(red(e.response.text + "Please check after 1 hour. Only works between 10 AM - 12 AM PST."))
 
     def update_tables(self, timestamp=datetime.utcnow()):
@@ -552,7 +1639,31 @@ class SomaTableOrganizer(object):
                                         client=self._client,
                                         annotation_units='voxels'))
 
-    def add_dataframe(self, df: pd.DataFrame, batch_size=10000):
+    def _assign_ids(self, df):
+        """
+        Fill in IDs for rows of df whose 'id' is 0 or missing, using the
+        nucleus segmentation ID at each point where there is one, and
+        otherwise a new "manual" ID above the largest existing manual ID.
+        """
+        ids = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(np.int64).values
+        missing = ids == 0
+        if missing.any():
+            nuc_ids = np.asarray(lookup.nucleusid_from_pt(np.vstack(df['pt_position'].values[missing])),
+                                 dtype=np.int64)
+            needs_man_id = nuc_ids == 0
+            man_ids = self._max_man_id() + np.cumsum(needs_man_id)
+            ids[missing] = np.where(needs_man_id, man_ids, nuc_ids)
+        df['id'] = ids
+        return df
+
+    def _upload_batch(self, df, table_name, schema_name):
+        stage = self._client.annotation.stage_annotations(table_name, schema_name=schema_name, id_field=True)
+        stage.add_dataframe(df)
+        self._client.annotation.upload_staged_annotations(stage, retries=1)
+        stage.clear_annotations()
+
+    def add_dataframe(self, df: pd.DataFrame, batch_size=10000,
+                      max_workers=4, checkpoint=None):
         """
         Add dataframe to both soma table and subset table.
 
@@ -562,148 +1673,390 @@ class SomaTableOrganizer(object):
         batch_size: int (default 10000)
             How many annotations you upload in each batch. The CAVE server does not
             allow users to upload more than 10000 annotations at a time.
+        max_workers: int (default 4)
+            How many batches to upload at the same time. Each batch is
+            uploaded to the soma table and then to the subset table.
+        checkpoint: str or None (default None)
+            Path to a json file recording the assigned IDs and which batches
+            have been uploaded. If the upload is interrupted, call this again
+            with the same df and checkpoint to upload only the remaining
+            batches. The file is deleted once everything is uploaded.
+
+        ---Returns---
+        np.ndarray of the IDs the somas were uploaded with, in the order of df
         """
         print("Checking the format of your table...")
         self.update_tables()
-        df_i = df.reset_index(drop=True).astype({'id': np.int64})
-        id_missing_idx = np.where(df_i['id'] == 0)[0]
-
-        new_man_ids = self._get_man_id_column(len(id_missing_idx))
-        new_nuc_ids = lookup.nucleusid_from_pt(df_i['pt_position'].loc[id_missing_idx])
-        j=0
-        for i, idx in enumerate(id_missing_idx):
-            if new_nuc_ids[i] != 0:
-                df_i.at[idx, 'id'] = new_nuc_ids[i]
-            else:
-                df_i.at[idx, 'id'] = new_man_ids[j]
-                j += 1
-        self._validate(df_i)
+        df_i = df.reset_index(drop=True)
+
+        progress = None
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                progress = json.load(f)
+            if (progress['soma_table'] != self._soma_table_name
+                    or progress['subset_table'] != self._subset_table_name
+                    or len(progress['ids']) != len(df_i)
+                    or progress['batch_size'] != batch_size):
+                raise ValueError(f'Checkpoint {checkpoint} is from a different'
+                                 ' upload. Delete it or choose another path.')
+            df_i['id'] = np.array(progress['ids'], dtype=np.int64)
+            print(f"Resuming from checkpoint: {len(progress['done']['subset'])}"
+                  " batches already uploaded.")
+        else:
+            df_i = self._assign_ids(df_i)
+            progress = {'soma_table': self._soma_table_name,
+                        'subset_table': self._subset_table_name,
+                        'batch_size': batch_size,
+                        'ids': df_i['id'].tolist(),
+                        'done': {'soma': [], 'subset': []}}
+
+        batch_starts = [i for i in range(0, len(df_i), batch_size)
+                        if i not in progress['done']['subset']]
+        pending = np.concatenate([np.arange(i, min(i + batch_size, len(df_i)))
+                                  for i in batch_starts
+                                  if i not in progress['done']['soma']] or [[]]).astype(int)
+        if len(pending) > 0:
+            self._validate(df_i.iloc[pending])
         print("Ready to upload...")
 
-        if len(df_i) <= 10000:
-            stage = self._client.annotation.stage_annotations(self._soma_table_name, schema_name="nucleus_detection", id_field=True)
-            stage.add_dataframe(df_i)
-            self._client.annotation.upload_staged_annotations(stage)
-            stage.clear_annotations()
-
-            df_is = df_i.reindex(columns=['id'])
-            df_is['target_id'] = df_is['id']
-            # df_is = df_is.rename(columns={'id': 'target_id'})
-            stage = self._client.annotation.stage_annotations(self._subset_table_name, schema_name="simple_reference", id_field=True)
-            stage.add_dataframe(df_is)
-            self._client.annotation.upload_staged_annotations(stage)
-            stage.clear_annotations()
-
-        else:
-            minidfs = [df_i.loc[i:i+batch_size-1, :] for i in range(0, len(df_i), batch_size)]
-            stage = self._client.annotation.stage_annotations(self._soma_table_name, schema_name="nucleus_detection", id_field=True)
-            for dftmp in minidfs:
-                stage.add_dataframe(dftmp)
-                self._client.annotation.upload_staged_annotations(stage)
-                stage.clear_annotations()
-
-            df_is = df_i.reindex(columns=['id'])
-            df_is['target_id'] = df_is['id']
-            # df_is = df_is.rename(columns={'id': 'target_id'})
-            minidfs = [df_is.loc[i:i+batch_size-1, :] for i in range(0, len(df_is), batch_size)]
-            stage = self._client.annotation.stage_annotations(self._subset_table_name, schema_name="simple_reference", id_field=True)
-            for dftmp in minidfs:
-                stage.add_dataframe(dftmp)
-                self._client.annotation.upload_staged_annotations(stage)
-                stage.clear_annotations()
+        checkpoint_lock = threading.Lock()
+        def mark_done(table, start):
+            with checkpoint_lock:
+                progress['done'][table].append(start)
+                if checkpoint is not None:
+                    with open(checkpoint, 'w') as f:
+                        json.dump(progress, f)
+
+        def upload(start):
+            soma_batch = df_i.iloc[start:start + batch_size]
+            if start not in progress['done']['soma']:
+                self._upload_batch(soma_batch, self._soma_table_name, 'nucleus_detection')
+                mark_done('soma', start)
+            subset_batch = pd.DataFrame({'id': soma_batch['id'],
+                                         'target_id': soma_batch['id']})
+            self._upload_batch(subset_batch, self._subset_table_name, 'simple_reference')
+            mark_done('subset', start)
+
+        if checkpoint is not None:
+            with open(checkpoint, 'w') as f:
+                json.dump(progress, f)
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in [executor.submit(upload, start) for start in batch_starts]:
+                result.result()
+        if checkpoint is not None:
+            os.remove(checkpoint)
+        # Make the next get_verified_nucleus_ids() query see the new somas
+        _verified_nucleus_ids_cache.clear()
 
         # self.update_tables()
         print(green("Successfully uploaded!"))
+        return df_i['id'].values
+
+
+_all_nuclei_path = 'gs://lee-lab_female-adult-nerve-cord/alignmentV4/nuclei/nuclei_seg_Mar2022'
+_verified_nuclei_path = 'gs://lee-lab_female-adult-nerve-cord/alignmentV4/nuclei/nuclei_seg_Mar2022_verified'
+# Nuclei passed to update_verified_nuclei_layer(), as {nucleus ID: time
+# added}, since CAVE queries may not return them yet. Forgotten after
+# lookup.recent_upload_ttl seconds.
+_recently_verified_nucleus_ids = {}
+# The result of the last soma table query by get_verified_nucleus_ids(), as
+# {'ids': sorted array, 'time': time queried}. Cleared by
+# SomaTableOrganizer.add_dataframe().
+_verified_nucleus_ids_cache = {}
 
 
-def update_verified_nuclei_layer(point, cube_size_microns=16):
+def get_verified_nucleus_ids(max_age=0) -> np.ndarray:
+    """
+    Get the IDs of all nuclei that have been verified, meaning that they are
+    in the soma table with an ID from the nucleus segmentation (as opposed to
+    a "meaningless" manually assigned ID), plus 0.
+
+    By default the soma table is queried on every call, so nuclei verified by
+    anyone are included. Nuclei recently passed to
+    `update_verified_nuclei_layer()` are always included too, even if the
+    query doesn't return them yet.
+
+    Arguments
+    ---------
+    max_age: float (default 0)
+        Reuse the result of an earlier query if it is at most this many
+        seconds old, instead of querying the soma table again. Nuclei
+        verified by others since then are then missing from the result.
+
+    Returns
+    -------
+    Sorted np.ndarray of np.int64
+    """
+    cached = _verified_nucleus_ids_cache
+    if not cached or time.time() - cached['time'] > max_age:
+        now = time.time()
+        soma_table = auth.get_caveclient().materialize.live_live_query('somas_dec2022', datetime.utcnow())
+        cached['ids'] = np.unique(soma_table.loc[soma_table['id'] > 20000000000000000,
+                                                 'id'].values.astype(np.int64))
+        cached['time'] = now
+    ids = cached['ids']
+    cutoff = time.time() - lookup.recent_upload_ttl
+    for nucleus_id, added in list(_recently_verified_nucleus_ids.items()):
+        if added < cutoff:
+            _recently_verified_nucleus_ids.pop(nucleus_id, None)
+    return np.union1d(ids.astype(np.int64),
+                      [0, *_recently_verified_nucleus_ids]).astype(np.int64)
+
+
+def _remove_unverified(data, verified_ids):
+    """Set every voxel of data whose ID is not in verified_ids to 0."""
+    unique_values = pd.unique(data.ravel())
+    # Match dtypes, since comparing uint64 with int64 goes through float64
+    is_valid = np.isin(unique_values, verified_ids.astype(data.dtype),
+                       assume_unique=True)
+    data[np.isin(data, unique_values[~is_valid])] = 0
+    return data
+
+
+def update_verified_nuclei_layer(points, cube_size_microns=16, nucleus_ids=None,
+                                 verified_ids=None, max_workers=8):
     """
     Update the verified nuclei segmentation layer.
 
-    This is typically called just after the user has added a new annotation to
-    the soma table, for example through `add_soma()`, to make the nucleus of
-    this new soma appear in the "nuclei (verified)" layer.
-    The user provides a point in the nucleus, then this function updates the
-    nucleus segmentation layer in a reasonably large cube surrounding the given
-    point to make sure the full nucleus is transferred.
+    This is typically called just after the user has added new annotations to
+    the soma table, for example through `add_soma()`, to make the nuclei of
+    these new somas appear in the "nuclei (verified)" layer.
+    The user provides a point in each nucleus, then this function updates the
+    nucleus segmentation layer in a reasonably large cube surrounding each
+    given point to make sure the full nucleus is transferred. Chunks covered
+    by more than one cube are only processed once, and chunks are processed
+    in parallel.
 
     Arguments
     ---------
-    point: 3-length iterable
-        A coordinate inside the nucleus. In xyz order, in units of the FANC
+    points: 3-length iterable, or Nx3 iterable
+        Coordinate(s) inside the nuclei. In xyz order, in units of the FANC
         image data's voxels (that is, voxels at 4.3x4.3x45nm resolution –
         note that the nucleus segmentation layer's voxel size is
         68.8x68.8x45nm, so the voxel coordinate that the user gives from the
         FANC image data will be divided by 16 to get the corresponding voxel
         coordinate in the nucleus segmentation layer).
 
+    cube_size_microns: int (default 16)
+        Side length of the cube to update around each point.
+
+    nucleus_ids: iterable of int or None (default None)
+        IDs of nuclei that were just added to the soma table, which may not
+        be visible in CAVE queries yet. These are treated as verified.
+
+    verified_ids: iterable of int or None (default None)
+        The IDs of all verified nuclei, as returned by
+        `get_verified_nucleus_ids()`. If None, the soma table is queried, so
+        that nuclei verified by anyone since the last update aren't erased
+        from the layer. Callers updating many places in a row can query once
+        and pass the result to each call instead.
+
+    max_workers: int (default 8)
+        Number of chunks to process at the same time.
+
     Returns
     -------
     Nothing
     """
-    all_nuclei = CloudVolume('gs://lee-lab_female-adult-nerve-cord/alignmentV4/nuclei/nuclei_seg_Mar2022')
-    verified_nuclei = CloudVolume('gs://lee-lab_female-adult-nerve-cord/alignmentV4/nuclei/nuclei_seg_Mar2022_verified')
+    points = np.array(points, dtype=float)
+    if points.ndim == 1:
+        points = points[np.newaxis, :]
+
+    all_nuclei = CloudVolume(_all_nuclei_path)
+    verified_nuclei = CloudVolume(_verified_nuclei_path)
     assert all(all_nuclei.chunk_size == verified_nuclei.chunk_size)
     assert all(all_nuclei.resolution == verified_nuclei.resolution)
     assert all_nuclei.bounds == verified_nuclei.bounds
-    chunk_size = all_nuclei.chunk_size
+    chunk_size = np.array(all_nuclei.chunk_size, dtype=int)
     bounds = all_nuclei.bounds
+    minpt = np.array(bounds.minpt, dtype=int)
+    maxpt = np.array(bounds.maxpt, dtype=int)
     cube_size_nm = cube_size_microns * 1000
     cube_size_voxels = cube_size_nm / np.array(all_nuclei.resolution)
 
-    soma_table = auth.get_caveclient().materialize.live_live_query('somas_dec2022', datetime.utcnow())
-    verified_ids = set(soma_table.loc[soma_table['id'] > 20000000000000000, 'id'])
-    verified_ids.add(0)
+    nucleus_ids = np.asarray([] if nucleus_ids is None else nucleus_ids,
+                             dtype=np.int64).reshape(-1)
+    now = time.time()
+    for nucleus_id in nucleus_ids.tolist():
+        _recently_verified_nucleus_ids[nucleus_id] = now
+    if verified_ids is None:
+        verified_ids = get_verified_nucleus_ids()
+    else:
+        verified_ids = np.union1d(np.asarray(verified_ids, dtype=np.int64),
+                                  [0, *nucleus_ids]).astype(np.int64)
 
-    def update_chunk(x_slice, y_slice, z_slice,
-                     valid_ids=verified_ids,
-                     verbose=False):
+    def update_chunk(origin):
         """
-        Process a given range of the nuclei predictions, removing invalid ids
+        Process one chunk of the nuclei predictions, removing invalid ids
         from all_nuclei and saving the result to the same location within
         verified_nuclei.
         """
-        if not isinstance(valid_ids, set):
-            raise TypeError('valid_ids must be a set but was {}'.format(type(valid_ids)))
-
+        x_slice, y_slice, z_slice = (slice(o, o + c) for o, c in zip(origin, chunk_size))
         data = np.array(all_nuclei[x_slice, y_slice, z_slice])
-
-        if verbose: print('Running ravel & unique')
-        unique_values = pd.unique(data.ravel())
-        if verbose: print('Checking ids for validity')
-        invalid_values = [i for i in unique_values if i not in valid_ids]
-        if verbose: print('Removing invalid ids from data')
-        data[np.isin(data, invalid_values)] = 0
-
         # Upload result
-        verified_nuclei[x_slice, y_slice, z_slice] = data
-
-    point_mip4 = np.array(point) / (16, 16, 1)
-    # Find the start of the cube, rounding down to the nearest chunk boundary
-    x_start = (point_mip4[0] - cube_size_voxels[0] // 2 - bounds.minpt[0]) // chunk_size[0] * chunk_size[0] + bounds.minpt[0]
-    y_start = (point_mip4[1] - cube_size_voxels[1] // 2 - bounds.minpt[1]) // chunk_size[1] * chunk_size[1] + bounds.minpt[1]
-    z_start = (point_mip4[2] - cube_size_voxels[2] // 2 - bounds.minpt[2]) // chunk_size[2] * chunk_size[2] + bounds.minpt[2]
-    # Find the end of the cube, rounding up to the nearest chunk boundary
-    x_end = ((point_mip4[0] + cube_size_voxels[0] // 2 - bounds.minpt[0]) // chunk_size[0] + 1) * chunk_size[0] + bounds.minpt[0]
-    y_end = ((point_mip4[1] + cube_size_voxels[1] // 2 - bounds.minpt[1]) // chunk_size[1] + 1) * chunk_size[1] + bounds.minpt[1]
-    z_end = ((point_mip4[2] + cube_size_voxels[2] // 2 - bounds.minpt[2]) // chunk_size[2] + 1) * chunk_size[2] + bounds.minpt[2]
+        verified_nuclei[x_slice, y_slice, z_slice] = _remove_unverified(data, verified_ids)
+
+    points_mip4 = points / (16, 16, 1)
+    # Find the start of each cube, rounding down to the nearest chunk boundary
+    starts = (points_mip4 - cube_size_voxels // 2 - minpt) // chunk_size * chunk_size + minpt
+    # Find the end of each cube, rounding up to the nearest chunk boundary
+    ends = ((points_mip4 + cube_size_voxels // 2 - minpt) // chunk_size + 1) * chunk_size + minpt
     # Make sure we don't go outside the bounds of the volume
-    x_start = max(bounds.minpt[0], int(x_start))
-    y_start = max(bounds.minpt[1], int(y_start))
-    z_start = max(bounds.minpt[2], int(z_start))
-    x_end = min(bounds.maxpt[0] - chunk_size[0], int(x_end))
-    y_end = min(bounds.maxpt[1] - chunk_size[1], int(y_end))
-    z_end = min(bounds.maxpt[2] - chunk_size[2], int(z_end))
-    print('Updating nucleus segmentation from {} to {}...'.format((x_start, y_start, z_start), (x_end, y_end, z_end)))
-    for x in range(x_start, x_end, chunk_size[0]):
-        for y in range(y_start, y_end, chunk_size[1]):
-            for z in range(z_start, z_end, chunk_size[2]):
-                update_chunk(slice(x, x + chunk_size[0]),
-                             slice(y, y + chunk_size[1]),
-                             slice(z, z + chunk_size[2]))
+    starts = np.maximum(minpt, starts.astype(int))
+    ends = np.minimum(maxpt - chunk_size, ends.astype(int))
+
+    # Take the union of the chunks in all cubes
+    chunks = set()
+    for start, end in zip(starts, ends):
+        grid = np.meshgrid(*(range(s, e, c) for s, e, c in zip(start, end, chunk_size)),
+                           indexing='ij')
+        chunks.update(zip(*(g.ravel().tolist() for g in grid)))
+    chunks = sorted(chunks)
+
+    print('Updating nucleus segmentation in {} chunks around {} point(s)...'.format(
+        len(chunks), len(points)))
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(update_chunk, chunks))
     print('Done updating nucleus segmentation.')
 
 
+_task_verified_ids = {}
+
+
+def _load_task_verified_ids(workspace, ids_file):
+    """
+    Load the verified nucleus IDs saved by `rebuild_verified_nuclei_layer()`,
+    caching them so each worker process only downloads them once. The file
+    name includes a digest of the IDs, so workers that outlive one rebuild
+    don't reuse its IDs for the next.
+    """
+    key = (workspace, ids_file)
+    if key not in _task_verified_ids:
+        ids = CloudFiles(workspace).get(ids_file)
+        _task_verified_ids[key] = np.frombuffer(ids, dtype=np.int64)
+    return _task_verified_ids[key]
+
+
+def _task_name(minpt, maxpt):
+    return '_'.join(f'{a}-{b}' for a, b in zip(minpt, maxpt))
+
+
+@queueable
+def rebuild_verified_nuclei_task(source_path, destination_path,
+                                 minpt, maxpt, workspace, ids_file):
+    """
+    Copy one chunk-aligned block of the nucleus segmentation to the verified
+    nuclei layer, removing nuclei that are not verified. Writes a progress
+    marker into the workspace when done.
+    """
+    verified_ids = _load_task_verified_ids(workspace, ids_file)
+    bbox = tuple(slice(a, b) for a, b in zip(minpt, maxpt))
+    source = CloudVolume(source_path, progress=False, fill_missing=True)
+    destination = CloudVolume(destination_path, progress=False)
+    data = np.array(source[bbox])
+    destination[bbox] = _remove_unverified(data, verified_ids)
+    CloudFiles(workspace).put(f'progress/{_task_name(minpt, maxpt)}', b'')
+
+
+def rebuild_verified_nuclei_layer(parallel=1, queue=None, task_shape=(4, 4, 4),
+                                  workspace=None, refresh_ids=False):
+    """
+    Regenerate the entire verified nuclei segmentation layer from the nucleus
+    segmentation, keeping only verified nuclei. Use this after large edits to
+    the soma table. For small edits, `update_verified_nuclei_layer()` is
+    faster.
+
+    The volume is split into chunk-aligned blocks, each processed by one
+    task. Finished blocks are recorded in the workspace, so calling this
+    again with the same workspace after an interrupted rebuild only processes
+    the remaining blocks. Once every block is done, the workspace is cleared
+    (right away when running locally, or at the start of the next call when
+    using a queue), so the next call is a full rebuild with fresh IDs.
+
+    Arguments
+    ---------
+    parallel: int (default 1)
+        Number of processes to run the tasks on, using LocalTaskQueue.
+        Ignored if queue is given.
+
+    queue: str or None (default None)
+        If given, a task queue path like 'fq:///path/to/queue' to insert the
+        tasks into instead of running them here. Workers on any machine that
+        can access the queue and the workspace can then run them, for example
+        with `TaskQueue('fq:///path/to/queue').poll(lease_seconds=600)`.
+
+    task_shape: 3-tuple of int (default (4, 4, 4))
+        Size of each task's block, in units of the segmentation's chunks.
+
+    workspace: str or None (default None)
+        Cloudpath of a directory to store the verified IDs and the progress
+        markers in. Must be accessible to all workers. If None, uses
+        auth.configs['nuclei_rebuild_workspace'].
+
+    refresh_ids: bool (default False)
+        If False and the workspace has verified IDs from an unfinished
+        rebuild, keep using them so all blocks are consistent. If True,
+        download the current verified IDs and restart the rebuild.
+
+    Returns
+    -------
+    int: Number of tasks that were run or inserted
+    """
+    if workspace is None:
+        workspace = auth.configs['nuclei_rebuild_workspace']
+    if '://' not in workspace:
+        workspace = 'file://' + os.path.abspath(os.path.expanduser(workspace))
+
+    all_nuclei = CloudVolume(_all_nuclei_path)
+    chunk_size = np.array(all_nuclei.chunk_size, dtype=int)
+    minpt = np.array(all_nuclei.bounds.minpt, dtype=int)
+    maxpt = np.array(all_nuclei.bounds.maxpt, dtype=int)
+    block_size = chunk_size * task_shape
+    grid = np.meshgrid(*(range(a, b, c) for a, b, c in zip(minpt, maxpt, block_size)),
+                       indexing='ij')
+    blocks = {}
+    for start in zip(*(g.ravel().tolist() for g in grid)):
+        end = np.minimum(np.array(start) + block_size, maxpt).tolist()
+        blocks[_task_name(start, end)] = (list(start), end)
+
+    cf = CloudFiles(workspace)
+    ids_files = [name for name in cf.list(prefix='verified_ids_')
+                 if name.endswith('.npy')]
+    done = {name[len('progress/'):] for name in cf.list(prefix='progress/')}
+    if refresh_ids or len(ids_files) != 1 or done >= set(blocks):
+        # Nothing to resume, so start a new rebuild with the current IDs
+        _clear_rebuild_workspace(cf)
+        ids = get_verified_nucleus_ids().astype(np.int64).tobytes()
+        ids_file = f'verified_ids_{hashlib.sha1(ids).hexdigest()[:16]}.npy'
+        cf.put(ids_file, ids)
+        done = set()
+    else:
+        ids_file = ids_files[0]
+
+    tasks = [partial(rebuild_verified_nuclei_task,
+                     _all_nuclei_path, _verified_nuclei_path,
+                     start, end, workspace, ids_file)
+             for name, (start, end) in blocks.items() if name not in done]
+    print('{} of {} blocks already done. {} tasks remaining.'.format(
+        len(blocks) - len(tasks), len(blocks), len(tasks)))
+
+    if queue is not None:
+        TaskQueue(queue).insert(tasks)
+    else:
+        LocalTaskQueue(parallel=parallel).insert_all(tasks)
+        if set(blocks) <= {name[len('progress/'):]
+                           for name in cf.list(prefix='progress/')}:
+            _clear_rebuild_workspace(cf)
+    return len(tasks)
+
+
+def _clear_rebuild_workspace(cf):
+    """Delete the verified IDs and progress markers of a rebuild."""
+    cf.delete([name for name in cf.list(prefix='verified_ids')
+               if name.endswith('.npy')])
+    cf.delete(list(cf.list(prefix='progress/')))
+
+
 def add_soma(point=None, is_neuron=True, nucleus_id=None):
     """
     Upload one new soma to a corresponding CAVE table.
@@ -743,9 +2096,9 @@ def add_soma(point=None, is_neuron=True, nucleus_id=None):
         upload_df.loc[0] = [point, nucleus_id]
     else:
         upload_df.loc[0] = [point, 0]
-    sto.add_dataframe(upload_df)
+    ids = sto.add_dataframe(upload_df)
 
-    update_verified_nuclei_layer(point)
+    update_verified_nuclei_layer(point, nucleus_ids=ids)
 
 
 def add_soma_df(points: pd.DataFrame, is_neuron=True, pt_position_column='pt_position', id_column='id'):
@@ -781,8 +2134,10 @@ def add_soma_df(points: pd.DataFrame, is_neuron=True, pt_position_column='pt_pos
         points['id'] = np.nan
 
     points = points.rename(columns={pt_position_column: 'pt_position', id_column: 'id'})
-    sto.add_dataframe(points)
-    # transfer_segmentation()
+    ids = sto.add_dataframe(points)
+
+    update_verified_nuclei_layer(np.vstack(points['pt_position'].values),
+                                 nucleus_ids=ids)
 
 
 class UploadUnsuccessful(Exception):
@@ -292,7 +292,8 @@ def process_message(message: str,
 
         if message.startswith(('getids', 'findids')):
             results = banc.lookup.cells_annotated_with(search_terms,
-                                                       return_as='list')
+                                                       return_as='list',
+                                                       include_subclasses=True)
             if len(results) > 300:
                 return (f"{len(results)} cells matched that search! Try a more"
                         " specific search (like `findids X and Y and Z`) to see"
@@ -300,11 +301,13 @@ def process_message(message: str,
             return f"Search successful:```{', '.join(map(str, results))}```"
         if message.startswith(('getnum', 'findnum')):
             results = banc.lookup.cells_annotated_with(search_terms,
-                                                       return_as='list')
+                                                       return_as='list',
+                                                       include_subclasses=True)
             return f"Your search matched {len(results)} cells."
 
         return ("Search successful. View your results: " +
-                banc.lookup.cells_annotated_with(search_terms, return_as='url'))
+                banc.lookup.cells_annotated_with(search_terms, return_as='url',
+                                                 include_subclasses=True))
 
     command_chars = ['?', '!', '-']
     try:
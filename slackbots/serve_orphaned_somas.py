@@ -52,6 +52,8 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from caveclient import CAVEclient
 
+import banc
+
 
 # Setup
 verbosity = 2
@@ -163,8 +165,11 @@ def fetch_orphaned_somas(y_range=[0, 160000], query_size=30, synapse_count_thres
         223000 : The bottom of the dataset
 
     query_size : int (default 30)
-      Request postsynaptic site counts for this many somas. Larger queries take
-      more time.
+      Inspect postsynaptic site counts for this many randomly selected
+      somas. If a per-materialization synapse count table has been built
+      from a full synapse snapshot (see `banc.connectivity.get_synapse_counts`),
+      counts are looked up there, so larger values are cheap. Otherwise the
+      synapses onto each sample of somas are queried from CAVE.
 
     synapse_count_threshold : int (default 50)
       Among the queried somas, only return ones that have fewer than this
@@ -192,22 +197,41 @@ def fetch_orphaned_somas(y_range=[0, 160000], query_size=30, synapse_count_thres
     somas = somas.loc[np.vstack(somas.pt_position)[:, 1] < y_range[1]]
     soma_ids = somas.pt_root_id
 
+    # Postsynaptic site counts for every soma come from the count table for
+    # this materialization, if one has already been built from a complete
+    # synapse snapshot (the bot never builds one itself, since that means
+    # querying the whole synapse table). Otherwise count synapses onto
+    # random samples of somas.
+    try:
+        counts = banc.connectivity.get_synapse_counts(
+            materialization_version=caveclient.materialize.version,
+            client=caveclient,
+            build=False
+        ).lookup(soma_ids)['n_inputs'].rename('synapse_counts')
+    except KeyError:
+        counts = None
+    if counts is not None:
+        counts.index.name = 'pt_root_id'
+        if not (counts <= synapse_count_threshold).any():
+            return counts.iloc[:0].reset_index()
+
     orphaned_somas = pd.Series(dtype='int64')
     iteration = 0
     while orphaned_somas.shape == (0,):
         iteration += 1
-        if iteration > 1:
-            print(f'Failed to find synapseless somas: Now doing iteration number {iteration}')
-        # Get synapses for a random n somas
-        soma_ids_sample = soma_ids.sample(query_size)
-        synapses = caveclient.materialize.synapse_query(post_ids=soma_ids_sample)
-
-        synapse_counts = pd.Series(
-            data=synapses.post_pt_root_id.value_counts(),
-            index=soma_ids_sample,
-            name='synapse_counts'
-        ).fillna(0).astype('int64')
-        synapse_counts.sort_values(inplace=True)
+        if counts is not None:
+            synapse_counts = counts.sample(min(query_size, len(counts)))
+        else:
+            if iteration > 1:
+                print(f'Failed to find synapseless somas: Now doing iteration number {iteration}')
+            soma_ids_sample = soma_ids.sample(query_size)
+            synapses = caveclient.materialize.synapse_query(post_ids=soma_ids_sample)
+            synapse_counts = pd.Series(
+                data=synapses.post_pt_root_id.value_counts(),
+                index=soma_ids_sample,
+                name='synapse_counts'
+            ).fillna(0).astype('int64')
+        synapse_counts = synapse_counts.sort_values()
         orphaned_somas = synapse_counts[synapse_counts <= synapse_count_threshold].reset_index()
 
     return orphaned_somas
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import subprocess
 from datetime import datetime, timezone
 
 import numpy as np
@@ -87,6 +90,975 @@ def test_annotations():
     assert not fanc.annotations.is_valid_annotation('n mjr mrg rrrs', table_name=table, raise_errors=False)
 
 
+def test_annotation_rules():
+    rules = fanc.annotations.AnnotationRules({
+        'primary class': {'sensory neuron': {'R7': {}}, 'CNS neuron': {}},
+        'side': {'left': {}},
+        'R7': {},
+    })
+    assert rules.roots == {'primary class', 'side'}
+    assert rules.parents['R7'] == ('sensory neuron', None)
+    assert rules.children['primary class'] == {'sensory neuron', 'CNS neuron'}
+    assert ('sensory neuron', 'R7') in rules.valid_pairs
+    assert rules.descendants['primary class'] == {'sensory neuron', 'R7', 'CNS neuron'}
+    assert rules.ancestors['R7'] == {'sensory neuron', 'primary class'}
+    assert {'R7', 'R8'} <= fanc.annotations.subclasses('sensory neuron', 'cell_info')
+
+    assert fanc.annotations.suggest('sensry neuron', rules)[0] == 'sensory neuron'
+    assert fanc.annotations.suggest('r7', rules) == ['R7']
+    assert fanc.annotations.suggest('sens', rules) == ['sensory neuron']
+    try:
+        fanc.annotations.is_valid_pair('primary class', 'sensry neuron', rules)
+        assert False
+    except ValueError as e:
+        assert 'Did you mean "sensory neuron"' in str(e)
+    assert fanc.annotations.guess_class('left', rules) == 'side'
+    assert not fanc.annotations.is_valid_pair('side', 'R7', rules, raise_errors=False)
+    assert fanc.annotations.guess_class('R7', 'cell_info') == 'photoreceptor neuron'
+
+
+def test_validate_bulk():
+    existing = pd.DataFrame({'pt_root_id': [1, 1],
+                             'tag2': ['primary class', 'sensory neuron'],
+                             'tag': ['sensory neuron', 'photoreceptor neuron']})
+    proposed = pd.DataFrame({
+        'pt_root_id': [1, 1, 2, 2, 2, 2],
+        'annotation': ['sensory neuron: photoreceptor neuron',  # Duplicate
+                       'photoreceptor neuron: R7',
+                       'primary class: CNS neuron',
+                       'primary class: sensory neuron',  # Conflicts with row 2
+                       'foo',
+                       'sensory neuron: photoreceptor neuron'],  # No parent
+    })
+    result = fanc.annotations.validate_bulk(proposed, 'cell_info', existing=existing)
+    assert result.allowed.tolist() == [False, True, True, False, False, False]
+    assert result.tag2[1] == 'photoreceptor neuron'
+    assert 'must be annotated with "sensory neuron"' in result.reason[5]
+
+    # A parent added by a later row doesn't count, since rows are posted in order
+    proposed = pd.DataFrame({
+        'pt_root_id': [3, 3],
+        'annotation': ['sensory neuron: photoreceptor neuron',
+                       'primary class: sensory neuron'],
+    })
+    result = fanc.annotations.validate_bulk(proposed, 'cell_info', existing=existing)
+    assert result.allowed.tolist() == [False, True]
+    result = fanc.annotations.validate_bulk(proposed.iloc[::-1], 'cell_info', existing=existing)
+    assert result.allowed.tolist() == [True, True]
+
+    # A row rejected for lacking a parent doesn't block a later row of the
+    # same class, just as it wouldn't when posting the rows one at a time
+    proposed = pd.DataFrame({
+        'pt_root_id': [3, 3, 3],
+        'annotation': ['sensory neuron: photoreceptor neuron',
+                       'primary class: sensory neuron',
+                       'sensory neuron: chordotonal neuron'],
+    })
+    result = fanc.annotations.validate_bulk(proposed, 'cell_info', existing=existing)
+    assert result.allowed.tolist() == [False, True, True]
+    assert 'must be annotated with' in result.reason[0]
+
+
+def test_annotations_import_time():
+    # Importing the annotations module should not load or compile the
+    # annotation vocabularies, which only happens the first time they're used
+    code = ('import sys, time\n'
+            'import fanc.annotations as a\n'
+            'assert "rules_governing_tables" not in vars(a)\n'
+            'assert "anytree" not in sys.modules\n'
+            't = time.time()\n'
+            'a.rules_governing_tables\n'
+            'print(time.time() - t)\n')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout.strip().splitlines()[-1]) < 0.5
+
+
+def test_connectome_graph():
+    # 1 -> 2 -> 3 -> 4, plus a weak shortcut 1 -> 4 and an isolated pair 5 -> 6
+    synapses = pd.DataFrame({
+        'pre_pt_root_id':  [1]*5 + [2]*5 + [3]*5 + [1] + [5]*3,
+        'post_pt_root_id': [2]*5 + [3]*5 + [4]*5 + [4] + [6]*3,
+    })
+    graph = fanc.connectivity.ConnectomeGraph.from_synapses(synapses)
+    assert len(graph) == 6 and graph.n_edges == 5
+    assert graph.out_weight()[1] == 6 and graph.in_weight()[4] == 6
+    assert graph.out_degree()[1] == 2 and graph.out_degree(threshold=2)[1] == 1
+    assert graph.downstream(1, hops=1).to_dict() == {2: 1, 4: 1}
+    assert graph.downstream(1, hops=3, threshold=2).to_dict() == {2: 1, 3: 2, 4: 3}
+    assert graph.upstream([4], hops=2, include_seeds=True).to_dict() == {1: 1, 2: 2, 3: 1, 4: 0}
+    assert graph.shortest_path(1, 4) == [1, 2, 3, 4]
+    assert graph.shortest_path(1, 4, weighted=False) == [1, 4]
+    assert graph.shortest_path(4, 1) == []
+    components = graph.connected_components()
+    assert components[1] == components[4] == 0 and components[5] == components[6] == 1
+
+    adj = pd.DataFrame([[0, 5], [2, 0]], index=[10, 20], columns=[10, 20])
+    graph = fanc.connectivity.ConnectomeGraph.from_adjacency(adj)
+    assert graph.out_weight().to_dict() == {10: 5, 20: 2}
+    try:
+        graph.index_of([30])
+        assert False
+    except KeyError:
+        pass
+
+
+def test_synapse_counts(tmp_path):
+    synapses = pd.DataFrame({
+        'pre_pt_root_id':  [1, 1, 1, 2, 0, 3],
+        'post_pt_root_id': [2, 2, 3, 3, 3, 0],
+    })
+    counts = fanc.connectivity.SynapseCounts.from_synapses(synapses,
+                                                            materialization_version=5)
+    assert counts.root_ids.tolist() == [1, 2, 3]
+    table = counts.lookup([3, 1, 99])
+    assert table.loc[3].tolist() == [3, 1, 2, 0]
+    assert table.loc[1].tolist() == [0, 3, 0, 2]
+    assert table.loc[99].tolist() == [0, 0, 0, 0]
+    assert counts.below_threshold([1, 2, 3], 3).tolist() == [1, 2]
+
+    counts.save(tmp_path / 'counts.npz')
+    loaded = fanc.connectivity.SynapseCounts.load(tmp_path / 'counts.npz')
+    assert loaded.materialization_version == 5 and loaded.timestamp is None
+    assert (loaded.counts == counts.counts).all()
+
+    # Counting a Parquet snapshot one row group at a time gives the same table
+    synapses['id'] = np.arange(len(synapses))
+    fanc.connectivity.export_synapses_to_parquet(synapses, tmp_path / 'snapshot',
+                                                 row_group_size=2)
+    from_snapshot = fanc.connectivity.SynapseCounts.from_snapshot(tmp_path / 'snapshot')
+    assert (from_snapshot.root_ids == counts.root_ids).all()
+    assert (from_snapshot.counts == counts.counts).all()
+
+    # With build=False, only counts that are already cached are returned
+    from types import SimpleNamespace
+    client = SimpleNamespace(datastack_name='test', materialize=SimpleNamespace(
+        get_timestamp=lambda version: None))
+    kwargs = {'materialization_version': 5, 'cache_dir': str(tmp_path / 'cache'),
+              'client': client}
+    try:
+        fanc.connectivity.get_synapse_counts(build=False, **kwargs)
+        assert False
+    except KeyError:
+        pass
+    fanc.connectivity.get_synapse_counts(synapses=synapses, **kwargs)
+    fanc.connectivity._synapse_counts.clear()
+    cached = fanc.connectivity.get_synapse_counts(build=False, **kwargs)
+    assert (cached.counts == counts.counts).all()
+
+
+def test_synapse_parquet(tmp_path):
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(0)
+    n = 20000
+    synapses = pd.DataFrame({
+        'id': np.arange(n),
+        'pre_pt_supervoxel_id': rng.integers(7e16, 8e16, n),
+        'post_pt_supervoxel_id': rng.integers(7e16, 8e16, n),
+        'pre_pt_root_id': rng.integers(0, 500, n) + 720575940000000000,
+        'post_pt_root_id': rng.integers(0, 500, n) + 720575940000000000,
+        'pre_pt_position': list(rng.integers(0, 200000, (n, 3))),
+        'post_pt_position': list(rng.integers(0, 200000, (n, 3))),
+    })
+    paths = fanc.connectivity.export_synapses_to_parquet(
+        [synapses.iloc[:n // 2], synapses.iloc[n // 2:]], tmp_path,
+        materialization_version=7, row_group_size=1000)
+    assert len(paths) == 2
+    parquet_file = pq.ParquetFile(paths[0])
+    assert parquet_file.schema_arrow.field('pre_pt_position_x').type == 'int32'
+    assert parquet_file.schema_arrow.metadata[b'materialization_version'] == b'7'
+
+    segid = synapses.pre_pt_root_id.iloc[0]
+    assert len(fanc.connectivity._select_row_groups(
+        parquet_file, {'pre_pt_root_id': np.array([segid])})) <= 2
+
+    outputs = fanc.connectivity.read_synapses_parquet(tmp_path, pre_ids=segid)
+    expected = synapses.loc[synapses.pre_pt_root_id == segid]
+    assert sorted(outputs.id) == sorted(expected.id)
+    row = outputs.set_index('id').loc[expected.id.iloc[0]]
+    assert (row.pre_pt_position == expected.pre_pt_position.iloc[0]).all()
+
+    pair = fanc.connectivity.read_synapses_parquet(
+        tmp_path, pre_ids=[segid], post_ids=expected.post_pt_root_id.iloc[0],
+        columns=['id'])
+    assert pair.columns.tolist() == ['id', 'pre_pt_root_id', 'post_pt_root_id']
+    assert len(pair) >= 1
+
+    # A CSV file can be exported in chunks, with its points parsed from strings
+    synapses.iloc[:100].to_csv(tmp_path / 'synapses.csv', index=False)
+    fanc.connectivity.export_synapses_to_parquet(
+        pd.read_csv(tmp_path / 'synapses.csv', chunksize=30), tmp_path / 'from_csv')
+    outputs = fanc.connectivity.read_synapses_parquet(tmp_path / 'from_csv')
+    outputs = outputs.set_index('id').loc[synapses.id.iloc[:100]]
+    assert (np.vstack(outputs.post_pt_position) ==
+            np.vstack(synapses.post_pt_position.iloc[:100])).all()
+
+
+def test_group_adj():
+    synapses = pd.DataFrame({
+        'pre_pt_root_id':  [1, 1, 1, 2, 2, 3, 4],
+        'post_pt_root_id': [3, 3, 4, 3, 4, 4, 1],
+    })
+    # Neuron 2 has two tags, neuron 4 has none
+    groups = pd.Series({1: ['A'], 2: ['A', 'B'], 3: ['C']})
+    table = fanc.connectivity.get_group_adj(synapses, groups)
+    table = table.set_index(['pre_group', 'post_group'])
+    assert table.loc[('A', 'C')].tolist() == [3, 2, 1.5]
+    assert table.loc[('B', 'C')].tolist() == [1, 1, 1.0]
+    assert len(table) == 2
+
+    names, weights, counts = fanc.connectivity.get_group_adj(
+        synapses, groups, threshold=2, materialization_version=1,
+        return_as='sparse')
+    assert names.tolist() == ['A', 'B', 'C']
+    assert weights.sum() == 2 and counts.sum() == 1
+    assert len(fanc.connectivity._group_adjacencies) == 1
+
+    # Different memberships or a different synapse subset are not served from the cache
+    names, weights, counts = fanc.connectivity.get_group_adj(
+        synapses, {1: 'A', 2: 'A', 3: 'C'}, threshold=2, materialization_version=1,
+        return_as='sparse')
+    assert names.tolist() == ['A', 'C'] and weights.sum() == 2
+    names, weights, counts = fanc.connectivity.get_group_adj(
+        synapses.iloc[1:], groups, threshold=2, materialization_version=1,
+        return_as='sparse')
+    assert weights.sum() == 0
+    assert len(fanc.connectivity._group_adjacencies) == 3
+
+
+def test_propagate(tmp_path):
+    # 1 -> 2 -> 3, and 4 provides most of 3's input
+    synapses = pd.DataFrame({
+        'pre_pt_root_id':  [1]*10 + [2]*2 + [4]*8,
+        'post_pt_root_id': [2]*10 + [3]*2 + [3]*8,
+    })
+    layers = fanc.connectivity.propagate(synapses, {'a': [1], 'b': [4]},
+                                         n_steps=3, output_dir=tmp_path)
+    assert layers['a'].loc[1] == 0 and layers['a'].loc[2] == 1
+    assert layers['a'].loc[3] == 2  # 2/10 of input / 0.3 saturation > 0.05
+    assert np.isnan(layers['a'].loc[4])
+    assert layers['b'].loc[3] == 1 and np.isnan(layers['b'].loc[2])
+    assert (tmp_path / 'step001_batch00000.npz').exists()
+
+    layers = fanc.connectivity.propagate(synapses, [1], mode='linear',
+                                         min_activation=0.5)
+    assert layers[0].loc[2] == 1 and np.isnan(layers[0].loc[3])
+
+
+def test_synapses_in_box():
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    rng = np.random.default_rng(0)
+    points = rng.integers(0, 64, (300, 3))
+    # Some synapses exactly on the planes where the box will be split
+    points[:30, 0] = 32
+    cave.create_table('synapses', 'synapse', data=pd.DataFrame({
+        'pre_pt_position': list(points), 'post_pt_position': list(points),
+        'size': 1}))
+    synapses = fanc.connectivity.get_synapses_in_box(
+        [[0, 0, 0], [64, 64, 64]], max_rows=100, min_box_size=(8, 8, 8),
+        client=cave)
+    assert cave.request_counts['materialize.query_table'] > 1
+    assert synapses['id'].is_unique
+    assert sorted(synapses['id']) == sorted(cave.table('synapses')['id'])
+
+
+def test_diff_connectivity(tmp_path):
+    old = pd.DataFrame({
+        'pre_pt_root_id':  [1, 1, 1, 2, 5],
+        'post_pt_root_id': [2, 2, 3, 3, 2],
+        'pre_pt_supervoxel_id':  [11, 11, 11, 21, 51],
+        'post_pt_supervoxel_id': [21, 21, 31, 31, 21],
+    })
+    # Neuron 1 got a new root ID (10), 5->2 was removed, 1->3 gained a synapse
+    new = pd.DataFrame({
+        'pre_pt_root_id':  [10, 10, 10, 10, 2, 3],
+        'post_pt_root_id': [2, 2, 3, 3, 3, 2],
+        'pre_pt_supervoxel_id':  [11, 11, 11, 11, 21, 31],
+        'post_pt_supervoxel_id': [21, 21, 31, 31, 31, 21],
+    })
+    diff = fanc.connectivity.diff_connectivity(old, new)
+    assert diff[['pre_pt_root_id', 'post_pt_root_id', 'change']].values.tolist() == [
+        [3, 2, 'added'], [5, 2, 'removed'], [10, 3, 'reweighted']]
+    assert diff.iloc[2][['old_weight', 'new_weight']].tolist() == [1, 2]
+
+    # Same result reading the new snapshot from Parquet, with explicit lineage
+    fanc.connectivity.export_synapses_to_parquet(new, tmp_path, row_group_size=2)
+    diff2 = fanc.connectivity.diff_connectivity(old, str(tmp_path), lineage={1: 10})
+    assert diff2.equals(diff)
+    # Comparing the connections one partition at a time gives the same result
+    for partitions in [1, 3]:
+        diff2 = fanc.connectivity.diff_connectivity(old, new, partitions=partitions)
+        assert diff2.equals(diff)
+
+    # Without lineage, the renamed neuron looks like churn
+    diff = fanc.connectivity.diff_connectivity(old, new, lineage=None)
+    assert (diff.change == 'removed').sum() == 3
+
+
+def test_soma_table_helpers():
+    sto = fanc.upload.SomaTableOrganizer
+    ids = np.array([1, 15, 2, 99, 0, 10000000000000005, 20000000000000000,
+                    1999999999999999999])
+    assert sto.find_manual_ids(ids).tolist() == [1, 15, 10000000000000005,
+                                                 1999999999999999999]
+    assert sto.find_manual_ids(ids, initial_digit=2).tolist() == [2, 20000000000000000]
+
+    somas = pd.DataFrame({'bb_start_position': [[0, 0, 0], np.nan, [1, 1, 1]],
+                          'bb_end_position': [[6, 8, 2], np.nan, [4, 5, 9]]})
+    assert sto().add_radius_column(somas).radius_nm.tolist() == [5, 10, 2.5]
+
+
+def test_rate_limiter():
+    import requests
+    limiter = fanc.auth.RateLimiter(base_delay=0.01)
+    responses = [429, 503, None]
+    def request():
+        status = responses.pop(0)
+        if status is not None:
+            response = requests.Response()
+            response.status_code = status
+            raise requests.HTTPError(str(status), response=response)
+        return 'ok'
+    assert limiter.call(request) == 'ok'
+    metrics = limiter.metrics()
+    assert (metrics['retries'], metrics['throttled'], metrics['successes']) == (2, 2, 1)
+    assert metrics['in_flight'] == 0
+
+    # Errors that aren't about load are raised right away
+    responses = [404]
+    try:
+        limiter.call(request)
+    except requests.HTTPError:
+        pass
+    else:
+        assert False
+    assert limiter.metrics()['retries'] == 2
+
+    # Writes are only retried when the server says it didn't process them
+    write = limiter.wrap(request, idempotent=False)
+    responses = [429, 503, None]
+    assert write() == 'ok'
+    for status in [500, 504]:
+        responses = [status, None]
+        try:
+            write()
+        except requests.HTTPError:
+            pass
+        else:
+            assert False
+    def dropped():
+        raise requests.ConnectionError('Connection reset')
+    try:
+        limiter.wrap(dropped, idempotent=False)()
+    except requests.ConnectionError:
+        pass
+    else:
+        assert False
+    assert limiter.metrics()['retries'] == 4
+
+    # Installing the limiter wraps the sub-clients' methods, and only once
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    with cave:
+        client = fanc.auth.get_caveclient()
+        assert type(client) is cave_emulator.CAVEEmulator
+        post = client.annotation.post_annotation
+        assert post._rate_limited
+        fanc.auth._install_rate_limiter(client)
+        assert client.annotation.post_annotation is post
+
+    # A staged upload whose response is lost isn't posted again, by caveclient
+    # or by the limiter, since the server may have applied it
+    cave = cave_emulator.CAVEEmulator(lost_response_rate=1.0)
+    cave.create_table('cell_info', 'bound_double_tag_user')
+    cave.add_segment([[0, 0, 0]])
+    with cave:
+        result = fanc.upload.annotate_neurons(
+            pd.DataFrame({'neuron': [[0, 0, 0]], 'annotation': [('primary class', 'sensory neuron')]}), 1,
+            convert_given_point_to_anchor_point=False)
+    assert result.status.tolist() == ['upload failed']
+    assert 'Timeout' in result.reason[0]
+    assert cave.request_counts['annotation.post_annotation'] == 1
+    assert len(cave.table('cell_info')) == 1
+
+    # Running out of retries is reported as such, not as data not ingested yet
+    def rate_limited(*args, **kwargs):
+        response = requests.Response()
+        response.status_code = 429
+        raise requests.HTTPError('429', response=response)
+    from types import SimpleNamespace
+    organizer = SimpleNamespace(_client=SimpleNamespace(
+        materialize=SimpleNamespace(live_live_query=rate_limited)))
+    try:
+        fanc.upload.SomaTableOrganizer._check_change(organizer, 'somas')
+    except fanc.upload.UpdateUnsuccessful as e:
+        assert 'HTTP 429' in str(e) and '1 hour' not in str(e)
+    else:
+        assert False
+
+
+def test_cave_emulator():
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    cave.create_table('cell_info', 'bound_double_tag_user')
+    segids = [cave.add_segment([[i * 10, 0, 0], [i * 10 + 1, 0, 0]]) for i in range(50)]
+    with cave:
+        df = pd.DataFrame({'neuron': [[i * 10, 0, 0] for i in range(50)],
+                           'annotation': [('primary class', 'sensory neuron')] * 50})
+        result = fanc.upload.annotate_neurons(df, 1, convert_given_point_to_anchor_point=False)
+        assert (result.status == 'uploaded').all()
+        # The bulk path should make a constant number of requests
+        assert cave.request_counts['annotation.post_annotation'] == 1
+        assert cave.request_counts['materialize.live_live_query'] == 1
+        assert fanc.lookup.annotations(segids[0], [('cell_info', 'tag')]) == ['sensory neuron']
+        # Lookups read the emulated segmentation through auth.get_cloudvolume()
+        points = [[0, 0, 0], [11, 0, 0], [5, 5, 5], [200, 0, 0]]
+        assert fanc.lookup.segid_from_pt_cv(points, progress=False).tolist() == [
+            segids[0], segids[1], 0, segids[20]]
+        supervoxels = fanc.lookup.segid_from_pt_cv(points, return_roots=False, progress=False)
+        assert supervoxels.tolist() == cave.supervoxels_at(points).tolist()
+
+        merged = cave.merge(segids[:2])
+        assert fanc.auth.get_caveclient().chunkedgraph.is_latest_roots(segids[:3]).tolist() == [False, False, True]
+        report = fanc.upload.delete_annotations([(merged, 'sensory neuron')], 1,
+                                                annotation_sources=[('cell_info', 'tag')])
+        assert report.status.tolist() == ['deleted']
+        assert fanc.lookup.annotations(merged, [('cell_info', 'tag')]) == ['sensory neuron']
+    assert fanc.auth._emulators == {}
+
+
+def test_cell_id_allocator(monkeypatch):
+    import threading
+    from fanc import cave_emulator
+    ranges = list(fanc.upload.cell_id_ranges.values())
+    for a, b in zip(ranges[:-1], ranges[1:]):
+        assert a.start < a.stop <= b.start
+    assert set(fanc.upload.cell_id_ranges) == set(fanc.upload._cell_type_annotations)
+
+    monkeypatch.setattr(fanc.upload, '_cell_id_allocators', {})
+    monkeypatch.setitem(fanc.upload.cell_id_ranges, 'descending', range(1, 8))
+    cave = cave_emulator.CAVEEmulator()
+    # Cell IDs 1-3 are in use, and annotation ID 5 is taken by a cell ID
+    # from another range
+    cave.create_table('cell_ids', 'bound_tag_user', data=pd.DataFrame({
+        'id': [1, 2, 3, 5], 'user_id': [1, 2, 3, 1_000_000],
+        'pt_position': [[0, 0, 0]] * 4, 'tag': 'soma'}))
+    with cave:
+        allocator = fanc.upload.get_cell_id_allocator(['cell_ids', 'user_id'])
+        assert fanc.upload.get_cell_id_allocator() is allocator
+        assert allocator.allocate('descending', 2, reserve=False) == [4, 6]
+        assert allocator.allocate('descending', 2) == [4, 6]
+        try:
+            allocator.allocate('descending', 2)
+        except ValueError as e:
+            assert 'Not enough unused cell IDs' in str(e)
+        else:
+            assert False
+        # The failed allocation didn't use up the last ID
+        assert allocator.allocate('descending') == [7]
+
+        allocated = []
+
+        def allocate():
+            allocated.extend(allocator.allocate('ascending', 5))
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(allocated) == list(range(2000, 2040))
+
+
+def test_new_cells():
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    cave.create_table('cell_ids', 'bound_tag_user')
+    cave.create_table('cell_info', 'bound_double_tag_user')
+    cave.create_table('peripheral_nerves', 'bound_tag_user')
+    cave.create_table('backbone_proofread', 'proofreading_boolstatus_user')
+    segids = [cave.add_segment([[i * 10, 0, 0], [i * 10 + 1, 0, 0]]) for i in range(3)]
+    # Only the first two cells have anchor points for their annotations
+    cave.create_table('neck_connective_y92500', 'bound_tag_user', data=pd.DataFrame({
+        'pt_position': [[0, 0, 0], [10, 0, 0]], 'tag': 'neck', 'user_id': 1}))
+    fanc.lookup._recent_uploads.clear()
+    fanc.lookup._recent_deletions.clear()
+    cells = pd.DataFrame({'pt_position': [[0, 0, 0], [10, 0, 0], [20, 0, 0], [0, 0, 0]],
+                          'pt_type': 'neck connective',
+                          'cell_type': ['descending', 'descending', 'VNC motor', 'ascending']})
+    with cave:
+        result = fanc.upload.new_cells(cells, 1, fake=False)
+        assert result.status.tolist() == ['uploaded'] * 3 + ['not allowed']
+        assert result.pt_root_id.tolist() == [*segids, segids[0]]
+        # The cell type annotations that failed are reported, not dropped
+        assert result.annotation_status.tolist() == ['uploaded', 'uploaded', 'not allowed', None]
+        assert 'No anchor point' in result.annotation_reason[2]
+        assert fanc.lookup.annotations(segids[1], [('cell_info', 'tag')]) == ['descending']
+
+        # When a batch fails, exactly the rows in earlier batches are uploaded
+        client = fanc.auth.get_caveclient()
+        post_annotation = client.annotation.post_annotation
+        calls = []
+        def flaky_post(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError('Server unavailable')
+            return post_annotation(*args, **kwargs)
+        client.annotation.post_annotation = flaky_post
+        points = [[i * 10, 5, 0] for i in range(3)]
+        for point in points:
+            cave.add_segment([point])
+        n_before = len(cave.table('cell_info'))
+        result = fanc.upload.annotate_neurons(pd.DataFrame({
+            'neuron': points,
+            'annotation': 'primary class: sensory neuron'}), 1, batch_size=1,
+            convert_given_point_to_anchor_point=False, fake=False)
+        assert result.status.tolist() == ['uploaded', 'upload failed', 'upload failed']
+        assert 'Server unavailable' in result.reason[1]
+        assert result.annotation_id.notna().tolist() == [True, False, False]
+        assert len(cave.table('cell_info')) == n_before + 1
+
+
+def test_upload_queue(tmp_path):
+    import socket
+    from fanc import cave_emulator
+    journal = str(tmp_path / 'journal.sqlite')
+    cave = cave_emulator.CAVEEmulator()
+    segids = [cave.add_segment([[i * 10, 0, 0]]) for i in range(4)]
+    fanc.lookup._recent_uploads.clear()
+    fanc.lookup._recent_deletions.clear()
+
+    def row(i):
+        return {'pt_position': [i * 10, 0, 0], 'tag': f'tag {i}', 'user_id': 1}
+    with cave:
+        # Uploads to a table that doesn't exist yet fail, and are uploaded
+        # once requeued
+        queue = fanc.upload.UploadQueue(journal, start=False)
+        keys = queue.put_many('cell_info', [row(0), row(1)], segids=segids[:2])
+        assert queue.flush() == 0
+        assert queue.status(keys).status[keys].tolist() == ['failed', 'failed']
+        assert 'not found' in queue.status(keys).error.iloc[0]
+        cave.create_table('cell_info', 'bound_tag_user')
+        assert queue.retry() == 2
+        assert queue.wait(keys).status[keys].tolist() == ['uploaded', 'uploaded']
+        assert fanc.lookup.annotations(segids[0], [('cell_info', 'tag')]) == ['tag 0']
+        # Adding the same annotation again does nothing
+        assert queue.put('cell_info', row(0)) == keys[0]
+        assert queue.flush() == 0
+
+        # Crash with one annotation pending and one mid-upload
+        keys = queue.put_many('cell_info', [row(2), row(3)])
+        crashed = subprocess.Popen([sys.executable, '-c', ''])
+        crashed.wait()
+        queue._db.execute("UPDATE uploads SET status = 'in flight', owner = ?"
+                          ' WHERE key = ?',
+                          (f'{socket.gethostname()} {crashed.pid} token', keys[1]))
+        queue._db.close()
+        queue = fanc.upload.UploadQueue(journal, start=False)
+        assert queue.status(keys).status[keys].tolist() == ['pending', 'unknown']
+        assert queue.flush() == 1
+        assert cave.table('cell_info').tag.tolist() == ['tag 0', 'tag 1', 'tag 2']
+        # Once checked, the annotation of unknown status can be requeued
+        assert queue.retry('unknown') == 1
+        assert queue.flush() == 1
+        assert len(cave.table('cell_info')) == 4
+        queue.close()
+
+        # Closing stops the background worker and by default uploads
+        # what's pending, or leaves it in the journal for next time
+        queue = fanc.upload.UploadQueue(journal, flush_interval=60)
+        key = queue.put('cell_info', row(4))
+        worker = queue._worker
+        queue.close(flush=False)
+        assert not worker.is_alive()
+        with fanc.upload.UploadQueue(journal, flush_interval=60) as queue:
+            assert queue.status([key]).status.tolist() == ['pending']
+            # The background worker uploads when woken by wait()
+            key = queue.put('cell_info', row(5))
+            assert queue.wait([key], timeout=10).status.tolist() == ['uploaded']
+            queue.put('cell_info', row(6))
+        assert queue._worker is None
+        assert cave.table('cell_info').tag.tolist()[-3:] == ['tag 4', 'tag 5', 'tag 6']
+
+        # Queues sharing a journal don't claim the same annotations, and don't
+        # mark annotations another live queue is uploading as 'unknown'
+        queue = fanc.upload.UploadQueue(journal, start=False)
+        other = fanc.upload.UploadQueue(journal, start=False, batch_size=1)
+        keys = queue.put_many('cell_info', [row(7), row(8)])
+        table_name, batch = other._claim_batch()
+        assert [key for key, _, _ in batch] == keys[:1]
+        fanc.upload.UploadQueue(journal, start=False).close(flush=False)
+        assert queue.status(keys).status[keys].tolist() == ['in flight', 'pending']
+        assert queue.flush() == 1
+        assert other._upload_batch(table_name, batch) == 1
+        assert queue.status(keys).status[keys].tolist() == ['uploaded', 'uploaded']
+        # Unless its lease has expired
+        key = queue.put('cell_info', row(9))
+        other.lease = -1
+        other._claim_batch()
+        assert queue.flush() == 0
+        assert queue.status([key]).status.tolist() == ['unknown']
+        other.close(flush=False)
+        queue.close()
+
+
+def test_published_manifest(tmp_path):
+    import json
+    from types import SimpleNamespace
+    from concurrent import futures
+    from fanc import publish
+    meshes = tmp_path / 'FANC' / 'neurons' / 'meshes'
+    meshes.mkdir(parents=True)
+    segids = [648518346486614449, 648518346498254576, 7]
+    for segid in segids:
+        (meshes / f'{segid}:0').write_text('{}')
+        (meshes / f'{segid}:0:1').write_text('')
+    path = 'file://' + str(tmp_path) + '/{}/neurons'
+
+    assert publish.list_public_segment_ids('FANC', path).tolist() == sorted(segids)
+    assert publish.read_manifest(path.format('FANC'))['source'] == 'listing'
+    publish.add_to_manifest(path.format('FANC'), [12])
+    assert publish.is_published([12, 7, 8], 'FANC', path).tolist() == [True, True, False]
+    assert sorted(os.listdir(tmp_path / 'FANC' / 'neurons')) == [
+        'meshes', publish.MANIFEST_FILENAME, publish.MANIFEST_FILENAME + '.lock']
+
+    # Concurrent additions don't lose each other's IDs
+    with futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: publish.add_to_manifest(path.format('FANC'), [100 + i]),
+                          range(16)))
+    assert publish.is_published(range(100, 116), 'FANC', path).all()
+
+    # On GCS, a manifest changed by someone else since it was read isn't
+    # overwritten, but read and merged again
+    from google.api_core.exceptions import PreconditionFailed
+
+    class Blob(object):
+        generation, content, uploads = 1, json.dumps({'segids': [1]}), 0
+
+        def reload(self):
+            pass
+
+        def download_as_bytes(self, if_generation_match):
+            return self.content
+
+        def upload_from_string(self, content, content_type, if_generation_match):
+            Blob.uploads += 1
+            if Blob.uploads == 1:
+                # Another writer gets in first
+                self.content, self.generation = json.dumps({'segids': [1, 5]}), 2
+            if if_generation_match != self.generation:
+                raise PreconditionFailed('Generation mismatch')
+            self.content, self.generation = content, self.generation + 1
+
+    blob = Blob()
+    client = SimpleNamespace(bucket=lambda name: SimpleNamespace(blob=lambda path: blob))
+    gcs_path = 'gs://bucket/FANC/neurons'
+    assert publish.add_to_manifest(gcs_path, [12], gcs_client=client).tolist() == [1, 5, 12]
+    assert json.loads(blob.content)['segids'] == [1, 5, 12]
+    assert Blob.uploads == 2
+
+
+def test_publish_pipeline(tmp_path, monkeypatch):
+    import time
+    import _thread
+    import cloudvolume
+    from types import SimpleNamespace
+    from fanc import publish
+    info = cloudvolume.CloudVolume.create_new_info(
+        num_channels=1, layer_type='segmentation', data_type='uint64',
+        encoding='raw', resolution=[400] * 3, voxel_offset=[0] * 3,
+        chunk_size=[64] * 3, volume_size=[64] * 3, mesh='meshes')
+    path = 'file://' + str(tmp_path) + '/{}/neurons'
+    cloudvolume.CloudVolume(path.format('FANC'), info=info).commit_info()
+
+    class MeshManager:
+        def mesh(self, seg_id):
+            if seg_id == 13:
+                raise RuntimeError('download failed')
+            return SimpleNamespace(vertices=np.random.rand(10, 3), faces=np.zeros((5, 3), int))
+    monkeypatch.setattr(fanc.auth, 'get_meshmanager', lambda: MeshManager())
+    checkpoint = tmp_path / 'checkpoint.txt'
+
+    result = publish.publish_mesh_to_gcloud(list(range(10, 20)), 'FANC', path, link_to_cellid=False,
+                                            checkpoint=str(checkpoint))
+    assert sorted(result['published']) == [10, 11, 12, 14, 15, 16, 17, 18, 19]
+    assert list(result['failed']) == [13]
+    assert result['stages']['upload']['done'] == 9
+    # The checkpoint is kept until every neuron has been published
+    assert checkpoint.exists()
+    assert publish.is_published([12, 13], 'FANC', path).tolist() == [True, False]
+
+    # Warping runs in worker processes, which import the stub from this file
+    cloudvolume.CloudVolume(path.format('JRC2018_VNC_FEMALE'), info=info).commit_info()
+    monkeypatch.setattr(publish, '_warp_mesh', _shift_mesh)
+    result = publish.publish_mesh_to_gcloud([10, 11, 12], 'JRC2018_VNC_FEMALE', path,
+                                            link_to_cellid=False, warp_processes=2,
+                                            checkpoint=None)
+    assert sorted(result['published']) == [10, 11, 12]
+    assert result['stages']['warp']['done'] == 3
+    mesh = cloudvolume.CloudVolume(path.format('JRC2018_VNC_FEMALE')).mesh.get(11)
+    assert mesh.vertices.min() >= 1000
+
+    # After an interruption, the workers stop before the checkpoint is closed,
+    # and what was published is recorded
+    class SlowMeshManager:
+        def mesh(self, seg_id):
+            time.sleep(0.5)
+            if seg_id == 22:
+                _thread.interrupt_main()
+            return SimpleNamespace(vertices=np.random.rand(10, 3), faces=np.zeros((5, 3), int))
+    monkeypatch.setattr(fanc.auth, 'get_meshmanager', lambda: SlowMeshManager())
+    checkpoint.unlink()
+    try:
+        publish.publish_mesh_to_gcloud(list(range(20, 40)), 'FANC', path, link_to_cellid=False,
+                                       download_workers=1, checkpoint=str(checkpoint))
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False
+    time.sleep(1)
+    uploaded = publish.list_mesh_ids(path.format('FANC'))
+    uploaded = uploaded[uploaded >= 20].tolist()
+    assert 0 < len(uploaded) < 20
+    assert sorted(int(i) for i in checkpoint.read_text().splitlines()[1:]) == uploaded
+    assert publish.is_published(range(20, 40), 'FANC', path).sum() == len(uploaded)
+
+
+def _shift_mesh(vertices, faces, template_space):
+    """Stands in for publish._warp_mesh, which needs transformix."""
+    return vertices + 1000, faces
+
+
+def test_delete_annotations(monkeypatch):
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    segids = [cave.add_segment([[i, 0, 0]]) for i in range(3)]
+    cave.create_table('cell_info', 'bound_tag_user', data=pd.DataFrame({
+        'pt_position': [[0, 0, 0], [1, 0, 0], [2, 0, 0]],
+        'tag': ['a', 'b', 'c'], 'user_id': [1, 2, 1]}))
+    sources = [('cell_info', 'tag')]
+    with cave:
+        # The annotation on segids[2] changed between the query and the check
+        get_annotation = cave.annotation.get_annotation
+        def stale_get_annotation(table_name, annotation_ids):
+            annos = get_annotation(table_name, annotation_ids)
+            return [{**anno, 'tag': 'changed'} if anno['tag'] == 'c' else anno
+                    for anno in annos]
+        monkeypatch.setattr(cave.annotation, 'get_annotation', stale_get_annotation)
+        report = fanc.upload.delete_annotations(
+            [(segids[0], 'a'), (segids[1], 'b'), (segids[2], 'c')], 1,
+            annotation_sources=sources)
+    assert report.status.tolist() == ['deleted', 'not deleted', 'not deleted']
+    assert report.reason[1].endswith('made it, User 2 (ID 2).')
+    assert report.reason[2] == 'Annotation 3 is "changed", not "c".'
+    assert cave.table('cell_info').tag.tolist() == ['b', 'c']
+    fanc.lookup._recent_deletions.clear()
+
+
+def _nuclei_layers(tmp_path, monkeypatch):
+    """
+    Point the nucleus segmentation and the verified nuclei layer at small
+    local volumes with three nuclei, and return the emulator to put the
+    soma table in.
+    """
+    import cloudvolume
+    from fanc import cave_emulator
+    info = cloudvolume.CloudVolume.create_new_info(
+        num_channels=1, layer_type='segmentation', data_type='uint64',
+        encoding='raw', resolution=[68.8, 68.8, 45], voxel_offset=[0, 0, 0],
+        chunk_size=[32, 32, 8], volume_size=[96, 96, 24])
+    paths = {}
+    for name in ['all', 'verified']:
+        paths[name] = 'file://' + str(tmp_path / name)
+        cloudvolume.CloudVolume(paths[name], info=info).commit_info()
+    nuclei = np.zeros((96, 96, 24), dtype=np.uint64)
+    ids = [20000000000000001, 20000000000000002, 20000000000000003]
+    nuclei[35:40, 35:40, 9:12] = ids[0]
+    nuclei[45:50, 45:50, 9:12] = ids[1]
+    nuclei[55:60, 55:60, 9:12] = ids[2]
+    cloudvolume.CloudVolume(paths['all'])[:, :, :] = nuclei
+    cloudvolume.CloudVolume(paths['verified'])[:, :, :] = np.zeros_like(nuclei)
+    monkeypatch.setattr(fanc.upload, '_all_nuclei_path', paths['all'])
+    monkeypatch.setattr(fanc.upload, '_verified_nuclei_path', paths['verified'])
+    monkeypatch.setattr(fanc.upload, '_recently_verified_nucleus_ids', {})
+    monkeypatch.setattr(fanc.upload, '_verified_nucleus_ids_cache', {})
+
+    def layer_ids():
+        return set(np.unique(cloudvolume.CloudVolume(paths['verified'])[:, :, :]).tolist())
+
+    def verify(nucleus_id, x):
+        row = {'id': nucleus_id, 'pt_position': [x * 16, x * 16, 10],
+               'volume': 1.0, 'bb_start_position': [x * 16 - 40, x * 16 - 40, 9],
+               'bb_end_position': [x * 16 + 40, x * 16 + 40, 12]}
+        if 'somas_dec2022' in cave._tables:
+            cave._insert('somas_dec2022', [row])
+        else:
+            cave.create_table('somas_dec2022', 'nucleus_detection', data=[row])
+
+    cave = cave_emulator.CAVEEmulator()
+    return cave, ids, verify, layer_ids
+
+
+def test_update_verified_nuclei_layer(tmp_path, monkeypatch):
+    cave, ids, verify, layer_ids = _nuclei_layers(tmp_path, monkeypatch)
+    verify(ids[0], 37)
+    point = [48 * 16, 48 * 16, 10]
+    with cave:
+        fanc.upload.update_verified_nuclei_layer(point, max_workers=2)
+        assert layer_ids() == {0, ids[0]}
+        # A nucleus verified by someone else since the last update survives
+        verify(ids[1], 47)
+        fanc.upload.update_verified_nuclei_layer(point, max_workers=2)
+        assert layer_ids() == {0, ids[0], ids[1]}
+        # As does one that was just added but isn't returned by queries yet
+        fanc.upload.update_verified_nuclei_layer(point, nucleus_ids=[ids[2]], max_workers=2)
+        fanc.upload.update_verified_nuclei_layer(point, max_workers=2)
+        assert layer_ids() == {0, *ids}
+
+        # Batch callers can query the verified IDs once and pass them in
+        n_queries = cave.request_counts['materialize.live_live_query']
+        verified_ids = fanc.upload.get_verified_nucleus_ids()
+        for _ in range(3):
+            fanc.upload.update_verified_nuclei_layer(point, verified_ids=verified_ids,
+                                                     max_workers=2)
+        assert layer_ids() == {0, *ids}
+        # Or reuse a recent query
+        assert (fanc.upload.get_verified_nucleus_ids(max_age=60) == verified_ids).all()
+        assert cave.request_counts['materialize.live_live_query'] == n_queries + 1
+
+
+def test_remove_unverified():
+    # IDs that differ only past float64 precision must not be confused
+    data = np.array([[0, 2**60 + 1], [2**60 + 2, 2**60 + 1]], dtype=np.uint64)
+    result = fanc.upload._remove_unverified(data.copy(), np.array([0, 2**60 + 1]))
+    assert result.tolist() == [[0, 2**60 + 1], [0, 2**60 + 1]]
+    assert fanc.upload._remove_unverified(data.copy(), np.array([0])).max() == 0
+
+
+def test_rebuild_verified_nuclei_layer(tmp_path, monkeypatch):
+    from cloudfiles import CloudFiles
+    from taskqueue import TaskQueue
+    cave, ids, verify, layer_ids = _nuclei_layers(tmp_path, monkeypatch)
+    workspace = 'file://' + str(tmp_path / 'workspace')
+    verify(ids[0], 37)
+    with cave:
+        # 3x3x3 chunks in blocks of 2x2x2 chunks
+        assert fanc.upload.rebuild_verified_nuclei_layer(
+            task_shape=(2, 2, 2), workspace=workspace) == 8
+        assert layer_ids() == {0, ids[0]}
+        # A finished local rebuild clears the workspace, so the next one
+        # picks up newly verified nuclei instead of doing nothing
+        assert list(CloudFiles(workspace).list()) == []
+        verify(ids[1], 47)
+        assert fanc.upload.rebuild_verified_nuclei_layer(
+            task_shape=(2, 2, 2), workspace=workspace) == 8
+        assert layer_ids() == {0, ids[0], ids[1]}
+
+        # Through a queue, an interrupted rebuild resumes with its own IDs
+        queue = 'fq://' + str(tmp_path / 'queue')
+        verify(ids[2], 57)
+        assert fanc.upload.rebuild_verified_nuclei_layer(
+            task_shape=(2, 2, 2), workspace=workspace, queue=queue) == 8
+        tq = TaskQueue(queue)
+        executed = []
+        tq.poll(lease_seconds=60, after_fn=lambda task: executed.append(task),
+                stop_fn=lambda: len(executed) == 3)
+        tq.purge()
+        assert fanc.upload.rebuild_verified_nuclei_layer(
+            task_shape=(2, 2, 2), workspace=workspace, queue=queue) == 5
+        tq.poll(lease_seconds=60, stop_fn=lambda: tq.is_empty())
+        assert layer_ids() == {0, *ids}
+        # Once all blocks are done, the next call starts over
+        assert fanc.upload.rebuild_verified_nuclei_layer(
+            task_shape=(2, 2, 2), workspace=workspace, queue=queue) == 8
+        tq.purge()
+
+
+def test_subclass_matching():
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    legs = [('body part innervated', 'innervates leg')]
+    cns = [('primary class', 'CNS neuron')]
+    # Each of these cells has a term that also sits under another parent
+    annotations = [
+        legs + [('innervates leg', 'innervates T2 leg'),
+                ('innervates T2 leg', 'innervates coxa')],
+        legs + [('innervates leg', 'innervates T1 leg'),
+                ('innervates T1 leg', 'innervates femur')],
+        cns + [('CNS neuron', 'visual centrifugal'),
+               ('visual centrifugal', 'lobula tangential'),
+               ('lobula tangential', 'LT1a')],
+        cns + [('CNS neuron', 'visual projection'),
+               ('visual projection', 'lobula plate tangential')],
+    ]
+    segids = [cave.add_segment([[i, 0, 0]]) for i in range(len(annotations))]
+    rows = [(i, tag2, tag) for i, pairs in enumerate(annotations)
+            for tag2, tag in pairs]
+    cave.create_table('cell_info', 'bound_double_tag_user', data=pd.DataFrame({
+        'pt_position': [[i, 0, 0] for i, _, _ in rows],
+        'tag2': [tag2 for _, tag2, _ in rows],
+        'tag': [tag for _, _, tag in rows],
+        'user_id': 1}))
+    fanc.lookup._recent_uploads.clear()
+    fanc.lookup._recent_deletions.clear()
+    with cave:
+        def query(tags, include_subclasses=True, **kwargs):
+            return fanc.lookup.cells_annotated_with(
+                tags, source_tables=[('cell_info', 'tag')],
+                include_subclasses=include_subclasses, **kwargs)
+        assert query('innervates T1 leg') == [segids[1]]
+        assert query('innervates T2 leg') == [segids[0]]
+        assert query('innervates leg') == sorted(segids[:2])
+        assert query('innervates leg', exclude_tags='innervates T1 leg') == [segids[0]]
+        assert query('visual centrifugal') == [segids[2]]
+        assert query('visual projection') == [segids[3]]
+        assert query('CNS neuron') == sorted(segids[2:])
+        assert query('innervates coxa', include_subclasses=False) == [segids[0]]
+
+
+def test_recent_writes_overlay():
+    import threading
+    from fanc import cave_emulator
+    cave = cave_emulator.CAVEEmulator()
+    segid = cave.add_segment([[0, 0, 0]])
+    cave.create_table('cell_info', 'bound_double_tag_user', data=pd.DataFrame({
+        'pt_position': [[0, 0, 0]], 'tag': ['sensory neuron'],
+        'tag2': ['primary class'], 'user_id': [1]}))
+    annotation_id = cave.table('cell_info')['id'].iloc[0]
+    sources = [('cell_info', 'tag')]
+    fanc.lookup._recent_uploads.clear()
+    fanc.lookup._recent_deletions.clear()
+    try:
+        with cave:
+            # Post, then look up before the server returns the new row
+            fanc.lookup.record_uploaded_annotations('cell_info', [{
+                'id': annotation_id + 1, 'pt_root_id': segid, 'pt_position': [0, 0, 0],
+                'tag': 'photoreceptor neuron', 'tag2': 'sensory neuron', 'user_id': 1}])
+            assert fanc.lookup.annotations(segid, sources) == ['sensory neuron',
+                                                               'photoreceptor neuron']
+            # Delete, then look up while the server still returns the row
+            fanc.lookup.record_deleted_annotations('cell_info', [annotation_id])
+            assert fanc.lookup.annotations(segid, sources) == ['photoreceptor neuron']
+
+            # Recording writes from another thread while looking up is safe
+            def record():
+                for i in range(2000):
+                    fanc.lookup.record_uploaded_annotations('cell_info', [{
+                        'id': 10 + i, 'pt_root_id': i, 'pt_position': [0, 0, 0],
+                        'tag': 'x', 'tag2': 'y', 'user_id': 1}])
+                    fanc.lookup.record_deleted_annotations('cell_info', [10 + i])
+            writer = threading.Thread(target=record)
+            writer.start()
+            while writer.is_alive():
+                fanc.lookup._merge_recent_writes(cave.table('cell_info'), 'cell_info')
+            writer.join()
+    finally:
+        fanc.lookup._recent_uploads.clear()
+        fanc.lookup._recent_deletions.clear()
+
+
 def test_false():
     assert 0 == 1
 
@@ -96,5 +1068,7 @@ if __name__ == '__main__':
 #    print('test_lookup: PASS')
     test_annotations()
     print('test_annotations: PASS')
+    test_connectome_graph()
+    print('test_connectome_graph: PASS')
     print('All tests passed')
 